@@ -0,0 +1,209 @@
+from models import arrival_history, precomputed_stats, backfill, vehicle_positions, config, util, instrumentation
+import compute_arrivals
+import compute_stats
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Computes arrivals and stats for a range of dates, e.g. to re-process historical data after changing
+# the algorithm for computing arrivals. Each (date, route) is a separate work unit that runs in a pool of
+# worker processes, and the raw state for the next date is downloaded while computing arrivals for the current date.
+#
+# Finished work units are recorded in a journal in the data/ directory, so running the same command again
+# after it was interrupted only computes the remaining work units.
+
+def get_state_for_date(d, agency: config.Agency, route_groups, journal: backfill.BackfillJournal, arrivals_version) -> list:
+    # Downloads the raw state for the routes whose arrivals have not been computed yet for date d.
+    # Returns a list of (start_time, end_time, state, route_ids) tuples for each day start hour.
+    date_state = []
+
+    for start_hour, route_ids in route_groups:
+        pending_route_ids = [
+            route_id for route_id in route_ids
+            if not journal.is_done('arrivals', agency.id, d, arrivals_version, route_id)
+        ]
+        if len(pending_route_ids) == 0:
+            continue
+
+        start_time, end_time = compute_arrivals.get_time_range(d, start_hour, agency.tz)
+
+        with instrumentation.stage('get_state', agency=agency.id, date=str(d)):
+            state = vehicle_positions.get_state(agency.id, d, start_time, end_time, pending_route_ids)
+
+        date_state.append((start_time, end_time, state, pending_route_ids))
+
+    return date_state
+
+def get_file_size(path):
+    return os.path.getsize(path) if path is not None and os.path.exists(path) else 0
+
+def backfill_arrivals_for_date(d, agency: config.Agency, date_state, journal: backfill.BackfillJournal, arrivals_version,
+        executor, max_inflight_bytes, save_to_s3) -> int:
+    # Computes arrivals for each route in a worker process, returning the number of routes with errors.
+
+    tasks = []
+    for start_time, end_time, state, route_ids in date_state:
+        for route_id in route_ids:
+            if route_id not in state.cache_paths:
+                print(f'no state for route {route_id}')
+                journal.record('arrivals', agency.id, d, arrivals_version, route_id, num_arrivals=0)
+                continue
+
+            cache_paths = state.cache_paths[route_id]
+            tasks.append((
+                route_id,
+                sum(get_file_size(path) for path in cache_paths),
+                compute_arrivals.compute_arrivals_for_route,
+                (d, agency.id, route_id, cache_paths, start_time, end_time, save_to_s3)
+            ))
+
+    num_errors = 0
+
+    for route_id, future in backfill.run_bounded(executor, tasks, max_inflight_bytes):
+        try:
+            result = future.result()
+        except Exception as err:
+            print(f'{route_id}: error computing arrivals: {repr(err)}')
+            journal.record('arrivals', agency.id, d, arrivals_version, route_id, status='error', error=repr(err))
+            num_errors += 1
+        else:
+            journal.record('arrivals', agency.id, d, arrivals_version, route_id,
+                seconds=result['seconds'], num_arrivals=result['num_arrivals'])
+
+    return num_errors
+
+def backfill_stats_for_date(d, agency: config.Agency, route_ids, journal: backfill.BackfillJournal, stats_version,
+        executor, max_inflight_bytes, save_to_s3) -> int:
+    # Computes stats for each route in a worker process and saves the stats for all routes,
+    # returning the number of routes with errors (stats are not saved if there are any errors).
+
+    t1 = time.time()
+
+    time_str_intervals, timestamp_intervals = compute_stats.get_stats_intervals(d, agency.tz)
+
+    tasks = [(
+            route_id,
+            get_file_size(arrival_history.get_cache_path(agency.id, route_id, d)),
+            compute_stats.compute_stats_for_route,
+            (d, agency.id, route_id, timestamp_intervals)
+        ) for route_id in route_ids
+    ]
+
+    route_stats_map = {}
+    num_errors = 0
+
+    for route_id, future in backfill.run_bounded(executor, tasks, max_inflight_bytes):
+        try:
+            route_stats_map[route_id] = future.result()
+        except Exception as err:
+            print(f'{route_id}: error computing stats: {repr(err)}')
+            num_errors += 1
+
+    if num_errors > 0:
+        journal.record('stats', agency.id, d, stats_version, status='error', error=f'{num_errors} routes failed')
+        return num_errors
+
+    compute_stats.save_stats_for_routes(d, agency, route_ids, [route_stats_map[route_id] for route_id in route_ids],
+        time_str_intervals, save_to_s3=save_to_s3)
+
+    journal.record('stats', agency.id, d, stats_version, seconds=round(time.time() - t1, 2))
+
+    return 0
+
+def backfill_agency(agency: config.Agency, dates, route_ids, journal: backfill.BackfillJournal,
+        workers=1, max_inflight_mb=1024, save_to_s3=False, include_stats=True):
+
+    arrivals_version = arrival_history.DefaultVersion
+
+    # stats need to be computed again if arrivals are computed with a new version
+    stats_version = f'{precomputed_stats.DefaultVersion}-{arrival_history.DefaultVersion}'
+
+    max_inflight_bytes = max_inflight_mb * 1024 * 1024
+
+    route_groups = compute_arrivals.get_route_ids_by_start_hour(agency, route_ids)
+
+    def is_date_done(d):
+        return all(journal.is_done('arrivals', agency.id, d, arrivals_version, route_id) for route_id in route_ids) \
+            and (not include_stats or journal.is_done('stats', agency.id, d, stats_version))
+
+    pending_dates = [d for d in dates if not is_date_done(d)]
+
+    print(f'{agency.id}: {len(pending_dates)} of {len(dates)} dates remaining')
+
+    num_errors = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor, ThreadPoolExecutor(max_workers=1) as download_executor:
+
+        def download_state(d):
+            return download_executor.submit(get_state_for_date, d, agency, route_groups, journal, arrivals_version)
+
+        next_date_state = download_state(pending_dates[0]) if len(pending_dates) > 0 else None
+
+        for i, d in enumerate(pending_dates):
+            t1 = time.time()
+
+            date_state = next_date_state.result()
+
+            # download state for the next date while computing arrivals for this date
+            if i + 1 < len(pending_dates):
+                next_date_state = download_state(pending_dates[i + 1])
+
+            num_date_errors = backfill_arrivals_for_date(d, agency, date_state, journal, arrivals_version,
+                executor, max_inflight_bytes, save_to_s3)
+
+            if include_stats and not journal.is_done('stats', agency.id, d, stats_version):
+                if num_date_errors > 0:
+                    print(f'{d}: not computing stats since arrivals failed for {num_date_errors} routes')
+                else:
+                    num_date_errors += backfill_stats_for_date(d, agency, route_ids, journal, stats_version,
+                        executor, max_inflight_bytes, save_to_s3)
+
+            print(f'{d}: done in {round(time.time() - t1, 1)} sec ({num_date_errors} errors)')
+
+            num_errors += num_date_errors
+
+    if num_errors > 0:
+        raise Exception(f"{num_errors} work units failed for {agency.id}, run again to retry them")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute arrivals and stats for a range of dates')
+    parser.add_argument('--agency', required=True, help='Agency ID')
+    parser.add_argument('--route', nargs='*')
+    parser.add_argument('--start-date', required=True, help='Start date (yyyy-mm-dd)')
+    parser.add_argument('--end-date', required=True, help='End date (yyyy-mm-dd), inclusive')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--max-inflight-mb', type=int, default=1024,
+        help='maximum size of cached state (in MB) for routes being processed at the same time')
+    parser.add_argument('--journal', default='backfill', help='name of journal file used to resume the backfill')
+    parser.add_argument('--no-stats', dest='stats', action='store_false', help='only compute arrivals')
+    parser.add_argument('--s3', dest='s3', action='store_true', help='store in s3')
+    instrumentation.add_report_arguments(parser)
+    parser.set_defaults(s3=False)
+    parser.set_defaults(stats=True)
+
+    args = parser.parse_args()
+
+    instrumentation.start_report('backfill', trace_memory=args.trace_memory)
+
+    agency = config.get_agency(args.agency)
+
+    if args.route is not None:
+        route_ids = args.route
+    else:
+        route_ids = [route.id for route in agency.get_route_list()]
+
+    dates = util.get_dates_in_range(args.start_date, args.end_date)
+
+    journal_path = backfill.get_journal_path(agency.id, args.journal)
+    print(f'journal: {journal_path}')
+
+    try:
+        backfill_agency(agency, dates, route_ids, backfill.BackfillJournal(journal_path),
+            workers=args.workers,
+            max_inflight_mb=args.max_inflight_mb,
+            save_to_s3=args.s3,
+            include_stats=args.stats,
+        )
+    finally:
+        instrumentation.save_report(args.report)
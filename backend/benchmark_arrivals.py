@@ -0,0 +1,138 @@
+from models import eclipses, spatial_index, synthetic_state, util
+import argparse
+import json
+import time
+import tracemalloc
+
+# Measures the time and memory used by each stage of computing arrivals for synthetic routes with GPS observations
+# of vehicles (see models/synthetic_state.py), without downloading any data, to compare the performance of
+# changes to the algorithm in models/eclipses.py.
+
+# scenario name => (route config args, route state args)
+scenarios = {
+    # many vehicles on a short straight route with closely spaced stops
+    'busy': (dict(num_stops=30, stop_spacing=120), dict(num_vehicles=60, hours=18)),
+    # long route that turns back on itself
+    'curve': (dict(num_stops=80, stop_spacing=250, shape='curve'), dict(num_vehicles=20, hours=18)),
+    'loop': (dict(num_stops=25, stop_spacing=250, shape='loop'), dict(num_vehicles=15, hours=18)),
+    # noisy GPS positions and frequent gaps in observations
+    'noisy': (dict(num_stops=40, stop_spacing=200), dict(num_vehicles=20, hours=18, noise_meters=25, gap_probability=0.5)),
+}
+
+class BenchmarkAgency:
+    id = 'test'
+    tz = None
+    invalid_direction_times = []
+
+def compute_distances(buses, route_config, use_spatial_index):
+    # finds the distance from each stop to the nearby observations,
+    # in the same way as eclipses.get_possible_arrivals
+    if use_spatial_index:
+        bus_index = spatial_index.GridIndex(buses['LAT'].values, buses['LON'].values)
+        for stop_info in route_config.get_stop_infos():
+            bus_index.query_radius(stop_info.lat, stop_info.lon, 200)
+    else:
+        lat_values = buses['LAT'].values
+        lon_values = buses['LON'].values
+        for stop_info in route_config.get_stop_infos():
+            util.haver_distance(stop_info.lat, stop_info.lon, lat_values, lon_values)
+
+def benchmark_scenario(name, seed=0, repeat=3, use_spatial_index=True) -> dict:
+    route_config_args, route_state_args = scenarios[name]
+    route_state_args = dict(route_state_args)
+    hours = route_state_args.pop('hours')
+
+    route_config = synthetic_state.make_route_config(**route_config_args)
+
+    start_time = 1577534400
+    route_state = synthetic_state.make_route_state(route_config, start_time, start_time + hours * 3600,
+        seed=seed, **route_state_args)
+
+    agency = BenchmarkAgency()
+
+    def get_stages():
+        # returns a list of (stage, num_observations, fn) tuples, where each function uses the result of the previous stage
+        results = {}
+
+        def resample():
+            results['buses'] = eclipses.resample_buses(route_state)
+
+        def distances():
+            compute_distances(results['buses'], route_config, use_spatial_index)
+
+        def possible_arrivals():
+            results['possible_arrivals'] = eclipses.get_possible_arrivals(agency, results['buses'].copy(), route_config, None,
+                use_spatial_index=use_spatial_index)
+
+        def clean():
+            results['arrivals'] = eclipses.clean_arrivals(results['possible_arrivals'], results['buses'], route_config)
+
+        return results, [
+            ('resample_buses', lambda: len(route_state), resample),
+            ('distances', lambda: len(results['buses']), distances),
+            ('get_possible_arrivals', lambda: len(results['buses']), possible_arrivals),
+            ('clean_arrivals', lambda: len(results['possible_arrivals']), clean),
+        ]
+
+    stage_times = {}
+
+    for i in range(repeat):
+        results, stages = get_stages()
+        for stage, _, fn in stages:
+            t1 = time.time()
+            fn()
+            stage_times.setdefault(stage, []).append(time.time() - t1)
+
+    # measure memory separately, since tracing memory allocations makes the code slower
+    stage_peak_memory = {}
+    results, stages = get_stages()
+    for stage, _, fn in stages:
+        tracemalloc.start()
+        fn()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stage_peak_memory[stage] = peak_memory
+
+    print(f"{name}: {len(route_config.get_stop_ids())} stops, {len(route_state)} observations, "
+        f"{len(results['buses'])} resampled observations, {len(results['possible_arrivals'])} possible arrivals, "
+        f"{len(results['arrivals'])} arrivals")
+
+    stats = []
+    for stage, get_num_observations, _ in stages:
+        seconds = min(stage_times[stage])
+        num_observations = get_num_observations()
+        stage_stats = {
+            'scenario': name,
+            'stage': stage,
+            'seconds': round(seconds, 4),
+            'observations': num_observations,
+            'observations_per_sec': round(num_observations / seconds) if seconds > 0 else None,
+            'peak_memory_mb': round(stage_peak_memory[stage] / 1024 / 1024, 1),
+        }
+        print(f"  {stage}: {stage_stats['seconds']} sec (best of {repeat}), "
+            f"{stage_stats['observations_per_sec']} obs/sec, peak memory {stage_stats['peak_memory_mb']} MB")
+        stats.append(stage_stats)
+
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark computing arrivals for synthetic routes')
+    parser.add_argument('--scenario', nargs='*', choices=list(scenarios.keys()), help='scenarios to run (default all)')
+    parser.add_argument('--seed', type=int, default=3, help='random seed')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times to run each stage')
+    parser.add_argument('--dense', dest='spatial_index', action='store_false',
+        help='compute distances from every observation to every stop instead of using a spatial index')
+    parser.add_argument('--json', help='path of JSON file to write the results')
+    parser.set_defaults(spatial_index=True)
+
+    args = parser.parse_args()
+
+    scenario_names = args.scenario if args.scenario else list(scenarios.keys())
+
+    all_stats = []
+    for name in scenario_names:
+        all_stats.extend(benchmark_scenario(name, seed=args.seed, repeat=args.repeat, use_spatial_index=args.spatial_index))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(all_stats, f, indent=2)
@@ -0,0 +1,47 @@
+from models import arrival_history, config, util
+import argparse
+
+# Combines the daily arrival history files in the local data/ directory into one archive file per route per month
+# (see arrival_history.compact_archive), so that computing metrics for a range of dates only opens one file
+# per route per month.
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compact cached arrival history into monthly archives')
+    parser.add_argument('--agency', required=False, help='Agency ID')
+    parser.add_argument('--route', nargs='*')
+    parser.add_argument('--date', help='Date (yyyy-mm-dd) in the month to compact')
+    parser.add_argument('--start-date', help='Start date (yyyy-mm-dd)')
+    parser.add_argument('--end-date', help='End date (yyyy-mm-dd), inclusive')
+    parser.add_argument('--version', default=arrival_history.DefaultVersion, help='arrival history version')
+    parser.add_argument('--remove-daily', dest='remove_daily', action='store_true',
+        help='remove daily arrival history files after adding them to the archive')
+    parser.set_defaults(remove_daily=False)
+
+    args = parser.parse_args()
+
+    agencies = [config.get_agency(args.agency)] if args.agency is not None else config.agencies
+
+    if args.route is not None and args.agency is None:
+        raise Exception("Must specify --agency with --route")
+
+    if args.date:
+        dates = util.get_dates_in_range(args.date, args.date)
+    elif args.start_date is not None and args.end_date is not None:
+        dates = util.get_dates_in_range(args.start_date, args.end_date)
+    else:
+        raise Exception('missing date, start-date, or end-date')
+
+    # one date in each month
+    month_dates = list({(d.year, d.month): d for d in dates}.values())
+
+    for agency in agencies:
+        if args.agency is not None and args.route is not None:
+            route_ids = args.route
+        else:
+            route_ids = [route.id for route in agency.get_route_list()]
+
+        for d in month_dates:
+            for route_id in route_ids:
+                archive_path = arrival_history.compact_archive(agency.id, route_id, d, args.version, remove_daily=args.remove_daily)
+                if archive_path is not None:
+                    print(f'{route_id}: {archive_path}')
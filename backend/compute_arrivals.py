@@ -1,51 +1,65 @@
-from models import arrival_history, util, vehicle_positions, eclipses, config
+from models import arrival_history, arrival_checkpoints, util, vehicle_positions, eclipses, config, instrumentation
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, date, timedelta
 import time
 
 
-def compute_arrivals_for_date_and_start_hour(d: date, start_hour: int,
-                agency: config.Agency, route_ids: list,
-                save_to_s3=True):
+def compute_arrivals_for_route(d: date, agency_id: str, route_id: str, cache_paths: tuple,
+                start_time, end_time, save_to_s3=True, resume=False) -> dict:
+    # Computes and saves the arrival history for one route from the cached state at cache_paths
+    # (a tuple of (cache_path, partial_cache_path) from vehicle_positions.CachedState).
+    # This only takes arguments that can be pickled cheaply, so that it can run in a worker process.
 
-    tz = agency.tz
+    agency = config.get_agency(agency_id)
 
-    start_dt = tz.localize(datetime(d.year, d.month, d.day, hour=start_hour))
-    end_dt = start_dt + timedelta(days=1)
+    t1 = time.time()
 
-    start_time = int(start_dt.timestamp())
-    end_time = int(end_dt.timestamp())
+    with instrumentation.stage('load_state', route=route_id, date=str(d)):
+        state = vehicle_positions.CachedState()
+        state.add(route_id, *cache_paths)
 
-    print(f"time = [{start_dt}, {end_dt})")
+        route_state = state.get_for_route(route_id)
 
-    t1 = time.time()
+    route_config = agency.get_route_config(route_id)
 
-    state = vehicle_positions.get_state(agency.id, d, start_time, end_time, route_ids)
+    with instrumentation.stage('find_arrivals', route=route_id, date=str(d)):
+        if resume:
+            arrivals_df = arrival_checkpoints.find_arrivals(agency, route_state, route_config, d, start_time, end_time)
+        else:
+            arrivals_df = eclipses.find_arrivals(agency, route_state, route_config, d)
 
-    print(f'retrieved state in {round(time.time()-t1,1)} sec')
+    instrumentation.snapshot_memory('find_arrivals', route=route_id, date=str(d))
 
-    for i, route_id in enumerate(route_ids):
-        route_state = state.get_for_route(route_id)
+    instrumentation.count('observations', len(route_state), route=route_id, date=str(d))
+    instrumentation.count('arrivals', len(arrivals_df), route=route_id, date=str(d))
 
-        if route_state is None:
-            print(f'no state for route {route_id}')
-            continue
+    history = arrival_history.from_data_frame(agency.id, route_id, arrivals_df, start_time, end_time)
+
+    print(f'{route_id}: {round(time.time()-t1,1)} saving arrival history')
 
-        route_config = agency.get_route_config(route_id)
+    arrival_history.save_for_date(history, d, save_to_s3)
 
-        t1 = time.time()
+    print(f'{route_id}: {round(time.time()-t1,2)} done')
 
-        arrivals_df = eclipses.find_arrivals(agency, route_state, route_config, d)
+    return {
+        'route_id': route_id,
+        'num_arrivals': len(arrivals_df),
+        'seconds': round(time.time()-t1, 2),
+    }
 
-        history = arrival_history.from_data_frame(agency.id, route_id, arrivals_df, start_time, end_time)
+def get_time_range(d: date, start_hour: int, tz) -> tuple:
+    # returns the (start_time, end_time) timestamps of the "day" starting at start_hour on date d
 
-        print(f'{route_id}: {round(time.time()-t1,1)} saving arrival history')
+    start_dt = tz.localize(datetime(d.year, d.month, d.day, hour=start_hour))
+    end_dt = start_dt + timedelta(days=1)
 
-        arrival_history.save_for_date(history, d, save_to_s3)
+    print(f"time = [{start_dt}, {end_dt})")
 
-        print(f'{route_id}: {round(time.time()-t1,2)} done')
+    return int(start_dt.timestamp()), int(end_dt.timestamp())
 
-def compute_arrivals(d: date, agency: config.Agency, route_ids: list, save_to_s3=True):
+def get_route_ids_by_start_hour(agency: config.Agency, route_ids: list) -> list:
+    # returns a list of (start_hour, route_ids) tuples, since some routes may start each "day" at a different hour
 
     all_custom_routes = []
     custom_start_hours = []
@@ -55,19 +69,72 @@ def compute_arrivals(d: date, agency: config.Agency, route_ids: list, save_to_s3
         custom_start_hours.append((custom_day_start_conf["start_hour"], custom_routes))
         all_custom_routes.extend(custom_routes)
 
-    compute_arrivals_for_date_and_start_hour(
-        d, start_hour=agency.default_day_start_hour,
-        agency=agency,
-        route_ids=[r for r in route_ids if r not in all_custom_routes],
-        save_to_s3=save_to_s3
-    )
+    return [
+        (agency.default_day_start_hour, [r for r in route_ids if r not in all_custom_routes])
+    ] + custom_start_hours
 
-    for start_hour, custom_routes in custom_start_hours:
+def compute_arrivals_for_date_and_start_hour(d: date, start_hour: int,
+                agency: config.Agency, route_ids: list,
+                save_to_s3=True, resume=False, workers=1):
+
+    start_time, end_time = get_time_range(d, start_hour, agency.tz)
+
+    t1 = time.time()
+
+    with instrumentation.stage('get_state', agency=agency.id, date=str(d)):
+        state = vehicle_positions.get_state(agency.id, d, start_time, end_time, route_ids)
+
+    print(f'retrieved state in {round(time.time()-t1,1)} sec')
+
+    route_args = []
+    for route_id in route_ids:
+        if route_id not in state.cache_paths:
+            print(f'no state for route {route_id}')
+            continue
+
+        route_args.append((d, agency.id, route_id, state.cache_paths[route_id], start_time, end_time, save_to_s3, resume))
+
+    if workers <= 1:
+        for args in route_args:
+            compute_arrivals_for_route(*args)
+        return
+
+    # each route is computed in a separate worker process, which only loads the cached state for that route.
+    # errors are collected so that a failure for one route doesn't prevent saving arrivals for other routes.
+    t1 = time.time()
+
+    route_results = []
+    errors = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(args[2], instrumentation.submit(executor, compute_arrivals_for_route, *args)) for args in route_args]
+
+        for route_id, future in futures:
+            try:
+                route_results.append(future.result())
+            except Exception as err:
+                print(f'{route_id}: error computing arrivals: {repr(err)}')
+                errors[route_id] = err
+
+    total_seconds = sum(result['seconds'] for result in route_results)
+
+    print(f'computed arrivals for {len(route_results)} routes in {round(time.time()-t1,1)} sec with {workers} workers ({round(total_seconds,1)} sec total)')
+    for result in sorted(route_results, key=lambda result: result['seconds'], reverse=True)[:5]:
+        print(f" {result['route_id']}: {result['seconds']} sec, {result['num_arrivals']} arrivals")
+
+    if len(errors) > 0:
+        raise Exception(f"Error computing arrivals for {len(errors)} routes: {', '.join(errors.keys())}")
+
+def compute_arrivals(d: date, agency: config.Agency, route_ids: list, save_to_s3=True, resume=False, workers=1):
+
+    for start_hour, start_hour_route_ids in get_route_ids_by_start_hour(agency, route_ids):
         compute_arrivals_for_date_and_start_hour(
             d, start_hour=start_hour,
             agency=agency,
-            route_ids=custom_routes,
-            save_to_s3=save_to_s3
+            route_ids=start_hour_route_ids,
+            save_to_s3=save_to_s3,
+            resume=resume,
+            workers=workers
         )
 
 if __name__ == '__main__':
@@ -78,10 +145,17 @@ if __name__ == '__main__':
     parser.add_argument('--start-date', help='Start date (yyyy-mm-dd)')
     parser.add_argument('--end-date', help='End date (yyyy-mm-dd), inclusive')
     parser.add_argument('--s3', dest='s3', action='store_true', help='store in s3')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+        help='only process GPS observations that were not processed the last time arrivals were computed for the same date')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes for computing arrivals for multiple routes')
+    instrumentation.add_report_arguments(parser)
     parser.set_defaults(s3=False)
+    parser.set_defaults(resume=False)
 
     args = parser.parse_args()
 
+    instrumentation.start_report('compute_arrivals', trace_memory=args.trace_memory)
+
     agencies = [config.get_agency(args.agency)] if args.agency is not None else config.agencies
 
     if args.route is not None and args.agency is None:
@@ -96,11 +170,14 @@ if __name__ == '__main__':
     else:
         raise Exception('missing date, start-date, or end-date')
 
-    for agency in agencies:
-        if args.agency is not None and args.route is not None:
-            route_ids = args.route
-        else:
-            route_ids = [route.id for route in agency.get_route_list()]
-
-        for d in dates:
-            compute_arrivals(d, agency, route_ids, args.s3)
+    try:
+        for agency in agencies:
+            if args.agency is not None and args.route is not None:
+                route_ids = args.route
+            else:
+                route_ids = [route.id for route in agency.get_route_list()]
+
+            for d in dates:
+                compute_arrivals(d, agency, route_ids, args.s3, resume=args.resume, workers=args.workers)
+    finally:
+        instrumentation.save_report(args.report)
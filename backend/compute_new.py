@@ -4,18 +4,12 @@ import requests
 from datetime import datetime, timedelta
 import boto3
 
-from models import config, util
+from models import config, util, instrumentation
 
 from compute_arrivals import compute_arrivals
 from compute_stats import compute_stats
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description = '')
-    parser.add_argument('--start-date', help='Start date (yyyy-mm-dd)')
-    parser.add_argument('--agency', required=False, help='Agency ID')
-
-    args = parser.parse_args()
-
+def main(args):
     agencies = [config.get_agency(args.agency)] if args.agency is not None else config.agencies
 
     s3_bucket = config.s3_bucket
@@ -69,10 +63,10 @@ if __name__ == '__main__':
             compute_start_time = datetime.now(tz)
 
             print(f'computing arrivals for {d}')
-            compute_arrivals(d, agency, route_ids)
+            compute_arrivals(d, agency, route_ids, resume=args.resume, workers=args.workers)
 
             print(f'computing stats for {d}')
-            compute_stats(d, agency, routes)
+            compute_stats(d, agency, routes, workers=args.workers)
 
             date_str = str(d)
 
@@ -84,3 +78,22 @@ if __name__ == '__main__':
                 save_state(state)
 
             d += timedelta(days=1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = '')
+    parser.add_argument('--start-date', help='Start date (yyyy-mm-dd)')
+    parser.add_argument('--agency', required=False, help='Agency ID')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes for computing arrivals and stats for multiple routes')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+        help='compute arrivals from all GPS observations, instead of only the observations that were not processed the last time')
+    instrumentation.add_report_arguments(parser)
+    parser.set_defaults(resume=True)
+
+    args = parser.parse_args()
+
+    instrumentation.start_report('compute_new', trace_memory=args.trace_memory)
+
+    try:
+        main(args)
+    finally:
+        instrumentation.save_report(args.report)
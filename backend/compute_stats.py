@@ -1,5 +1,6 @@
-from models import arrival_history, trip_times, constants, config, timetables, wait_times, metrics, precomputed_stats, util, gtfs
+from models import arrival_history, trip_times, constants, config, timetables, wait_times, metrics, precomputed_stats, util, gtfs, instrumentation
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
 import collections
 import numpy as np
@@ -234,92 +235,179 @@ def add_trip_time_stats_for_route(all_stats, timestamp_intervals, route_config,
                                 len(trip_min)
                             ]
 
-def compute_stats(d: date, agency: config.Agency, routes, scheduled=False, save_to_s3=True):
-
-    tz = agency.tz
+def compute_stats_for_route(d: date, agency_id: str, route_id: str, timestamp_intervals, scheduled=False):
+    #
+    # Computes stats for one route, returning a dict of stat ID => list of stats for the route in each interval
+    # (in the same format as the values of the 'routes' dict in the saved stats),
+    # or None if there is no arrival history (or timetable if scheduled=True) for this route.
+    #
+    # This only takes arguments that can be pickled cheaply, so that it can run in a worker process.
+    #
+    agency = config.get_agency(agency_id)
     stat_ids = precomputed_stats.AllStatIds
 
-    print(f"{d} {'(scheduled)' if scheduled else '(observed)'}")
+    print(route_id)
 
-    time_str_intervals = constants.DEFAULT_TIME_STR_INTERVALS.copy()
-    time_str_intervals.append(('07:00','19:00'))
+    t1 = time.time()
 
-    timestamp_intervals = [(
-            int(util.get_localized_datetime(d, start_time_str, tz).timestamp()),
-            int(util.get_localized_datetime(d, end_time_str, tz).timestamp())
-        ) for start_time_str, end_time_str in time_str_intervals
-    ]
+    route_config = agency.get_route_config(route_id)
 
-    timestamp_intervals.append((None, None))
-    time_str_intervals.append((None, None))
+    labels = {'route': route_id, 'date': str(d)}
+
+    if not scheduled:
+        try:
+            with instrumentation.stage('load_arrival_history', **labels):
+                history = arrival_history.get_by_date(agency.id, route_id, d)
+                history_df = history.get_data_frame()
+        except FileNotFoundError as ex:
+            print(ex)
+            return None
+
+        instrumentation.count('loaded_arrivals', len(history_df), **labels)
+
+    try:
+        with instrumentation.stage('load_timetable', **labels):
+            timetable = timetables.get_by_date(agency.id, route_id, d)
+    except (FileNotFoundError, KeyError) as ex:
+        if scheduled:
+            print(ex)
+            return None
+        else:
+            print(f'{ex} - skipping schedule adherence stats')
+            timetable = None
 
+    timetable_df = timetable.get_data_frame() if timetable is not None else None
+
+    # the add_*_stats_for_route functions add stats to all_stats[stat_id][interval_index][route_id]
     all_stats = {}
 
     for stat_id in stat_ids:
         all_stats[stat_id] = {}
 
         for interval_index, _ in enumerate(timestamp_intervals):
-            all_stats[stat_id][interval_index] = {}
+            all_stats[stat_id][interval_index] = {route_id: {'directions':{}}}
 
-    for route in routes:
-        route_id = route.id
-        print(route_id)
+            for dir_info in route_config.get_direction_infos():
+                dir_id = dir_info.id
 
-        t1 = time.time()
+                all_stats[stat_id][interval_index][route_id]['directions'][dir_id] = collections.defaultdict(dict)
 
-        route_config = agency.get_route_config(route_id)
+    base_df = timetable_df if scheduled else history_df
 
-        if not scheduled:
-            try:
-                history = arrival_history.get_by_date(agency.id, route_id, d)
-            except FileNotFoundError as ex:
-                print(ex)
-                continue
+    with instrumentation.stage('trip_time_stats', **labels):
+        add_trip_time_stats_for_route(all_stats, timestamp_intervals, route_config, base_df)
 
-            history_df = history.get_data_frame()
+    with instrumentation.stage('headway_and_wait_time_stats', **labels):
+        add_headway_and_wait_time_stats_for_route(all_stats, timestamp_intervals, route_config, base_df)
 
-        try:
-            timetable = timetables.get_by_date(agency.id, route_id, d)
-        except (FileNotFoundError, KeyError) as ex:
-            if scheduled:
-                print(ex)
-                continue
-            else:
-                print(f'{ex} - skipping schedule adherence stats')
-                timetable = None
+    if not scheduled and timetable_df is not None:
+        with instrumentation.stage('schedule_adherence_stats', **labels):
+            add_schedule_adherence_stats_for_route(all_stats, timestamp_intervals, route_config, history_df, timetable_df)
 
-        timetable_df = timetable.get_data_frame() if timetable is not None else None
+    t2 = time.time()
+    print(f' {round(t2-t1, 2)} sec')
 
-        for stat_id in stat_ids:
-            for interval_index, _ in enumerate(timestamp_intervals):
-                all_stats[stat_id][interval_index][route_id] = {'directions':{}}
+    return {
+        stat_id: [
+            all_stats[stat_id][interval_index][route_id]
+            for interval_index, _ in enumerate(timestamp_intervals)
+        ] for stat_id in stat_ids
+    }
+
+def get_stats_intervals(d: date, tz) -> tuple:
+    # returns a tuple (time_str_intervals, timestamp_intervals) with the time ranges of the day to compute stats for
 
-                for dir_info in route_config.get_direction_infos():
-                    dir_id = dir_info.id
+    time_str_intervals = constants.DEFAULT_TIME_STR_INTERVALS.copy()
+    time_str_intervals.append(('07:00','19:00'))
 
-                    all_stats[stat_id][interval_index][route_id]['directions'][dir_id] = collections.defaultdict(dict)
+    dates = [d] * len(time_str_intervals)
+    start_timestamps = util.get_timestamps(dates, [start_time_str for start_time_str, _ in time_str_intervals], tz)
+    end_timestamps = util.get_timestamps(dates, [end_time_str for _, end_time_str in time_str_intervals], tz)
 
-        base_df = timetable_df if scheduled else history_df
+    timestamp_intervals = [
+        (int(start_timestamp), int(end_timestamp)) for start_timestamp, end_timestamp in zip(start_timestamps, end_timestamps)
+    ]
 
-        add_trip_time_stats_for_route(all_stats, timestamp_intervals, route_config, base_df)
-        add_headway_and_wait_time_stats_for_route(all_stats, timestamp_intervals, route_config, base_df)
+    timestamp_intervals.append((None, None))
+    time_str_intervals.append((None, None))
 
-        if not scheduled and timetable_df is not None:
-            add_schedule_adherence_stats_for_route(all_stats, timestamp_intervals, route_config, history_df, timetable_df)
+    return time_str_intervals, timestamp_intervals
+
+def compute_stats(d: date, agency: config.Agency, routes, scheduled=False, save_to_s3=True, workers=1):
+
+    print(f"{d} {'(scheduled)' if scheduled else '(observed)'}")
+
+    time_str_intervals, timestamp_intervals = get_stats_intervals(d, agency.tz)
+
+    route_ids = [route.id for route in routes]
+
+    t1 = time.time()
+
+    if workers <= 1:
+        all_route_stats = [
+            compute_stats_for_route(d, agency.id, route_id, timestamp_intervals, scheduled)
+            for route_id in route_ids
+        ]
+    else:
+        # each route is computed in a separate worker process,
+        # and the stats for each route are merged below in the original order of the routes
+        errors = {}
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                instrumentation.submit(executor, compute_stats_for_route, d, agency.id, route_id, timestamp_intervals, scheduled)
+                for route_id in route_ids
+            ]
+
+            all_route_stats = []
+            for route_id, future in zip(route_ids, futures):
+                try:
+                    all_route_stats.append(future.result())
+                except Exception as err:
+                    print(f'{route_id}: error computing stats: {repr(err)}')
+                    errors[route_id] = err
+
+        if len(errors) > 0:
+            raise Exception(f"Error computing stats for {len(errors)} routes: {', '.join(errors.keys())}")
+
+        print(f'computed stats for {len(route_ids)} routes in {round(time.time()-t1,1)} sec with {workers} workers')
+
+    with instrumentation.stage('save_stats', agency=agency.id, date=str(d)):
+        save_stats_for_routes(d, agency, route_ids, all_route_stats, time_str_intervals, scheduled, save_to_s3)
+
+def save_stats_for_routes(d: date, agency: config.Agency, route_ids, all_route_stats, time_str_intervals,
+        scheduled=False, save_to_s3=True):
+    #
+    # Merges the stats returned by compute_stats_for_route for each route (None for routes without stats)
+    # and saves the stats for all routes for each stat ID and interval.
+    #
+    stat_ids = precomputed_stats.AllStatIds
 
-        t2 = time.time()
-        print(f' {round(t2-t1, 2)} sec')
+    all_stats = {}
 
     for stat_id in stat_ids:
-        for interval_index, (start_time, end_time) in enumerate(timestamp_intervals):
-            start_time_str, end_time_str = time_str_intervals[interval_index]
+        all_stats[stat_id] = {}
+
+        for interval_index, _ in enumerate(time_str_intervals):
+            all_stats[stat_id][interval_index] = {}
+
+    for route_id, route_stats in zip(route_ids, all_route_stats):
+        if route_stats is None:
+            continue
+
+        for stat_id in stat_ids:
+            for interval_index, interval_route_stats in enumerate(route_stats[stat_id]):
+                all_stats[stat_id][interval_index][route_id] = interval_route_stats
+
+    for stat_id in stat_ids:
+        for interval_index, (start_time_str, end_time_str) in enumerate(time_str_intervals):
 
             data = {
                 'routes': all_stats[stat_id][interval_index],
             }
             precomputed_stats.save_stats(agency.id, stat_id, d, start_time_str, end_time_str, scheduled=scheduled, data=data, save_to_s3=save_to_s3)
 
-def compute_stats_for_dates(dates, agency: config.Agency, scheduled=False, save_to_s3=True):
+def compute_stats_for_dates(dates, agency: config.Agency, scheduled=False, save_to_s3=True, workers=1):
 
     routes = agency.get_route_list()
 
@@ -330,10 +418,10 @@ def compute_stats_for_dates(dates, agency: config.Agency, scheduled=False, save_
             if date_key not in computed_date_keys:
                 computed_date_keys[date_key] = True
                 schedule_date = util.parse_date(date_key)
-                compute_stats(schedule_date, agency, routes, scheduled=True, save_to_s3=save_to_s3)
+                compute_stats(schedule_date, agency, routes, scheduled=True, save_to_s3=save_to_s3, workers=workers)
     else:
         for d in dates:
-            compute_stats(d, agency, routes, scheduled=False, save_to_s3=save_to_s3)
+            compute_stats(d, agency, routes, scheduled=False, save_to_s3=save_to_s3, workers=workers)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Compute and cache statistics')
@@ -343,11 +431,15 @@ if __name__ == '__main__':
     parser.add_argument('--end-date', help='End date (yyyy-mm-dd), inclusive')
     parser.add_argument('--s3', dest='s3', action='store_true', help='store in s3')
     parser.add_argument('--scheduled', dest='scheduled', action='store_true', help='compute scheduled stats from timetable')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes for computing stats for multiple routes')
+    instrumentation.add_report_arguments(parser)
     parser.set_defaults(s3=False)
     parser.set_defaults(scheduled=False)
 
     args = parser.parse_args()
 
+    instrumentation.start_report('compute_stats', trace_memory=args.trace_memory)
+
     agencies = [config.get_agency(args.agency)] if args.agency is not None else config.agencies
 
     if args.date:
@@ -363,5 +455,8 @@ if __name__ == '__main__':
 
     scheduled = args.scheduled
 
-    for agency in agencies:
-        compute_stats_for_dates(dates, agency, scheduled=scheduled, save_to_s3=args.s3)
+    try:
+        for agency in agencies:
+            compute_stats_for_dates(dates, agency, scheduled=scheduled, save_to_s3=args.s3, workers=args.workers)
+    finally:
+        instrumentation.save_report(args.report)
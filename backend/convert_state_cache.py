@@ -0,0 +1,25 @@
+from models import vehicle_positions, config
+from pathlib import Path
+import argparse
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert cached CSV state files to the columnar format')
+    parser.add_argument('--agency', required=False, help='Agency ID')
+    parser.add_argument('--date', required=False, help='Only convert state cached for this date (yyyy-mm-dd)')
+    parser.add_argument('--remove-csv', dest='remove_csv', action='store_true', help='remove CSV files after converting')
+    parser.set_defaults(remove_csv=False)
+
+    args = parser.parse_args()
+
+    agencies = [config.get_agency(args.agency)] if args.agency is not None else config.agencies
+
+    for agency in agencies:
+        state_cache_dir = Path(vehicle_positions.get_state_cache_dir(agency.id))
+        if not state_cache_dir.exists():
+            continue
+
+        date_pattern = args.date if args.date is not None else '*'
+
+        for csv_path in sorted(state_cache_dir.glob(f'{date_pattern}/state_*.csv')):
+            table_path = vehicle_positions.convert_csv_cache(str(csv_path), remove_csv=args.remove_csv)
+            print(f'{csv_path} -> {table_path}')
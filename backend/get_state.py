@@ -1,4 +1,4 @@
-from models import vehicle_positions, util, config
+from models import vehicle_positions, util, config, instrumentation
 import argparse
 
 if __name__ == '__main__':
@@ -7,9 +7,14 @@ if __name__ == '__main__':
     parser.add_argument('--date', required=True, help='date')
     parser.add_argument('--start-time', required=False, help='start time (hh:mm)')
     parser.add_argument('--end-time', required=False, help='end time (hh:mm)')
+    parser.add_argument('--concurrency', type=int, required=False, help='maximum number of concurrent requests to S3')
+    parser.add_argument('--max-buffer-mb', type=int, required=False, help='maximum size of buffered observations in memory (MB)')
+    instrumentation.add_report_arguments(parser)
 
     args = parser.parse_args()
 
+    instrumentation.start_report('get_state', trace_memory=args.trace_memory)
+
     agencies = [config.get_agency(args.agency)] if args.agency is not None else config.agencies
 
     date_str = args.date
@@ -36,4 +41,7 @@ if __name__ == '__main__':
         print(f"start = {local_start}")
         print(f"end = {local_end}")
 
-        state = vehicle_positions.get_state(agency.id, d, local_start.timestamp(), local_end.timestamp(), route_ids)
+        with instrumentation.stage('get_state', agency=agency.id, date=str(d)):
+            state = vehicle_positions.get_state(agency.id, d, local_start.timestamp(), local_end.timestamp(), route_ids, max_buffer_mb=args.max_buffer_mb, concurrency=args.concurrency)
+
+    instrumentation.save_report(args.report)
@@ -123,8 +123,8 @@ def download_arrival_data():
         
 
     ## convert unix timestamp to datetime then convert to agency timezone then format as string
-    arrival_df['arrival_time'] = arrival_df['arrival_time_unix'].apply(lambda x: util.unix_timestamp_to_datetime(x, agency_config.tz).strftime('%Y-%m-%d %H:%M:%S'))
-    arrival_df['departure_time'] = arrival_df['departure_time_unix'].apply(lambda x: util.unix_timestamp_to_datetime(x, agency_config.tz).strftime('%Y-%m-%d %H:%M:%S'))
+    arrival_df['arrival_time'] = util.format_timestamps(arrival_df['arrival_time_unix'].values, agency_config.tz)
+    arrival_df['departure_time'] = util.format_timestamps(arrival_df['departure_time_unix'].values, agency_config.tz)
 
     # rearrange columns and sort for user convenience
     arrival_df = arrival_df[['agency','date','route_id',
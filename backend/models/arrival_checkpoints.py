@@ -0,0 +1,555 @@
+import os
+import re
+import json
+import hashlib
+from datetime import date
+import numpy as np
+import pandas as pd
+from . import arrival_history, columnar, config, eclipses, routeconfig, util
+
+# Checkpoints allow compute_arrivals.py to find arrivals incrementally when it is run
+# multiple times for the same day (e.g. every few hours by compute_new.py), instead of
+# reprocessing all GPS observations since the start of the day each time.
+# The arrivals are identical to calling eclipses.find_arrivals with all GPS observations.
+#
+# The checkpoint contains all arrivals found so far (including the OBS_GROUP column which
+# is not saved in the arrival history), and the following state for each vehicle:
+#
+#   NUM_OBS, LAST_TIME: number of GPS observations processed and time of the last one.
+#       Vehicles without new observations are not processed again.
+#
+#   LAST_OBS_GROUP, TAIL_START_TIME: observation group of the last GPS observation processed,
+#       and time of the first observation in that group. Arrivals in earlier observation groups
+#       are never affected by new observations (see eclipses.resample_bus).
+#
+#   RESUME_TIME: time of a GPS observation in the last observation group where processing can resume
+#       (or -1 to process the whole observation group again), chosen so that every eclipse
+#       (consecutive observations near a stop) that started at or before the resume time has already ended.
+#       Possible arrivals for these eclipses are saved in the checkpoint, since they can't be computed
+#       from the observations after the resume time.
+#
+# For each direction, the checkpoint also saves the point where get_arrivals_with_ascending_stop_index
+# can resume in the last observation group. After it finishes a trip, it processes the remaining
+# possible arrivals without any state from previous trips. If the possible arrivals used to decide to finish
+# the trip can't change when there are new observations, the trips before that point are final,
+# and the next run only needs the possible arrivals after the time of the last row before that point (PREV_TIME),
+# and the last arrival found before that point (PREV_STOP_INDEX, PREV_DEPARTURE_TIME),
+# which is used by add_missing_arrivals_for_vehicle_direction.
+
+Version = 'v1'
+
+vehicle_columns = ['VID', 'NUM_OBS', 'LAST_TIME', 'LAST_OBS_GROUP', 'TAIL_START_TIME', 'RESUME_TIME']
+
+resume_point_columns = ['VID', 'DID', 'PREV_TIME', 'PREV_STOP_INDEX', 'PREV_DEPARTURE_TIME']
+
+possible_arrival_columns = eclipses.arrival_columns + eclipses.eclipse_columns
+
+column_dtypes = {
+    'VID': object,
+    'SID': object,
+    'DID': object,
+    'DIST': np.float64,
+}
+
+# add_missing_arrivals_for_vehicle_direction only looks for missing stops
+# when the gap between arrivals is shorter than this
+max_gap_seconds = 360
+
+class ArrivalCheckpoint:
+    def __init__(self, vehicles: dict, resume_points: dict, possible_arrivals: pd.DataFrame, arrivals: pd.DataFrame):
+        self.vehicles = vehicles                    # map of vehicle ID => dict with keys from vehicle_columns
+        self.resume_points = resume_points          # map of vehicle ID => map of direction ID => dict with keys from resume_point_columns
+        self.possible_arrivals = possible_arrivals  # possible arrivals in eclipses that started at or before each vehicle's resume time
+        self.arrivals = arrivals
+
+class DirectionState:
+    # possible arrivals, ascending arrivals and finish points from get_arrivals_with_ascending_stop_index
+    # for the last observation group of a vehicle in one direction
+
+    def __init__(self, possible_arrivals: pd.DataFrame, arrivals: pd.DataFrame, finish_points: list, prev_resume_point: dict):
+        self.possible_arrivals = possible_arrivals
+        self.arrivals = arrivals
+        self.finish_points = finish_points
+        self.prev_resume_point = prev_resume_point
+
+    def get_resume_point(self, vid, did, max_finish_time):
+        # Returns the last point where get_arrivals_with_ascending_stop_index finished a trip
+        # before max_finish_time, or None if there is no such point.
+        time_values = self.possible_arrivals['TIME'].values
+        num_rows = len(time_values)
+
+        for finish_index, next_index in reversed(self.finish_points):
+            if time_values[finish_index] >= max_finish_time:
+                continue
+
+            # possible arrivals are selected by time when resuming, so the rows before and after
+            # the resume point can't have the same time
+            if next_index < num_rows and time_values[next_index - 1] >= time_values[next_index]:
+                continue
+
+            prev_arrivals = self.arrivals[self.arrivals.index.values < next_index]
+            if not prev_arrivals.empty:
+                prev_stop_index = prev_arrivals['STOP_INDEX'].values[-1]
+                prev_departure_time = prev_arrivals['DEPARTURE_TIME'].values[-1]
+            elif self.prev_resume_point is not None:
+                prev_stop_index = self.prev_resume_point['PREV_STOP_INDEX']
+                prev_departure_time = self.prev_resume_point['PREV_DEPARTURE_TIME']
+            else:
+                prev_stop_index = -1
+                prev_departure_time = -1
+
+            return {
+                'VID': vid,
+                'DID': did,
+                'PREV_TIME': time_values[next_index - 1],
+                'PREV_STOP_INDEX': prev_stop_index,
+                'PREV_DEPARTURE_TIME': prev_departure_time,
+            }
+
+        return None
+
+def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config: routeconfig.RouteConfig, d: date,
+        start_time, end_time) -> pd.DataFrame:
+    '''
+    Returns the same arrivals as eclipses.find_arrivals(agency, route_state, route_config, d),
+    only processing GPS observations that were not processed when this function was last called
+    for the same route and time range, and saving a checkpoint for the next call.
+    '''
+    route_id = route_config.id
+
+    cache_path = get_cache_path(agency.id, route_id, d, start_time, end_time)
+    checkpoint_hash = get_checkpoint_hash(agency, route_config)
+
+    checkpoint = load_checkpoint(cache_path, checkpoint_hash)
+    if checkpoint is None:
+        checkpoint = ArrivalCheckpoint({}, {}, make_frame([], possible_arrival_columns), eclipses.make_arrivals_frame([]))
+
+    prev_vehicles = checkpoint.vehicles
+
+    vehicles = {}
+    resume_points = {}
+    saved_possible_arrivals = []
+
+    new_states = {}
+    obs_group_offsets = {}
+    resumed_vehicles = {}   # map of vehicle ID => previous state, for vehicles resuming in the middle of an observation group
+
+    for vid, bus in route_state.groupby(route_state['VID']):
+        time_values = bus['TIME'].values
+        num_obs = len(time_values)
+
+        prev = prev_vehicles.get(vid, None)
+
+        if prev is not None and prev['NUM_OBS'] == num_obs and prev['LAST_TIME'] == time_values[-1]:
+            vehicles[vid] = prev
+            if vid in checkpoint.resume_points:
+                resume_points[vid] = checkpoint.resume_points[vid]
+            continue
+
+        if prev is None or np.count_nonzero(time_values <= prev['LAST_TIME']) != prev['NUM_OBS']:
+            # new vehicle, or observations were added before the last processed observation
+            offset = 0
+            from_time = time_values[0]
+        elif time_values[time_values > prev['LAST_TIME']][0] - prev['LAST_TIME'] > 1800:
+            # new observations start a new observation group
+            offset = prev['LAST_OBS_GROUP']
+            from_time = time_values[time_values > prev['LAST_TIME']][0]
+        else:
+            # new observations continue the last observation group
+            offset = prev['LAST_OBS_GROUP'] - 1
+            if prev['RESUME_TIME'] >= 0:
+                from_time = prev['RESUME_TIME']
+                resumed_vehicles[vid] = prev
+            else:
+                from_time = prev['TAIL_START_TIME']
+
+        new_bus = bus[time_values >= from_time]
+
+        obs_group_start_times = eclipses.get_obs_group_start_times(new_bus)
+
+        if vid in resumed_vehicles and len(obs_group_start_times) == 1:
+            tail_start_time = prev['TAIL_START_TIME']
+        else:
+            tail_start_time = obs_group_start_times[-1]
+
+        vehicles[vid] = {
+            'VID': vid,
+            'NUM_OBS': num_obs,
+            'LAST_TIME': time_values[-1],
+            'LAST_OBS_GROUP': offset + len(obs_group_start_times),
+            'TAIL_START_TIME': tail_start_time,
+            'RESUME_TIME': -1,
+        }
+
+        obs_group_offsets[vid] = offset
+        new_states[vid] = new_bus
+
+    num_new_obs = sum(len(new_bus) for new_bus in new_states.values())
+
+    print(f'{route_id}: processing {num_new_obs} of {len(route_state)} GPS observations for {len(new_states)} of {len(vehicles)} vehicles')
+
+    all_arrivals = [get_kept_arrivals(checkpoint, vehicles, obs_group_offsets, resumed_vehicles)]
+
+    prev_possible_arrivals = checkpoint.possible_arrivals
+    saved_possible_arrivals.append(prev_possible_arrivals[
+        prev_possible_arrivals['VID'].isin([vid for vid in resume_points]).values
+    ])
+
+    if len(new_states) > 0:
+        buses = eclipses.resample_buses(pd.concat(new_states.values()))
+        buses['OBS_GROUP'] += buses['VID'].map(obs_group_offsets).values.astype(np.int64)
+
+        possible_arrivals = get_possible_arrivals(agency, buses, route_config, d, checkpoint, resumed_vehicles)
+
+        buses_map = {vid: bus for vid, bus in buses.groupby('VID')}
+
+        start_trip = max([arrivals['TRIP'].max() for arrivals in all_arrivals if not arrivals.empty], default=-1) + 1
+
+        new_arrivals, direction_states = clean_arrivals(possible_arrivals, buses_map, route_config,
+            checkpoint, vehicles, resumed_vehicles, start_trip)
+
+        all_arrivals.append(new_arrivals)
+
+        possible_arrivals_map = {vid: vehicle_possible_arrivals for vid, vehicle_possible_arrivals in possible_arrivals.groupby('VID')}
+
+        for vid, new_bus in new_states.items():
+            vehicle = vehicles[vid]
+
+            vehicle_possible_arrivals = possible_arrivals_map.get(vid, None)
+            if vehicle_possible_arrivals is None:
+                vehicle_possible_arrivals = make_frame([], possible_arrival_columns)
+            else:
+                vehicle_possible_arrivals = vehicle_possible_arrivals[
+                    vehicle_possible_arrivals['OBS_GROUP'].values == vehicle['LAST_OBS_GROUP']
+                ]
+
+            if vid in resumed_vehicles and resumed_vehicles[vid]['LAST_OBS_GROUP'] == vehicle['LAST_OBS_GROUP']:
+                prev_resume_points = checkpoint.resume_points.get(vid, {})
+            else:
+                prev_resume_points = {}
+
+            vehicle_resume_points, vehicle_saved_possible_arrivals = update_resume_state(
+                vehicle, new_bus, buses_map[vid], vehicle_possible_arrivals,
+                direction_states, prev_resume_points, route_config
+            )
+
+            if len(vehicle_resume_points) > 0:
+                resume_points[vid] = vehicle_resume_points
+            saved_possible_arrivals.append(vehicle_saved_possible_arrivals)
+
+    all_arrivals = [arrivals for arrivals in all_arrivals if not arrivals.empty]
+
+    if len(all_arrivals) > 0:
+        arrivals = renumber_trips(pd.concat(all_arrivals, ignore_index=True)[eclipses.arrival_columns])
+    else:
+        arrivals = eclipses.make_arrivals_frame([])
+
+    save_checkpoint(cache_path, checkpoint_hash, ArrivalCheckpoint(
+        vehicles,
+        resume_points,
+        concat_frames(saved_possible_arrivals, possible_arrival_columns),
+        arrivals
+    ))
+
+    return arrivals
+
+def get_kept_arrivals(checkpoint: ArrivalCheckpoint, vehicles: dict, obs_group_offsets: dict, resumed_vehicles: dict) -> pd.DataFrame:
+    # Returns the arrivals from the checkpoint that will not be replaced by arrivals from processing new observations.
+    arrivals = checkpoint.arrivals
+    if arrivals.empty:
+        return arrivals
+
+    max_obs_group = np.iinfo(np.int64).max
+
+    # arrivals in observation groups after obs_group_offsets[vid] will be replaced,
+    # and arrivals for vehicles that no longer have any observations are removed
+    min_replaced_obs_group_values = np.array([
+        (obs_group_offsets[vid] + 1 if vid in obs_group_offsets else max_obs_group) if vid in vehicles else 0
+        for vid in arrivals['VID'].values
+    ], dtype=np.int64)
+
+    keep_values = arrivals['OBS_GROUP'].values < min_replaced_obs_group_values
+
+    # when resuming in the middle of an observation group, trips that finished before the resume point
+    # in each direction are kept
+    resume_point_times = {
+        (vid, did): resume_point['PREV_TIME']
+        for vid in resumed_vehicles
+        for did, resume_point in checkpoint.resume_points.get(vid, {}).items()
+    }
+    if len(resume_point_times) > 0:
+        prev_time_values = np.array([
+            resume_point_times.get((vid, did), -1)
+            for vid, did in zip(arrivals['VID'].values, arrivals['DID'].values)
+        ], dtype=np.int64)
+
+        keep_values |= (arrivals['TIME'].values <= prev_time_values) & \
+            (arrivals['OBS_GROUP'].values == min_replaced_obs_group_values)
+
+    return arrivals[keep_values]
+
+def get_possible_arrivals(agency: config.Agency, buses: pd.DataFrame, route_config: routeconfig.RouteConfig, d: date,
+        checkpoint: ArrivalCheckpoint, resumed_vehicles: dict) -> pd.DataFrame:
+
+    possible_arrivals = eclipses.get_possible_arrivals(agency, buses, route_config, d, include_eclipse_times=True)
+
+    if len(resumed_vehicles) > 0:
+        # the first observation processed for resumed vehicles may be in the middle of an eclipse.
+        # eclipses that started at or before the resume time are saved in the checkpoint instead.
+        resume_time_values = possible_arrivals['VID'].map({
+            vid: prev['RESUME_TIME'] for vid, prev in resumed_vehicles.items()
+        }).values
+
+        possible_arrivals = possible_arrivals[possible_arrivals['ECLIPSE_START'].values != resume_time_values]
+
+        prev_possible_arrivals = checkpoint.possible_arrivals
+        prev_possible_arrivals = prev_possible_arrivals[prev_possible_arrivals['VID'].isin(list(resumed_vehicles.keys())).values]
+
+        possible_arrivals = concat_frames([prev_possible_arrivals, possible_arrivals], possible_arrival_columns)
+
+    # eclipses.clean_arrivals uses a stable sort by time, so possible arrivals for each vehicle and direction
+    # with the same time are ordered by stop index, then by the order of the eclipses
+    # (saved possible arrivals are always before new possible arrivals for the same stop).
+    sort_order = np.lexsort((
+        np.arange(len(possible_arrivals)),
+        possible_arrivals['STOP_INDEX'].values,
+        possible_arrivals['TIME'].values
+    ))
+
+    return possible_arrivals.iloc[sort_order].reset_index(drop=True)
+
+def clean_arrivals(possible_arrivals: pd.DataFrame, buses_map: dict, route_config: routeconfig.RouteConfig,
+        checkpoint: ArrivalCheckpoint, vehicles: dict, resumed_vehicles: dict, start_trip: int):
+    # Like eclipses.clean_arrivals, but resumes get_arrivals_with_ascending_stop_index from the saved resume points,
+    # and returns a tuple (arrivals, direction_states) where direction_states is a map of (vehicle ID, direction ID)
+    # => DirectionState for each vehicle's last observation group.
+
+    all_arrivals = []
+    direction_states = {}
+
+    for (vid, did, obs_group), dir_possible_arrivals in possible_arrivals.groupby(['VID', 'DID', 'OBS_GROUP']):
+        dir_info = route_config.get_direction_info(did)
+
+        resume_point = None
+        if vid in resumed_vehicles and obs_group == resumed_vehicles[vid]['LAST_OBS_GROUP']:
+            resume_point = checkpoint.resume_points.get(vid, {}).get(did, None)
+
+        if resume_point is not None:
+            dir_possible_arrivals = dir_possible_arrivals[dir_possible_arrivals['TIME'].values > resume_point['PREV_TIME']]
+
+        dir_possible_arrivals = dir_possible_arrivals.reset_index(drop=True)
+
+        finish_points = []
+
+        dir_arrivals, start_trip = eclipses.get_arrivals_with_ascending_stop_index(
+            dir_possible_arrivals, dir_info, start_trip, finish_points=finish_points
+        )
+
+        if obs_group == vehicles[vid]['LAST_OBS_GROUP']:
+            direction_states[(vid, did)] = DirectionState(dir_possible_arrivals, dir_arrivals, finish_points, resume_point)
+
+        all_arrivals.append(add_missing_arrivals(dir_arrivals[eclipses.arrival_columns], vid, did, buses_map[vid],
+            route_config, resume_point))
+
+    return concat_frames(all_arrivals, eclipses.arrival_columns), direction_states
+
+def add_missing_arrivals(dir_arrivals: pd.DataFrame, vid, did, bus: pd.DataFrame, route_config: routeconfig.RouteConfig,
+        resume_point: dict) -> pd.DataFrame:
+
+    if resume_point is None or resume_point['PREV_STOP_INDEX'] < 0 or dir_arrivals.empty:
+        return eclipses.add_missing_arrivals_for_vehicle_direction(dir_arrivals, vid, did, bus, route_config)
+
+    # add the last arrival before the resume point (with TRIP=-1), so that it is possible to find
+    # missing stops between that arrival and the first new arrival
+    prev_departure_time = resume_point['PREV_DEPARTURE_TIME']
+    prev_arrival = eclipses.make_arrivals_frame([(
+        vid, prev_departure_time, prev_departure_time, 0.0, None, did, resume_point['PREV_STOP_INDEX'], -1, -1
+    )])
+
+    dir_arrivals = eclipses.add_missing_arrivals_for_vehicle_direction(
+        pd.concat([prev_arrival, dir_arrivals], ignore_index=True), vid, did, bus, route_config
+    )
+
+    return dir_arrivals[dir_arrivals['TRIP'].values != -1]
+
+def update_resume_state(vehicle: dict, new_bus: pd.DataFrame, bus: pd.DataFrame, possible_arrivals: pd.DataFrame,
+        direction_states: dict, prev_resume_points: dict, route_config: routeconfig.RouteConfig):
+    # Sets vehicle['RESUME_TIME'] and returns a tuple (resume_points, possible_arrivals) containing the
+    # resume points and possible arrivals to save in the checkpoint for this vehicle.
+
+    vid = vehicle['VID']
+
+    time_values = bus['TIME'].values
+    last_time = time_values[-1]
+
+    # eclipses that include the last observation may continue when there are new observations
+    open_eclipse_start_values = possible_arrivals['ECLIPSE_START'].values[possible_arrivals['ECLIPSE_END'].values == last_time]
+    open_eclipse_start_time = np.min(open_eclipse_start_values) if len(open_eclipse_start_values) > 0 else last_time
+
+    # possible arrivals from eclipses that haven't started yet will have times after the last observation
+    max_finish_time = min(open_eclipse_start_time, last_time)
+
+    max_resume_time = open_eclipse_start_time - 1
+
+    resume_points = {}
+
+    for dir_info in route_config.get_direction_infos():
+        did = dir_info.id
+
+        resume_point = prev_resume_points.get(did, None)
+
+        direction_state = direction_states.get((vid, did), None)
+        if direction_state is not None:
+            new_resume_point = direction_state.get_resume_point(vid, did, max_finish_time)
+            if new_resume_point is not None:
+                resume_point = new_resume_point
+
+        if resume_point is not None:
+            resume_points[did] = resume_point
+
+            # observations after the last arrival before the resume point may be needed to find missing stops
+            prev_time = resume_point['PREV_TIME']
+            if resume_point['PREV_STOP_INDEX'] >= 0:
+                max_resume_time = min(max_resume_time, prev_time, max(resume_point['PREV_DEPARTURE_TIME'], prev_time - max_gap_seconds))
+            else:
+                max_resume_time = min(max_resume_time, prev_time)
+        else:
+            dir_time_values = possible_arrivals['TIME'].values[possible_arrivals['DID'].values == did]
+            if len(dir_time_values) > 0:
+                max_resume_time = min(max_resume_time, np.min(dir_time_values))
+
+    # Find the last observation before max_resume_time (excluding duplicate observations removed by resample_bus)
+    # that is the only resampled observation at that time, so it is possible to tell which eclipses started
+    # at or before the resume time.
+    new_time_values = new_bus['TIME'].values
+    new_time_values = new_time_values[np.diff(new_time_values, prepend=0) > 2]
+
+    resume_time_values = new_time_values[(new_time_values <= max_resume_time) & (new_time_values > vehicle['TAIL_START_TIME'])]
+    resume_time_values = resume_time_values[
+        np.searchsorted(time_values, resume_time_values, side='right') - np.searchsorted(time_values, resume_time_values, side='left') == 1
+    ]
+
+    if len(resume_time_values) == 0:
+        return {}, make_frame([], possible_arrival_columns)
+
+    resume_time = resume_time_values[-1]
+    vehicle['RESUME_TIME'] = resume_time
+
+    prev_time_values = np.array([
+        resume_points[did]['PREV_TIME'] if did in resume_points else -1
+        for did in possible_arrivals['DID'].values
+    ], dtype=np.int64)
+
+    saved_possible_arrivals = possible_arrivals[
+        (possible_arrivals['ECLIPSE_START'].values <= resume_time) & (possible_arrivals['TIME'].values > prev_time_values)
+    ]
+
+    return resume_points, saved_possible_arrivals
+
+def renumber_trips(arrivals: pd.DataFrame) -> pd.DataFrame:
+    # eclipses.clean_arrivals numbers trips consecutively in order of (VID, DID, OBS_GROUP),
+    # so arrivals from previous runs need to be renumbered after merging them with new arrivals.
+    trip_keys = ['VID', 'DID', 'OBS_GROUP', 'TRIP']
+
+    arrivals = arrivals.sort_values(trip_keys, kind='mergesort')
+
+    new_trip_values = np.zeros(len(arrivals), dtype=bool)
+    new_trip_values[0] = True
+    for key in trip_keys:
+        values = arrivals[key].values
+        new_trip_values[1:] |= (values[1:] != values[:-1])
+
+    arrivals['TRIP'] = np.cumsum(new_trip_values) - 1
+
+    return arrivals.sort_values(['TIME', 'VID', 'DID', 'TRIP', 'STOP_INDEX'], kind='mergesort').reset_index(drop=True)
+
+def make_frame(rows: list, columns: list) -> pd.DataFrame:
+    return pd.DataFrame(rows, columns=columns)
+
+def concat_frames(frames: list, columns: list) -> pd.DataFrame:
+    # concatenates non-empty data frames, so that empty data frames don't change the dtype of any columns
+    frames = [frame[columns] for frame in frames if not frame.empty]
+    if len(frames) == 0:
+        return make_frame([], columns)
+    return pd.concat(frames, ignore_index=True)
+
+def get_checkpoint_hash(agency: config.Agency, route_config: routeconfig.RouteConfig) -> str:
+    # checkpoints are ignored if anything else that affects the arrivals has changed
+    data_str = json.dumps({
+        'version': Version,
+        'arrivals_version': arrival_history.DefaultVersion,
+        'route': route_config.data,
+        'invalid_direction_times': agency.invalid_direction_times,
+        'js_properties': agency.js_properties,
+    }, sort_keys=True, default=str)
+
+    return hashlib.sha1(data_str.encode('utf-8')).hexdigest()
+
+def load_checkpoint(cache_path: str, checkpoint_hash: str) -> ArrivalCheckpoint:
+    try:
+        table = columnar.read_table(cache_path, use_mmap=False)
+    except FileNotFoundError:
+        return None
+
+    if table.meta.get('hash') != checkpoint_hash:
+        print(f'ignoring outdated arrival checkpoint {cache_path}')
+        return None
+
+    def get_data_frame(name, columns):
+        return pd.DataFrame({
+            column: table.get_values(f'{name}.{column}') for column in columns
+        }, columns=columns)
+
+    vehicles = {
+        vehicle['VID']: vehicle
+        for vehicle in get_data_frame('vehicles', vehicle_columns).to_dict('records')
+    }
+
+    resume_points = {}
+    for resume_point in get_data_frame('resume_points', resume_point_columns).to_dict('records'):
+        resume_points.setdefault(resume_point['VID'], {})[resume_point['DID']] = resume_point
+
+    return ArrivalCheckpoint(
+        vehicles,
+        resume_points,
+        get_data_frame('possible_arrivals', possible_arrival_columns),
+        get_data_frame('arrivals', eclipses.arrival_columns),
+    )
+
+def save_checkpoint(cache_path: str, checkpoint_hash: str, checkpoint: ArrivalCheckpoint):
+    columns = {}
+
+    def add_columns(name, rows: list, column_names):
+        for column in column_names:
+            columns[f'{name}.{column}'] = np.array([row[column] for row in rows], dtype=column_dtypes.get(column, np.int64))
+
+    def add_data_frame_columns(name, df: pd.DataFrame, column_names):
+        for column in column_names:
+            columns[f'{name}.{column}'] = df[column].values.astype(column_dtypes.get(column, np.int64))
+
+    add_columns('vehicles', list(checkpoint.vehicles.values()), vehicle_columns)
+    add_columns('resume_points', [
+        resume_point
+        for vehicle_resume_points in checkpoint.resume_points.values()
+        for resume_point in vehicle_resume_points.values()
+    ], resume_point_columns)
+    add_data_frame_columns('possible_arrivals', checkpoint.possible_arrivals, possible_arrival_columns)
+    add_data_frame_columns('arrivals', checkpoint.arrivals, eclipses.arrival_columns)
+
+    cache_dir = os.path.dirname(cache_path)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    columnar.write_table(cache_path, columns, meta={'hash': checkpoint_hash})
+
+def get_cache_path(agency_id: str, route_id: str, d: date, start_time, end_time) -> str:
+    date_str = str(d)
+
+    if re.match('^[\w\-]+$', agency_id) is None:
+        raise Exception(f"Invalid agency id: {agency_id}")
+
+    if re.match('^[\w\-]+$', route_id) is None:
+        raise Exception(f"Invalid route id: {route_id}")
+
+    return os.path.join(util.get_data_dir(),
+        f"arrival_checkpoints_{Version}_{agency_id}/{date_str}/arrival_checkpoint_{Version}_{agency_id}_{route_id}_{int(start_time)}_{int(end_time)}.cols")
@@ -1,11 +1,10 @@
-from datetime import date
+from datetime import date, datetime, timedelta
 import time
 import re
 import os
 import json
-import requests
 import pandas as pd
-from . import util, config
+from . import util, config, instrumentation, columnar, cache
 import boto3
 from pathlib import Path
 import gzip
@@ -14,16 +13,274 @@ import numpy as np
 
 DefaultVersion = 'v4c'
 
+arrival_columns = ["VID", "TIME", "DEPARTURE_TIME", "SID", "DID", "DIST", "TRIP"]
+
+def get_json_values(values: np.ndarray) -> list:
+    # returns a list of strings with each value in the same format as json.dumps
+    if values.dtype.kind in ('i', 'u'):
+        return list(map(str, values.tolist()))
+    if values.dtype.kind == 'f' and np.isfinite(values).all():
+        return list(map(float.__repr__, values.tolist()))
+    return list(map(json.dumps, values.tolist()))
+
+def get_json_key(key) -> str:
+    # json.dumps converts dict keys that are not strings (e.g. numbers) to strings
+    return json.dumps(key if isinstance(key, str) else json.dumps(key))
+
+class ArrivalColumns:
+    '''
+    Arrivals for one route stored as parallel numpy arrays, ordered by stop and direction (in the same order as stops_data),
+    then by time, with the offsets of the first arrival for each (stop, direction) pair.
+
+    The arrivals for a stop (and direction) can be selected with slices of the arrays, and time ranges can be selected
+    with a binary search, without creating Python objects for each arrival.
+    '''
+    def __init__(self, group_keys, group_offsets, time_values, departure_time_values, dist_values,
+            vid_codes, vid_dictionary, trip_values):
+        self.group_keys = group_keys          # list of (stop_id, direction_id) tuples
+        self.group_offsets = group_offsets    # arrivals for group_keys[i] are in rows group_offsets[i]:group_offsets[i+1]
+        self.time_values = time_values
+        self.departure_time_values = departure_time_values
+        self.dist_values = dist_values
+        self.vid_codes = vid_codes            # int32 indexes into vid_dictionary
+        self.vid_dictionary = vid_dictionary  # numpy object array of distinct vehicle IDs
+        self.trip_values = trip_values
+
+        self.group_indexes_by_stop = {}
+        self.group_indexes_by_key = {}
+        for group_index, (stop_id, direction_id) in enumerate(group_keys):
+            self.group_indexes_by_stop.setdefault(stop_id, []).append(group_index)
+            self.group_indexes_by_key[(stop_id, direction_id)] = group_index
+
+        # vehicle IDs may be strings or ints, which can't be compared with a binary search
+        self.vid_codes_by_vid = {vid: vid_code for vid_code, vid in enumerate(vid_dictionary.tolist())}
+
+    def __len__(self):
+        return len(self.time_values)
+
+    @classmethod
+    def from_stops_data(cls, stops_data, has_dist=True, has_departure_time=True, has_trip=True):
+        group_keys = []
+        group_offsets = [0]
+        arrivals = []
+
+        for stop_id, stop_info in stops_data.items():
+            for direction_id, dir_arrivals in stop_info['arrivals'].items():
+                group_keys.append((stop_id, direction_id))
+                # arrivals are normally saved in time order already
+                arrivals.extend(sorted(dir_arrivals, key=lambda arrival: arrival['t']))
+                group_offsets.append(len(arrivals))
+
+        time_values = np.array([arrival['t'] for arrival in arrivals], dtype=np.int64)
+
+        def get_values(key, default_values):
+            if len(arrivals) == 0:
+                return default_values
+            values = np.array([arrival[key] for arrival in arrivals])
+            # arrays of Python objects (e.g. with None values) can't be stored in columnar files
+            return values.astype(np.float64) if values.dtype.kind == 'O' else values
+
+        vid_codes, vid_dictionary = columnar.encode_values(np.array([arrival['v'] for arrival in arrivals], dtype=object))
+
+        return cls(
+            group_keys,
+            np.array(group_offsets, dtype=np.int64),
+            time_values,
+            get_values('e', time_values) if has_departure_time else time_values,
+            get_values('d', np.zeros(0, dtype=np.int64)) if has_dist else np.full(len(arrivals), np.nan),
+            vid_codes.astype(np.int32),
+            vid_dictionary,
+            get_values('i', np.zeros(0, dtype=np.int64)) if has_trip else np.full(len(arrivals), -1, dtype=np.int64),
+        )
+
+    @classmethod
+    def from_data_frame(cls, arrivals: pd.DataFrame):
+        # arrivals are grouped by SID, then DID (in sorted order, like DataFrame.groupby), then sorted by time
+        if arrivals.empty:
+            return cls([], np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=object), np.zeros(0, dtype=np.int64))
+
+        arrivals = arrivals.sort_values('TIME')
+
+        sid_codes, sid_values = pd.factorize(arrivals['SID'].values, sort=True)
+        did_codes, did_values = pd.factorize(arrivals['DID'].values, sort=True)
+
+        # stable sort keeps arrivals in time order within each group
+        order = np.lexsort((did_codes, sid_codes))
+        sid_codes = sid_codes[order]
+        did_codes = did_codes[order]
+
+        is_group_start = np.r_[True, (sid_codes[1:] != sid_codes[:-1]) | (did_codes[1:] != did_codes[:-1])]
+        group_start_indexes = np.nonzero(is_group_start)[0]
+
+        group_keys = list(zip(
+            np.asarray(sid_values, dtype=object)[sid_codes[group_start_indexes]].tolist(),
+            np.asarray(did_values, dtype=object)[did_codes[group_start_indexes]].tolist(),
+        ))
+
+        vid_codes, vid_dictionary = columnar.encode_values(arrivals['VID'].values[order].astype(object))
+
+        return cls(
+            group_keys,
+            np.append(group_start_indexes, len(order)).astype(np.int64),
+            arrivals['TIME'].values[order],
+            arrivals['DEPARTURE_TIME'].values[order],
+            # distances are saved as integers
+            np.round(arrivals['DIST'].values[order]).astype(np.int64),
+            vid_codes,
+            vid_dictionary,
+            arrivals['TRIP'].values[order],
+        )
+
+    def get_stops_data(self) -> dict:
+        stops_data = {}
+
+        vid_values = self.vid_dictionary[self.vid_codes]
+
+        for group_index, (stop_id, direction_id) in enumerate(self.group_keys):
+            start_index = self.group_offsets[group_index]
+            end_index = self.group_offsets[group_index + 1]
+
+            stops_data.setdefault(stop_id, {'arrivals': {}})['arrivals'][direction_id] = [
+                {'t': t, 'e': e, 'd': dist, 'v': v, 'i': trip}
+                for t, e, dist, v, trip in zip(
+                    self.time_values[start_index:end_index].tolist(),
+                    self.departure_time_values[start_index:end_index].tolist(),
+                    self.dist_values[start_index:end_index].tolist(),
+                    vid_values[start_index:end_index].tolist(),
+                    self.trip_values[start_index:end_index].tolist(),
+                )
+            ]
+
+        return stops_data
+
+    def get_stops_json(self) -> str:
+        # returns the same string as json.dumps(self.get_stops_data()), without creating a dict for each arrival
+        vid_strs = [json.dumps(vid) for vid in self.vid_dictionary.tolist()]
+
+        arrival_strs = [
+            f'{{"t": {t}, "e": {e}, "d": {dist}, "v": {vid_strs[vid_code]}, "i": {trip}}}'
+            for t, e, dist, vid_code, trip in zip(
+                get_json_values(self.time_values),
+                get_json_values(self.departure_time_values),
+                get_json_values(self.dist_values),
+                self.vid_codes.tolist(),
+                get_json_values(self.trip_values),
+            )
+        ]
+
+        stop_strs = []
+        direction_strs = []
+        for group_index, (stop_id, direction_id) in enumerate(self.group_keys):
+            start_index = self.group_offsets[group_index]
+            end_index = self.group_offsets[group_index + 1]
+
+            direction_strs.append(f'{get_json_key(direction_id)}: [{", ".join(arrival_strs[start_index:end_index])}]')
+
+            if group_index + 1 == len(self.group_keys) or self.group_keys[group_index + 1][0] != stop_id:
+                stop_strs.append(f'{get_json_key(stop_id)}: {{"arrivals": {{{", ".join(direction_strs)}}}}}')
+                direction_strs = []
+
+        return f'{{{", ".join(stop_strs)}}}'
+
+    def get_data_frame(self, direction_id = None, stop_id = None, vehicle_id = None,
+            start_time = None, end_time = None) -> pd.DataFrame:
+        # see ArrivalHistory.get_data_frame
+
+        if vehicle_id is not None and vehicle_id not in self.vid_codes_by_vid:
+            return pd.DataFrame(data = [], columns = arrival_columns)
+
+        if stop_id is not None and direction_id is not None:
+            key = (stop_id, direction_id)
+            group_indexes = [self.group_indexes_by_key[key]] if key in self.group_indexes_by_key else []
+        elif stop_id is not None:
+            group_indexes = self.group_indexes_by_stop.get(stop_id, [])
+        elif direction_id is not None:
+            group_indexes = [group_index for group_index, key in enumerate(self.group_keys) if key[1] == direction_id]
+        else:
+            group_indexes = range(len(self.group_keys))
+
+        # find the range of rows for each group within the time range
+        start_indexes = []
+        end_indexes = []
+        for group_index in group_indexes:
+            start_index = self.group_offsets[group_index]
+            end_index = self.group_offsets[group_index + 1]
+            if start_time is not None or end_time is not None:
+                group_time_values = self.time_values[start_index:end_index]
+                if end_time is not None:
+                    end_index = start_index + np.searchsorted(group_time_values, end_time, side='left')
+                if start_time is not None:
+                    start_index = start_index + np.searchsorted(group_time_values, start_time, side='left')
+            start_indexes.append(start_index)
+            end_indexes.append(max(start_index, end_index))
+
+        group_lengths = np.array(end_indexes, dtype=np.int64) - np.array(start_indexes, dtype=np.int64)
+
+        if len(group_indexes) == 1:
+            rows = slice(start_indexes[0], end_indexes[0])
+        else:
+            rows = np.concatenate([np.arange(start_index, end_index) for start_index, end_index in zip(start_indexes, end_indexes)]) \
+                if len(group_indexes) > 0 else np.zeros(0, dtype=np.int64)
+
+        vid_codes = self.vid_codes[rows]
+
+        is_vehicle = (vid_codes == self.vid_codes_by_vid[vehicle_id]) if vehicle_id is not None else None
+
+        def get_values(values):
+            values = values[rows]
+            return values[is_vehicle] if is_vehicle is not None else values
+
+        def get_group_values(key_index):
+            values = np.repeat(np.array([self.group_keys[group_index][key_index] for group_index in group_indexes], dtype=object), group_lengths)
+            return values[is_vehicle] if is_vehicle is not None else values
+
+        time_values = get_values(self.time_values)
+
+        if len(time_values) == 0:
+            return pd.DataFrame(data = [], columns = arrival_columns)
+
+        return pd.DataFrame({
+            "VID": self.vid_dictionary[vid_codes[is_vehicle] if is_vehicle is not None else vid_codes],
+            "TIME": time_values,
+            "DEPARTURE_TIME": get_values(self.departure_time_values),
+            "SID": get_group_values(0),
+            "DID": get_group_values(1),
+            "DIST": get_values(self.dist_values),
+            "TRIP": get_values(self.trip_values),
+        }, columns = arrival_columns)
+
 class ArrivalHistory:
-    def __init__(self, agency_id: str, route_id, stops_data, start_time = None, end_time = None, version = DefaultVersion):
+    def __init__(self, agency_id: str, route_id, stops_data = None, start_time = None, end_time = None, version = DefaultVersion,
+            columns: ArrivalColumns = None):
         self.agency_id = agency_id
         self.route_id = route_id
         self.start_time = start_time
         self.end_time = end_time
-        self.stops_data = stops_data
+        self._stops_data = stops_data
+        self.columns = columns
         self.version = version
 
-    
+    @property
+    def stops_data(self):
+        # histories loaded from columnar files only create the nested dicts of arrivals if needed (e.g. to export JSON)
+        if self._stops_data is None:
+            self._stops_data = self.columns.get_stops_data() if self.columns is not None else {}
+        return self._stops_data
+
+    def get_columns(self) -> ArrivalColumns:
+        # arrivals are converted from stops_data to numpy arrays the first time they are needed,
+        # so that selecting arrivals for each stop/direction/time range doesn't need to loop over all arrivals
+        if self.columns is None:
+            has_dist = has_departure_time = bool(self.version and self.version[1] >= '3')
+            has_trip = bool(self.version and self.version[1] >= '4')
+            self.columns = ArrivalColumns.from_stops_data(self.stops_data, has_dist, has_departure_time, has_trip)
+        return self.columns
+
+    def is_memory_mapped(self) -> bool:
+        # True if the arrivals are views of a memory-mapped columnar file shared with other processes
+        return self.columns is not None and columnar.is_memory_mapped(self.columns.time_values)
+
     def get_data_frame(self, direction_id = None, stop_id = None, vehicle_id = None,
             start_time = None, end_time = None) -> pd.DataFrame:
         '''
@@ -35,67 +292,21 @@ class ArrivalHistory:
             end_time (unix timestamp)
 
         '''
-        stops = self.stops_data
-        data = []
-
-        has_dist = has_departure_time = self.version and self.version[1] >= '3'
-        has_trip = self.version and self.version[1] >= '4'
-
-        columns = ("VID", "TIME", "DEPARTURE_TIME", "SID", "DID", "DIST", "TRIP")
-
-        def add_stop(s):
-            stop_info = stops[s]
-            for did, arrivals in stop_info['arrivals'].items():
-                if direction_id is not None and did != direction_id:
-                    continue
-
-                for arrival in arrivals:
-                    v = arrival['v']
-                    if vehicle_id is not None and v != vehicle_id:
-                        continue
-
-                    timestamp = arrival['t']
-
-                    if start_time is not None and timestamp < start_time:
-                        continue
-                    if end_time is not None and timestamp >= end_time:
-                        break # arrivals for each stop+direction are in timestamp order, so can stop here
+        return self.get_columns().get_data_frame(direction_id=direction_id, stop_id=stop_id, vehicle_id=vehicle_id,
+            start_time=start_time, end_time=end_time)
 
-                    departure_time = arrival['e'] if has_departure_time else timestamp
-                    dist = arrival['d'] if has_dist else np.nan
-
-                    trip = arrival['i'] if has_trip else -1
-
-                    data.append((v, timestamp, departure_time, s, did, dist, trip))
-
-        if stop_id is not None:
-            if stop_id in stops:
-                add_stop(stop_id)
-        else:
-            for s in stops:
-                add_stop(s)
-
-        return pd.DataFrame(data = data, columns = columns)
-        
-    
     def find_closest_arrival_time(self, stop_id, vehicle_id, time):
+        if stop_id is None:
+            return None
 
-        closest_time = None
-        closest_time_diff = None
+        df = self.get_data_frame(stop_id=stop_id, vehicle_id=vehicle_id)
 
-        if stop_id in self.stops_data:
-            for direction_id, arrivals in self.stops_data[stop_id]['arrivals'].items():
-                for arrival in arrivals:
-                    if (vehicle_id == arrival['v'] or vehicle_id is None):
-                        arrival_time = arrival['t']
-                        time_diff = abs(arrival_time - time)
-                        if (closest_time is None) or (time_diff < closest_time_diff):
-                            closest_time = arrival_time
-                            closest_time_diff = time_diff
+        if df.empty:
+            return None
 
-        return closest_time
+        arrival_time_values = df['TIME'].values
+        return arrival_time_values[np.argmin(np.abs(arrival_time_values - time))].item()
 
-    
     @classmethod
     def from_data(cls, data):
         return cls(
@@ -118,36 +329,32 @@ class ArrivalHistory:
             'stops': self.stops_data,
         }
 
+    def to_json(self) -> str:
+        # returns the same string as json.dumps(self.get_data()).
+        # histories created from data frames or columnar files are serialized directly from the numpy arrays.
+        if self._stops_data is not None or self.columns is None:
+            return json.dumps(self.get_data())
+
+        data_str = json.dumps({
+            'version': self.version,
+            'agency': self.agency_id,
+            'route_id': self.route_id,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+        })
+        return f'{data_str[:-1]}, "stops": {self.columns.get_stops_json()}}}'
+
 
 def from_data_frame(agency_id: str, route_id, arrivals_df: pd.DataFrame, start_time, end_time) -> ArrivalHistory:
     # note: arrival_history module uses timestamps in seconds, but tryn-api uses ms
-    return ArrivalHistory(agency_id, route_id, stops_data=make_stops_data(arrivals_df), start_time=start_time, end_time=end_time)
+    return ArrivalHistory(agency_id, route_id, columns=ArrivalColumns.from_data_frame(arrivals_df), start_time=start_time, end_time=end_time)
 
 
 def make_stops_data(arrivals: pd.DataFrame):
-    stops_data = {}
-
-    if not arrivals.empty:
-        arrivals = arrivals.sort_values('TIME')
-
-        for stop_id, stop_arrivals in arrivals.groupby(arrivals['SID']):
-            stop_directions_data = {}
-
-            for stop_direction_id, stop_direction_arrivals in stop_arrivals.groupby(stop_arrivals['DID']):
-                arrivals_data = []
-
-                for row in stop_direction_arrivals.itertuples():
-                    arrivals_data.append({'t': row.TIME, 'e': row.DEPARTURE_TIME, 'd': round(row.DIST), 'v': row.VID, 'i': row.TRIP})
-
-                stop_directions_data[stop_direction_id] = arrivals_data
-
-            stops_data[stop_id] = {
-                'arrivals': stop_directions_data
-            }
-    return stops_data
+    return ArrivalColumns.from_data_frame(arrivals).get_stops_data()
 
 
-def get_cache_path(agency_id: str, route_id: str, d: date, version = DefaultVersion) -> str:
+def get_cache_path(agency_id: str, route_id: str, d: date, version = DefaultVersion, extension = 'json') -> str:
     if version is None:
         version = DefaultVersion
 
@@ -164,7 +371,7 @@ def get_cache_path(agency_id: str, route_id: str, d: date, version = DefaultVers
     if re.match('^[\w\-]+$', version) is None:
         raise Exception(f"Invalid version: {version}")
 
-    return os.path.join(util.get_data_dir(), f"arrivals_{version}_{agency_id}/{date_str}/arrivals_{version}_{agency_id}_{date_str}_{route_id}.json")
+    return os.path.join(util.get_data_dir(), f"arrivals_{version}_{agency_id}/{date_str}/arrivals_{version}_{agency_id}_{date_str}_{route_id}.{extension}")
 
 
 def get_s3_path(agency_id: str, route_id: str, d: date, version = DefaultVersion) -> str:
@@ -176,9 +383,202 @@ def get_s3_path(agency_id: str, route_id: str, d: date, version = DefaultVersion
     return f"arrivals/{version}/{agency_id}/{date_path}/arrivals_{version}_{agency_id}_{date_str}_{route_id}.json.gz"
 
 
+def get_columns_table(history: ArrivalHistory) -> columnar.ColumnTable:
+    # Returns the arrival history as a columnar table (see columnar.py), with the (stop_id, direction_id) pairs and
+    # the offset of the arrivals for each pair in the metadata.
+    columns = history.get_columns()
+
+    return columnar.ColumnTable({
+            'TIME': columns.time_values,
+            'DEPARTURE_TIME': columns.departure_time_values,
+            'DIST': columns.dist_values,
+            'VID': columns.vid_codes,
+            'TRIP': columns.trip_values,
+        },
+        dictionaries={'VID': columns.vid_dictionary},
+        meta={
+            'version': history.version,
+            'agency': history.agency_id,
+            'route_id': history.route_id,
+            'start_time': history.start_time,
+            'end_time': history.end_time,
+            'groups': [list(key) for key in columns.group_keys],
+            'offsets': columns.group_offsets.tolist(),
+        },
+    )
+
+def from_columns_table(table: columnar.ColumnTable) -> ArrivalHistory:
+    # The arrays are views of the table's buffer (e.g. a memory-mapped file),
+    # so the arrivals are not parsed or copied until they are accessed.
+    meta = table.meta
+
+    columns = ArrivalColumns(
+        [tuple(key) for key in meta['groups']],
+        np.array(meta['offsets'], dtype=np.int64),
+        table.columns['TIME'],
+        table.columns['DEPARTURE_TIME'],
+        table.columns['DIST'],
+        table.columns['VID'],
+        table.dictionaries['VID'],
+        table.columns['TRIP'],
+    )
+
+    return ArrivalHistory(meta['agency'], meta['route_id'],
+        start_time=meta['start_time'],
+        end_time=meta['end_time'],
+        version=meta['version'],
+        columns=columns,
+    )
+
+def write_columns_file(path: str, history: ArrivalHistory):
+    cache_dir = Path(path).parent
+    if not cache_dir.exists():
+        cache_dir.mkdir(parents = True, exist_ok = True)
+
+    table = get_columns_table(history)
+    columnar.write_table(path, table.columns, table.meta, table.dictionaries)
+
+def read_columns_file(path: str) -> ArrivalHistory:
+    return from_columns_table(columnar.read_table(path))
+
+def get_archive_path(agency_id: str, route_id: str, d: date, version = DefaultVersion) -> str:
+    # path of the archive containing the arrival history for a route for every date in the same month as d
+    if version is None:
+        version = DefaultVersion
+
+    month_str = d.strftime('%Y-%m')
+    cache_dir = Path(get_cache_path(agency_id, route_id, d, version)).parent.parent
+
+    return os.path.join(cache_dir, f"archive/{month_str}/arrivals_{version}_{agency_id}_{month_str}_{route_id}.arch")
+
+def write_archive(path: str, histories: dict):
+    # Saves a map of date => ArrivalHistory for one route in a single file (see columnar.write_archive),
+    # with an index of the byte offset of the arrivals for each date.
+    archive_dir = Path(path).parent
+    if not archive_dir.exists():
+        archive_dir.mkdir(parents = True, exist_ok = True)
+
+    tables = {}
+    for d in sorted(histories.keys()):
+        table = get_columns_table(histories[d])
+        tables[str(d)] = columnar.table_to_bytes(table.columns, table.meta, table.dictionaries)
+
+    columnar.write_archive(path, tables)
+
+def get_archive(path: str) -> columnar.TableArchive:
+    # returns the archive at path, or None if it doesn't exist.
+    # Open archives are kept in the shared cache with the mtime of the file, so that loading the arrival history
+    # for multiple dates in the same month only opens and memory-maps the archive once
+    key = ('arrival_archive', path)
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        cache.shared_cache.remove(key)
+        return None
+
+    entry = cache.shared_cache.get(key)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+
+    archive = columnar.read_archive(path)
+    cache.shared_cache.set(key, (mtime, archive))
+    return archive
+
+def read_archive(path: str) -> dict:
+    # returns a map of date => ArrivalHistory for each date in the archive at path
+    archive = get_archive(path)
+    if archive is None:
+        return {}
+
+    return {util.parse_date(date_str): from_columns_table(archive.get_table(date_str)) for date_str in archive.keys()}
+
+def get_from_archive(agency_id: str, route_id: str, d: date, version = DefaultVersion) -> ArrivalHistory:
+    # returns the arrival history from the monthly archive, or None if the archive doesn't contain this date
+    # or the arrival history was saved again as a daily file after the archive was written.
+    # Archives only contain past dates, so unlike the daily files they are used no matter how old they are.
+    archive_path = get_archive_path(agency_id, route_id, d, version)
+    try:
+        archive_mtime = os.stat(archive_path).st_mtime
+    except FileNotFoundError:
+        return None
+
+    archive = get_archive(archive_path)
+    if archive is None or str(d) not in archive:
+        return None
+
+    cache_path = get_cache_path(agency_id, route_id, d, version)
+    if os.path.exists(cache_path) and os.stat(cache_path).st_mtime > archive_mtime:
+        return None
+
+    return from_columns_table(archive.get_table(str(d)))
+
+def compact_archive(agency_id: str, route_id: str, d: date, version = DefaultVersion, remove_daily=False) -> str:
+    # Writes the arrival histories for all dates in the same month as d (from the daily files in the local cache
+    # and the existing archive) to the monthly archive, returning the path of the archive or None if there are no arrivals.
+    # Dates after yesterday are not archived since arrivals may still be computed again for the rest of the day.
+    archive_path = get_archive_path(agency_id, route_id, d, version)
+
+    histories = read_archive(archive_path)
+    daily_dates = []
+
+    # "today" is the current date in the agency's time zone, which may differ from the server's local date
+    today = datetime.now(config.get_agency(agency_id).tz).date()
+
+    month_date = date(d.year, d.month, 1)
+    while month_date.month == d.month and month_date < today:
+        history = get_cached_by_date(agency_id, route_id, month_date, version)
+        if history is not None:
+            histories[month_date] = history
+            daily_dates.append(month_date)
+        month_date += timedelta(days=1)
+
+    if len(histories) == 0:
+        return None
+
+    write_archive(archive_path, histories)
+
+    if remove_daily:
+        for daily_date in daily_dates:
+            for extension in ['json', 'cols']:
+                cache_path = get_cache_path(agency_id, route_id, daily_date, version, extension=extension)
+                if os.path.exists(cache_path):
+                    os.remove(cache_path)
+
+    return archive_path
+
+def get_cached_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion) -> ArrivalHistory:
+    # returns the arrival history from the daily files in the local cache (of any age), or None if not cached
+    cache_path = get_cache_path(agency_id, route_id, d, version)
+    columns_cache_path = get_cache_path(agency_id, route_id, d, version, extension='cols')
+
+    if os.path.exists(columns_cache_path) and \
+            (not os.path.exists(cache_path) or os.stat(cache_path).st_mtime <= os.stat(columns_cache_path).st_mtime):
+        return read_columns_file(columns_cache_path)
+
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            return ArrivalHistory.from_data(json.loads(f.read()))
+
+    return None
+
 def get_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion) -> ArrivalHistory:
 
+    history = get_from_archive(agency_id, route_id, d, version)
+    if history is not None:
+        return history
+
     cache_path = get_cache_path(agency_id, route_id, d, version)
+    columns_cache_path = get_cache_path(agency_id, route_id, d, version, extension='cols')
+
+    # the columnar cache is loaded fastest, but is only used if it is at least as new as the JSON cache
+    try:
+        columns_mtime = os.stat(columns_cache_path).st_mtime
+        now = time.time()
+        if now - columns_mtime < 86400 and (not os.path.exists(cache_path) or os.stat(cache_path).st_mtime <= columns_mtime):
+            return read_columns_file(columns_cache_path)
+    except FileNotFoundError as err:
+        pass
 
     try:
         mtime = os.stat(cache_path).st_mtime
@@ -186,7 +586,11 @@ def get_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion
         if now - mtime < 86400:
             with open(cache_path, "r") as f:
                 text = f.read()
-                return ArrivalHistory.from_data(json.loads(text))
+                history = ArrivalHistory.from_data(json.loads(text))
+            write_columns_file(columns_cache_path, history)
+            # the arrivals are returned from the memory-mapped columnar file instead of the parsed JSON,
+            # so that API server processes loading the same arrival history share the same physical memory
+            return read_columns_file(columns_cache_path)
     except FileNotFoundError as err:
         pass
 
@@ -194,7 +598,7 @@ def get_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion
     s3_path = get_s3_path(agency_id, route_id, d, version)
 
     s3_url = f"http://{s3_bucket}.s3.amazonaws.com/{s3_path}"
-    r = requests.get(s3_url)
+    r = util.get_http_session().get(s3_url)
 
     if r.status_code == 404:
         raise FileNotFoundError(f"{s3_url} not found")
@@ -212,34 +616,42 @@ def get_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion
     with open(cache_path, "w") as f:
         f.write(r.text)
 
-    return ArrivalHistory.from_data(data)
+    history = ArrivalHistory.from_data(data)
+    write_columns_file(columns_cache_path, history)
+    return read_columns_file(columns_cache_path)
 
 
 def save_for_date(history: ArrivalHistory, d: date, s3=False):
-    data_str = json.dumps(history.get_data())
-
-    version = history.version
-    agency_id = history.agency_id
-    route_id = history.route_id
-
-    cache_path = get_cache_path(agency_id, route_id, d, version)
-
-    cache_dir = Path(cache_path).parent
-    if not cache_dir.exists():
-        cache_dir.mkdir(parents = True, exist_ok = True)
-
-    with open(cache_path, "w") as f:
-        f.write(data_str)
-
-    if s3:
-        s3 = boto3.resource('s3')
-        s3_path = get_s3_path(agency_id, route_id, d, version)
-        s3_bucket = config.s3_bucket
-        print(f'saving to s3://{s3_bucket}/{s3_path}')
-        object = s3.Object(s3_bucket, s3_path)
-        object.put(
-            Body=gzip.compress(bytes(data_str, 'utf-8')),
-            ContentType='application/json',
-            ContentEncoding='gzip',
-            ACL='public-read'
-        )
\ No newline at end of file
+    with instrumentation.stage('save_arrival_history', route=history.route_id, date=str(d)):
+        data_str = history.to_json()
+
+        version = history.version
+        agency_id = history.agency_id
+        route_id = history.route_id
+
+        instrumentation.count('arrival_history_bytes', len(data_str), route=route_id, date=str(d))
+
+        cache_path = get_cache_path(agency_id, route_id, d, version)
+
+        cache_dir = Path(cache_path).parent
+        if not cache_dir.exists():
+            cache_dir.mkdir(parents = True, exist_ok = True)
+
+        with open(cache_path, "w") as f:
+            f.write(data_str)
+
+        # JSON is saved for the frontend and other clients; the columnar file is a local cache for loading arrivals faster
+        write_columns_file(get_cache_path(agency_id, route_id, d, version, extension='cols'), history)
+
+        if s3:
+            s3 = boto3.resource('s3')
+            s3_path = get_s3_path(agency_id, route_id, d, version)
+            s3_bucket = config.s3_bucket
+            print(f'saving to s3://{s3_bucket}/{s3_path}')
+            object = s3.Object(s3_bucket, s3_path)
+            object.put(
+                Body=gzip.compress(bytes(data_str, 'utf-8')),
+                ContentType='application/json',
+                ContentEncoding='gzip',
+                ACL='public-read'
+            )
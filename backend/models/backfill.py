@@ -0,0 +1,109 @@
+import json
+import re
+import os
+import threading
+from pathlib import Path
+from concurrent.futures import wait, FIRST_COMPLETED
+from . import util, instrumentation
+
+# Helpers for backfill.py, which computes arrivals and stats for many dates and routes.
+#
+# Each work unit (e.g. computing arrivals for one route on one date) is recorded in a journal file
+# with one JSON object per line after it finishes, so that a backfill can be resumed after it is
+# interrupted without computing the same work units again. Work units are recorded with the version of
+# the data they produce, so changing arrival_history.DefaultVersion or precomputed_stats.DefaultVersion
+# causes all work units to be computed again.
+#
+# backfill.py checks the journal from the thread that downloads state for the next date while the main thread
+# records finished work units, so reading and writing the journal is protected by a lock.
+
+class BackfillJournal:
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.lock = threading.Lock()
+
+        if Path(path).exists():
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line may be incomplete if the process was killed while writing it
+                        continue
+
+                    if record.get('status') == 'done':
+                        self.done.add(get_unit_key(
+                            record['stage'], record['agency'], record['date'], record['version'], record.get('route')
+                        ))
+
+    def is_done(self, stage, agency_id, d, version, route_id=None):
+        key = get_unit_key(stage, agency_id, d, version, route_id)
+        with self.lock:
+            return key in self.done
+
+    def record(self, stage, agency_id, d, version, route_id=None, status='done', **props):
+        record = {
+            'stage': stage,
+            'agency': agency_id,
+            'date': str(d),
+            'route': route_id,
+            'version': version,
+            'status': status,
+            **props
+        }
+
+        cache_dir = Path(self.path).parent
+        if not cache_dir.exists():
+            cache_dir.mkdir(parents = True, exist_ok = True)
+
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            if status == 'done':
+                self.done.add(get_unit_key(stage, agency_id, d, version, route_id))
+
+def get_unit_key(stage, agency_id, d, version, route_id=None):
+    return (stage, agency_id, str(d), version, route_id)
+
+def get_journal_path(agency_id, name='backfill'):
+    if re.match('^[\w\-]+$', agency_id) is None:
+        raise Exception(f"Invalid agency id: {agency_id}")
+    if re.match('^[\w\-]+$', name) is None:
+        raise Exception(f"Invalid journal name: {name}")
+
+    return f'{util.get_data_dir()}/backfill_{agency_id}/{name}.jsonl'
+
+def run_bounded(executor, tasks, max_inflight_bytes):
+    '''
+    Submits tasks to executor (e.g. a ProcessPoolExecutor), where tasks is an iterable of
+    (key, num_bytes, fn, args) tuples, and yields (key, future) tuples as the tasks finish.
+
+    A task is only submitted when the total num_bytes of the tasks that are running or waiting to run
+    is at most max_inflight_bytes (so the tasks don't use too much memory at once), except that
+    one task is always allowed to run even if it is larger than max_inflight_bytes.
+    '''
+    pending = {}
+    inflight_bytes = 0
+
+    def wait_for_tasks():
+        nonlocal inflight_bytes
+        done, _ = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+        for future in done:
+            key, num_bytes = pending.pop(future)
+            inflight_bytes -= num_bytes
+            yield key, future
+
+    for key, num_bytes, fn, args in tasks:
+        while len(pending) > 0 and inflight_bytes + num_bytes > max_inflight_bytes:
+            yield from wait_for_tasks()
+
+        future = instrumentation.submit(executor, fn, *args)
+        pending[future] = (key, num_bytes)
+        inflight_bytes += num_bytes
+
+    while len(pending) > 0:
+        yield from wait_for_tasks()
@@ -0,0 +1,197 @@
+import sys
+import mmap
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+from . import columnar, config
+
+# In-memory cache for objects that are expensive to load (e.g. arrival histories parsed from JSON),
+# which can be shared by all requests in a long-running process such as the API server.
+#
+# The memory used by the cache is limited by estimating the size of each value when it is added (see get_size).
+# When the total size exceeds max_bytes, the least recently used values are removed.
+#
+# Values that contain memory-mapped arrays (e.g. arrival histories loaded from columnar files) don't use much memory
+# of their own, but each memory-mapped file keeps a file descriptor open until the value is garbage collected.
+# If max_mapped_files is set, the least recently used values are also removed when the values in the cache
+# use more than max_mapped_files different memory-mapped files, so the process doesn't run out of file descriptors.
+#
+# Keys are tuples starting with the type of value (e.g. ('headways', agency_id, route_id, date, ...)).
+# The cache counts hits and misses for each type of value, to see which values are reused (see get_stats).
+
+class LRUCache:
+    def __init__(self, max_bytes, max_mapped_files=None):
+        self.max_bytes = max_bytes
+        self.max_mapped_files = max_mapped_files
+        self.total_bytes = 0
+        self.entries = OrderedDict()   # map of key => (value, size, mapped files), from least recently used to most recently used
+        self.mapped_files = {}         # map of id(mmap) => (mmap, number of entries using it)
+        self.hits = {}                 # map of key type => number of times get() found a value
+        self.misses = {}               # map of key type => number of times get() didn't find a value
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        key_type = get_key_type(key)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                self.misses[key_type] = self.misses.get(key_type, 0) + 1
+                return default
+            self.hits[key_type] = self.hits.get(key_type, 0) + 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size=None):
+        # memory-mapped files are only counted if the size is estimated by get_size
+        mapped_files = []
+        if size is None:
+            size = get_size(value, mapped_files=mapped_files)
+
+        with self.lock:
+            self._remove(key)
+
+            self.entries[key] = (value, size, mapped_files)
+            self.total_bytes += size
+
+            for mapped_file in mapped_files:
+                _, num_entries = self.mapped_files.get(id(mapped_file), (mapped_file, 0))
+                self.mapped_files[id(mapped_file)] = (mapped_file, num_entries + 1)
+
+            # the value that was just added is kept even if it is larger than max_bytes
+            while self.is_full() and len(self.entries) > 1:
+                oldest_key = next(iter(self.entries))
+                self._remove(oldest_key)
+
+        return value
+
+    def is_full(self):
+        return self.total_bytes > self.max_bytes or \
+            (self.max_mapped_files is not None and len(self.mapped_files) > self.max_mapped_files)
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def remove_where(self, fn):
+        # removes all entries where fn(key) returns True
+        with self.lock:
+            for key in [key for key in self.entries if fn(key)]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.mapped_files.clear()
+            self.total_bytes = 0
+            self.hits = {}
+            self.misses = {}
+
+    def get_stats(self) -> dict:
+        # returns the number of entries, bytes, hits and misses for each type of key
+        with self.lock:
+            type_stats = {}
+
+            def get_type_stats(key_type):
+                if key_type not in type_stats:
+                    type_stats[key_type] = {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0}
+                return type_stats[key_type]
+
+            for key, (value, size, mapped_files) in self.entries.items():
+                stats = get_type_stats(get_key_type(key))
+                stats['entries'] += 1
+                stats['bytes'] += size
+
+            for key_type, hits in self.hits.items():
+                get_type_stats(key_type)['hits'] = hits
+
+            for key_type, misses in self.misses.items():
+                get_type_stats(key_type)['misses'] = misses
+
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'mapped_files': len(self.mapped_files),
+                'max_mapped_files': self.max_mapped_files,
+                'hits': sum(self.hits.values()),
+                'misses': sum(self.misses.values()),
+                'types': type_stats,
+            }
+
+    def _remove(self, key):
+        # the cache only drops its references to the value, since the arrays of memory-mapped files
+        # may still be used by another thread. Each file is closed once nothing refers to it.
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        value, size, mapped_files = entry
+        self.total_bytes -= size
+
+        for mapped_file in mapped_files:
+            _, num_entries = self.mapped_files[id(mapped_file)]
+            if num_entries > 1:
+                self.mapped_files[id(mapped_file)] = (mapped_file, num_entries - 1)
+            else:
+                del self.mapped_files[id(mapped_file)]
+
+# cache for all modules in this process (e.g. arrival histories and archives, timetables and metrics),
+# so that the memory and the memory-mapped files used by all cached values are limited together
+shared_cache = LRUCache(config.metrics_cache_mb * 1024 * 1024, max_mapped_files=config.metrics_cache_max_files)
+
+def get_key_type(key):
+    return key[0] if isinstance(key, tuple) and len(key) > 0 else None
+
+def get_size(value, seen=None, mapped_files=None) -> int:
+    '''
+    Returns the approximate number of bytes of memory used by a value, including the objects it contains
+    (numpy arrays, data frames, dicts, lists, and the attributes of other objects).
+
+    If mapped_files is a list, the mmap objects of memory-mapped files used by the value are appended to it.
+    '''
+    if seen is None:
+        seen = set()
+
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    if isinstance(value, mmap.mmap):
+        if mapped_files is not None:
+            mapped_files.append(value)
+        return sys.getsizeof(value)
+
+    if isinstance(value, np.ndarray):
+        # memory-mapped arrays are shared with other processes and can be evicted from the page cache by the OS,
+        # so they don't count towards the memory used by this process
+        mapped_file = columnar.get_mapped_file(value)
+        if mapped_file is not None:
+            size = get_size(mapped_file, seen, mapped_files)
+        else:
+            size = value.nbytes
+        if value.dtype.kind == 'O':
+            size += sum(get_size(item, seen, mapped_files) for item in value.ravel().tolist())
+        return size
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        memory_usage = value.memory_usage(index=True, deep=True)
+        return int(memory_usage.sum() if isinstance(value, pd.DataFrame) else memory_usage)
+
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        size += sum(get_size(k, seen, mapped_files) + get_size(v, seen, mapped_files) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(get_size(item, seen, mapped_files) for item in value)
+    elif hasattr(value, '__dict__'):
+        size += get_size(vars(value), seen, mapped_files)
+
+    return size
@@ -0,0 +1,279 @@
+import io
+import os
+import json
+import mmap
+import struct
+import uuid
+import numpy as np
+import pandas as pd
+
+# Simple binary container for a table of typed columns, used for caching data
+# (such as GPS observations) that would otherwise be parsed from CSV or JSON text.
+#
+# File layout:
+#   8 byte magic string
+#   8 byte little-endian unsigned integer containing the length of the JSON header
+#   JSON header describing each column (name, dtype, length, byte offset) and arbitrary metadata
+#   raw column data, with each column aligned to a 64-byte boundary
+#
+# Since column data is stored in native numpy format, loading a table only needs to read
+# (or memory-map) the file and create numpy views of each column without copying or parsing.
+#
+# String columns (e.g. vehicle IDs) are dictionary-encoded: the distinct values are stored
+# in the JSON header and the column data contains int32 indexes into the dictionary.
+
+MAGIC = b'OTCOL01\n'
+ARCHIVE_MAGIC = b'OTARC01\n'
+ALIGNMENT = 64
+
+class ColumnTable:
+    def __init__(self, columns: dict, dictionaries: dict = None, meta: dict = None):
+        self.columns = columns                  # map of column name => numpy array (codes for dictionary-encoded columns)
+        self.dictionaries = dictionaries or {}  # map of column name => numpy object array of distinct values
+        self.meta = meta or {}
+
+    def __len__(self):
+        for values in self.columns.values():
+            return len(values)
+        return 0
+
+    def get_column_names(self):
+        return list(self.columns.keys())
+
+    def get_values(self, name) -> np.ndarray:
+        '''
+        Returns the values of a column, decoding dictionary-encoded columns into an array of Python objects.
+        '''
+        values = self.columns[name]
+        if name in self.dictionaries:
+            return self.dictionaries[name][values]
+        return values
+
+    def get_data_frame(self, columns=None) -> pd.DataFrame:
+        if columns is None:
+            columns = self.get_column_names()
+        return pd.DataFrame({name: self.get_values(name) for name in columns}, columns=columns)
+
+def encode_values(values: np.ndarray):
+    '''
+    Returns a tuple (codes, dictionary) for a column, or (values, None) if the column doesn't need to be dictionary-encoded.
+    '''
+    values = np.asarray(values)
+    if values.dtype.kind in ('O', 'U', 'S'):
+        values = values.astype(object)
+        dictionary, codes = np.unique(values, return_inverse=True)
+        return codes.astype(np.int32), dictionary
+    return values, None
+
+def write_table(path: str, columns: dict, meta: dict = None, dictionaries: dict = None):
+    '''
+    Writes a table of columns (map of column name => numpy array) to a file at the given path.
+
+    Columns containing strings are dictionary-encoded automatically. Columns that are already
+    dictionary-encoded can be written by passing int32 codes in `columns` and the distinct values
+    in `dictionaries`.
+
+    The file is written to a temporary path and then renamed, so readers never see a partially written file.
+    '''
+    temp_path = get_temp_path(path)
+    with open(temp_path, 'wb') as f:
+        write_table_to(f, columns, meta, dictionaries)
+
+    os.replace(temp_path, path)
+
+def get_temp_path(path) -> str:
+    # the API server may write the same file from several threads in one process,
+    # so the temp path is unique per write rather than per process
+    return f'{path}.tmp{os.getpid()}_{uuid.uuid4().hex[:12]}'
+
+def table_to_bytes(columns: dict, meta: dict = None, dictionaries: dict = None) -> bytes:
+    f = io.BytesIO()
+    write_table_to(f, columns, meta, dictionaries)
+    return f.getvalue()
+
+def write_table_to(f, columns: dict, meta: dict = None, dictionaries: dict = None):
+    # writes a table at the current position of a binary file object, which should be aligned to ALIGNMENT bytes
+    dictionaries = dict(dictionaries or {})
+
+    column_headers = []
+    column_data = []
+    offset = 0
+
+    for name, values in columns.items():
+        if name in dictionaries:
+            values = np.asarray(values, dtype=np.int32)
+            dictionary = dictionaries[name]
+        else:
+            values, dictionary = encode_values(values)
+
+        values = np.ascontiguousarray(values)
+        dtype = values.dtype.newbyteorder('<') if values.dtype.byteorder == '>' else values.dtype
+
+        column_header = {
+            'name': name,
+            'dtype': dtype.str,
+            'length': len(values),
+            'offset': offset,
+        }
+        if dictionary is not None:
+            column_header['dictionary'] = [str(v) for v in dictionary]
+
+        column_headers.append(column_header)
+        column_data.append(values.astype(dtype, copy=False))
+
+        offset = align(offset + values.nbytes)
+
+    header_bytes = json.dumps({
+        'columns': column_headers,
+        'meta': meta or {},
+    }, separators=(',', ':')).encode('utf-8')
+
+    base_offset = f.tell()
+    data_start = base_offset + align(len(MAGIC) + 8 + len(header_bytes))
+
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', len(header_bytes)))
+    f.write(header_bytes)
+
+    for column_header, values in zip(column_headers, column_data):
+        pad_to(f, data_start + column_header['offset'])
+        f.write(values.tobytes())
+
+    pad_to(f, data_start + offset)
+
+def read_table(path: str, use_mmap=True) -> ColumnTable:
+    '''
+    Reads a table written by write_table. If use_mmap is True, the returned columns are read-only
+    views of a memory-mapped file, so that data is only loaded from disk when it is accessed,
+    and multiple processes reading the same file share the same physical memory.
+    '''
+    with open(path, 'rb') as f:
+        if use_mmap:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buf = f.read()
+
+    return table_from_buffer(buf, path)
+
+def is_memory_mapped(values: np.ndarray) -> bool:
+    '''
+    Returns True if the array is a view of a memory-mapped file (e.g. a column returned by read_table),
+    so its data is stored in the OS page cache and shared with other processes mapping the same file.
+    '''
+    return get_mapped_file(values) is not None
+
+def get_mapped_file(values: np.ndarray):
+    '''
+    Returns the mmap object that the array is a view of, or None if the array is not memory-mapped.
+    The file stays open (using a file descriptor) until the mmap and all arrays created from it are garbage collected.
+    '''
+    base = values
+    while isinstance(base, np.ndarray):
+        base = base.base
+    if isinstance(base, memoryview):
+        base = base.obj
+    return base if isinstance(base, mmap.mmap) else None
+
+def table_from_buffer(buf, path='buffer', base_offset=0) -> ColumnTable:
+    magic_end = base_offset + len(MAGIC)
+    if bytes(buf[base_offset:magic_end]) != MAGIC:
+        raise Exception(f'{path} is not a columnar table')
+
+    header_len, = struct.unpack('<Q', buf[magic_end:magic_end + 8])
+    header_start = magic_end + 8
+    header = json.loads(bytes(buf[header_start:header_start + header_len]).decode('utf-8'))
+
+    data_start = base_offset + align(len(MAGIC) + 8 + header_len)
+
+    columns = {}
+    dictionaries = {}
+    for column_header in header['columns']:
+        name = column_header['name']
+        dtype = np.dtype(column_header['dtype'])
+        columns[name] = np.frombuffer(buf, dtype=dtype, count=column_header['length'],
+            offset=data_start + column_header['offset'])
+
+        if 'dictionary' in column_header:
+            dictionaries[name] = np.array(column_header['dictionary'], dtype=object)
+
+    return ColumnTable(columns, dictionaries, header['meta'])
+
+# An archive file contains multiple tables (e.g. one for each date) in the same layout:
+#   8 byte magic string
+#   8 byte little-endian unsigned integer containing the length of the JSON header
+#   JSON header with the byte offset of each table by key, and arbitrary metadata
+#   tables in the same format as write_table, each aligned to a 64-byte boundary
+#
+# Reading an archive memory-maps the file once, and each table is read from its offset when it is needed.
+
+class TableArchive:
+    def __init__(self, buf, offsets: dict, meta: dict = None, path='buffer'):
+        self.buf = buf
+        self.offsets = offsets  # map of key => byte offset of table
+        self.meta = meta or {}
+        self.path = path
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def keys(self):
+        return list(self.offsets.keys())
+
+    def get_table(self, key) -> ColumnTable:
+        return table_from_buffer(self.buf, f'{self.path}[{key}]', base_offset=self.offsets[key])
+
+def write_archive(path: str, tables: dict, meta: dict = None):
+    '''
+    Writes an archive of tables to a file at the given path, where `tables` is a map of key => bytes
+    returned by table_to_bytes. Tables are written in the order of the keys.
+    '''
+    offsets = {}
+    offset = 0
+    for key, table_bytes in tables.items():
+        offsets[key] = offset
+        offset = align(offset + len(table_bytes))
+
+    header_bytes = json.dumps({
+        'offsets': offsets,
+        'meta': meta or {},
+    }, separators=(',', ':')).encode('utf-8')
+
+    data_start = align(len(ARCHIVE_MAGIC) + 8 + len(header_bytes))
+
+    temp_path = get_temp_path(path)
+    with open(temp_path, 'wb') as f:
+        f.write(ARCHIVE_MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+
+        for key, table_bytes in tables.items():
+            pad_to(f, data_start + offsets[key])
+            f.write(table_bytes)
+
+    os.replace(temp_path, path)
+
+def read_archive(path: str) -> TableArchive:
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic_end = len(ARCHIVE_MAGIC)
+    if bytes(buf[:magic_end]) != ARCHIVE_MAGIC:
+        raise Exception(f'{path} is not a columnar archive')
+
+    header_len, = struct.unpack('<Q', buf[magic_end:magic_end + 8])
+    header_start = magic_end + 8
+    header = json.loads(bytes(buf[header_start:header_start + header_len]).decode('utf-8'))
+
+    data_start = align(len(ARCHIVE_MAGIC) + 8 + header_len)
+
+    offsets = {key: data_start + offset for key, offset in header['offsets'].items()}
+
+    return TableArchive(buf, offsets, header['meta'], path)
+
+def align(offset):
+    return offset + (-offset % ALIGNMENT)
+
+def pad_to(f, offset):
+    pos = f.tell()
+    if pos < offset:
+        f.write(b'\0' * (offset - pos))
@@ -2,8 +2,30 @@ import os, re, yaml, pytz
 
 s3_bucket = os.environ.get("OPENTRANSIT_S3_BUCKET", 'opentransit-data')
 
+# optional URL of an S3-compatible server to use instead of Amazon S3 when fetching raw state (e.g. for testing)
+s3_endpoint_url = os.environ.get("OPENTRANSIT_S3_ENDPOINT_URL", None)
+
 agency_ids = os.environ.get("OPENTRANSIT_AGENCY_IDS", 'muni').split(',')
 
+# maximum size of buffered GPS observations (in MB) while downloading raw state from S3,
+# before the observations are flushed to temp files on disk
+state_buffer_mb = int(os.environ.get("OPENTRANSIT_STATE_BUFFER_MB", '64'))
+
+# maximum number of concurrent requests when downloading raw state from S3
+state_fetch_concurrency = int(os.environ.get("OPENTRANSIT_STATE_FETCH_CONCURRENCY", '8'))
+
+# maximum number of concurrent requests when the API downloads arrival histories, timetables and stats from S3
+s3_fetch_concurrency = int(os.environ.get("OPENTRANSIT_S3_FETCH_CONCURRENCY", '8'))
+
+# maximum size (in MB) of arrival histories, timetables and stats cached in memory by each API server process
+metrics_cache_mb = int(os.environ.get("OPENTRANSIT_METRICS_CACHE_MB", '512'))
+
+# maximum number of memory-mapped files (each using a file descriptor) held by the values cached in each API server process
+metrics_cache_max_files = int(os.environ.get("OPENTRANSIT_METRICS_CACHE_MAX_FILES", '256'))
+
+# optional directory where command line scripts save a JSON report with timings and counters for each run
+report_dir = os.environ.get("OPENTRANSIT_REPORT_DIR", None)
+
 class Agency:
     def __init__(self, conf):
         self.id = conf['id']
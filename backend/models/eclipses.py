@@ -2,10 +2,12 @@ import time
 from datetime import date
 import pandas as pd
 import numpy as np
-from . import routeconfig, util, config
+from . import routeconfig, util, config, spatial_index, instrumentation
 
 
 def resample_bus(bus: pd.DataFrame) -> pd.DataFrame:
+    # Resamples the GPS observations for one vehicle (sorted by time).
+    # find_arrivals uses resample_buses() instead, which returns the same rows for all vehicles at once.
 
     time_diffs = np.diff(bus['TIME'].values, prepend=0)
 
@@ -111,6 +113,17 @@ def resample_bus(bus: pd.DataFrame) -> pd.DataFrame:
 
     return resampled_bus
 
+def get_obs_group_start_times(bus: pd.DataFrame) -> np.ndarray:
+    # Returns the time of the first GPS observation in each observation group
+    # that resample_bus() would assign to a vehicle's observations (sorted by time).
+    time_values = bus['TIME'].values
+
+    time_values = time_values[np.diff(time_values, prepend=0) > 2]
+    if len(time_values) == 0:
+        return time_values
+
+    return time_values[np.r_[True, np.diff(time_values) > 1800]]
+
 def get_invalid_direction_times(agency: config.Agency, route_config: routeconfig.RouteConfig, direction_id: str):
     route_id = route_config.id
     invalid_times = []
@@ -123,9 +136,127 @@ def get_invalid_direction_times(agency: config.Agency, route_config: routeconfig
                 ))
     return invalid_times
 
-def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config: routeconfig.RouteConfig, d: date) -> pd.DataFrame:
+def resample_buses(route_state: pd.DataFrame) -> pd.DataFrame:
+    # Returns a data frame of resampled GPS observations ordered by vehicle, then by time,
+    # with a gap in the row index between the observations for each vehicle
+    # (and between each observation group).
+    #
+    # The result is identical to calling resample_bus() for each vehicle and removing the separator rows,
+    # but all vehicles are resampled at once using numpy arrays instead of looping over each observation.
 
-    tz = agency.tz
+    target_dist = 25
+
+    if route_state.empty:
+        return pd.DataFrame({
+            'VID': np.array([], dtype=object),
+            'LAT': np.array([], dtype=np.float64),
+            'LON': np.array([], dtype=np.float64),
+            'TIME': np.array([], dtype=np.int64),
+            'OBS_GROUP': np.array([], dtype=np.int64),
+        }, columns=['VID','LAT','LON','TIME','OBS_GROUP'])
+
+    # order observations by vehicle (in the same order as groupby), keeping the original order for each vehicle
+    vid_codes, vids = pd.factorize(route_state['VID'].values, sort=True)
+    sort_order = np.argsort(vid_codes, kind='mergesort')
+
+    vid_codes = vid_codes[sort_order]
+    time_values = route_state['TIME'].values[sort_order]
+
+    # remove duplicates (positions are observed every 15 seconds, but usually only update every minute or so)
+    vehicle_start_values = np.r_[True, vid_codes[1:] != vid_codes[:-1]]
+    prev_raw_time_values = np.r_[0, time_values[:-1]]
+    prev_raw_time_values[vehicle_start_values] = 0
+
+    keep_values = (time_values - prev_raw_time_values) > 2
+    sort_order = sort_order[keep_values]
+
+    vid_codes = vid_codes[keep_values]
+    time_values = time_values[keep_values]
+    lat_values = route_state['LAT'].values[sort_order]
+    lon_values = route_state['LON'].values[sort_order]
+
+    num_rows = len(time_values)
+
+    vehicle_start_values = np.r_[True, vid_codes[1:] != vid_codes[:-1]]
+    vehicle_end_values = np.r_[vehicle_start_values[1:], True]
+
+    def get_prev_values(values):
+        prev_values = np.r_[np.nan, values[:-1]]
+        prev_values[vehicle_start_values] = np.nan
+        return prev_values
+
+    prev_time_values = get_prev_values(time_values)
+    prev_lat_values = get_prev_values(lat_values)
+    prev_lon_values = get_prev_values(lon_values)
+
+    dt_values = time_values - prev_time_values
+    lat_diff_values = lat_values - prev_lat_values
+    lon_diff_values = lon_values - prev_lon_values
+
+    moved_dist_values = util.haver_distance(prev_lat_values, prev_lon_values, lat_values, lon_values)
+    num_samples_values = np.floor(moved_dist_values / target_dist) # may be 0
+    num_samples_values[vehicle_start_values] = 0
+
+    # interpolate observations where the vehicle moved more than 2 * target_dist within 3 minutes
+    # (see resample_bus for details)
+    interp_values = (num_samples_values > 1) & (num_samples_values < 100) & (dt_values < 180)
+
+    # increment the observation group (and add a separator row) after gaps of more than 30 minutes
+    gap_values = ~interp_values & (dt_values > 1800)
+
+    gap_counts = np.cumsum(gap_values)
+    vehicle_start_indexes = np.nonzero(vehicle_start_values)[0]
+    vehicle_lengths = np.diff(np.r_[vehicle_start_indexes, num_rows])
+    obs_group_values = 1 + gap_counts - np.repeat(gap_counts[vehicle_start_indexes], vehicle_lengths)
+
+    # each observation is preceded by its interpolated rows or a separator row,
+    # and the last observation for each vehicle is followed by a separator row
+    num_interp_values = np.where(interp_values, num_samples_values - 1, 0).astype(np.int64)
+    block_sizes = num_interp_values + gap_values + 1 + vehicle_end_values
+    block_start_indexes = np.cumsum(block_sizes) - block_sizes
+
+    num_resampled_rows = int(np.sum(block_sizes))
+
+    # separator rows have zeros for all columns except VID
+    resampled_vid_codes = np.repeat(vid_codes, block_sizes)
+    resampled_lat_values = np.zeros(num_resampled_rows)
+    resampled_lon_values = np.zeros(num_resampled_rows)
+    resampled_time_values = np.zeros(num_resampled_rows)
+    resampled_obs_group_values = np.zeros(num_resampled_rows, dtype=np.int64)
+
+    obs_indexes = block_start_indexes + num_interp_values + gap_values
+    resampled_lat_values[obs_indexes] = lat_values
+    resampled_lon_values[obs_indexes] = lon_values
+    resampled_time_values[obs_indexes] = time_values
+    resampled_obs_group_values[obs_indexes] = obs_group_values
+
+    # for each interpolated row, index of the following observation and sample number (1 to num_samples - 1)
+    interp_row_indexes = np.repeat(np.arange(num_rows), num_interp_values)
+    interp_sample_values = np.arange(len(interp_row_indexes)) \
+        - np.repeat(np.cumsum(num_interp_values) - num_interp_values, num_interp_values) + 1
+
+    frac_values = interp_sample_values / num_samples_values[interp_row_indexes]
+
+    interp_indexes = block_start_indexes[interp_row_indexes] + interp_sample_values - 1
+    resampled_lat_values[interp_indexes] = prev_lat_values[interp_row_indexes] + lat_diff_values[interp_row_indexes] * frac_values
+    resampled_lon_values[interp_indexes] = prev_lon_values[interp_row_indexes] + lon_diff_values[interp_row_indexes] * frac_values
+    resampled_time_values[interp_indexes] = prev_time_values[interp_row_indexes] + dt_values[interp_row_indexes] * frac_values
+    resampled_obs_group_values[interp_indexes] = obs_group_values[interp_row_indexes]
+
+    buses = pd.DataFrame({
+        'VID': vids[resampled_vid_codes],
+        'LAT': resampled_lat_values,
+        'LON': resampled_lon_values,
+        'TIME': resampled_time_values.astype(np.int64),
+        'OBS_GROUP': resampled_obs_group_values,
+    }, columns=['VID','LAT','LON','TIME','OBS_GROUP'])
+
+    def remove_bus_separators():
+        return buses[buses['TIME'] != 0]
+
+    return remove_bus_separators()
+
+def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config: routeconfig.RouteConfig, d: date) -> pd.DataFrame:
 
     route_id = route_config.id
 
@@ -138,17 +269,43 @@ def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config
 
     print(f'{route_id}: {round(time.time() - t0, 1)} resampling {len(route_state["TIME"].values)} GPS observations')
 
-    buses = pd.concat([
-        resample_bus(bus)
-        for vid, bus in route_state.groupby(route_state['VID'])
-    ], ignore_index=True)
+    with instrumentation.stage('resample_buses', route=route_id):
+        buses = resample_buses(route_state)
 
-    def remove_bus_separators():
-        return buses[buses['TIME'] != 0]
+    print(f'{route_id}: {round(time.time() - t0, 1)} finding stops near {len(buses["TIME"].values)} resampled GPS observations')
 
-    buses = remove_bus_separators()
+    with instrumentation.stage('get_possible_arrivals', route=route_id):
+        possible_arrivals = get_possible_arrivals(agency, buses, route_config, d)
 
-    print(f'{route_id}: {round(time.time() - t0, 1)} computing distances from {len(buses["TIME"].values)} resampled GPS observations to stops')
+    if possible_arrivals.empty:
+        arrivals, num_trips = possible_arrivals, 0
+    else:
+        print(f'{route_id}: {round(time.time() - t0, 1)} cleaning arrivals')
+
+        with instrumentation.stage('clean_arrivals', route=route_id):
+            arrivals = clean_arrivals(possible_arrivals, buses, route_config)
+
+        num_trips = len(np.unique(arrivals['TRIP'].values))
+
+    print(f"{route_id}: {round(time.time() - t0, 1)} found {len(arrivals['TIME'].values)} arrivals in {num_trips} trips")
+
+    instrumentation.count('resampled_observations', len(buses), route=route_id)
+    instrumentation.count('possible_arrivals', len(possible_arrivals), route=route_id)
+    instrumentation.count('trips', num_trips, route=route_id)
+
+    return arrivals
+
+def get_possible_arrivals(agency: config.Agency, buses: pd.DataFrame, route_config: routeconfig.RouteConfig, d: date,
+        include_eclipse_times=False, use_spatial_index=True) -> pd.DataFrame:
+    # Returns a data frame of possible arrivals for all stops in all directions (ordered by direction,
+    # then by stop index, then by vehicle and time).
+    #
+    # If use_spatial_index is True, the observations near each stop are found using a spatial index,
+    # so distances are only computed for observations within the radius of each stop.
+    # Otherwise, adds DIST_{stop_id} columns to the buses data frame with the distance from
+    # every observation to every stop (which uses memory proportional to the number of stops).
+
+    tz = agency.tz
 
     # datetime not normally needed for computation, but useful for debugging
     #buses['DATE_TIME'] = buses.TIME.apply(lambda t: datetime.fromtimestamp(t, tz))
@@ -169,9 +326,15 @@ def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config
                 # calculate distances fast with haversine function
                 buses[f'DIST_{stop_id}'] = util.haver_distance(stop_info.lat, stop_info.lon, lat_values, lon_values)
 
-    compute_distances_to_all_stops()
+    def make_bus_index(buses):
+        return spatial_index.GridIndex(buses['LAT'].values, buses['LON'].values) if use_spatial_index else None
+
+    bus_index = make_bus_index(buses)
 
-    print(f'{route_id}: {round(time.time() - t0, 1)} computing possible arrivals')
+    if not use_spatial_index:
+        compute_distances_to_all_stops()
+
+    print(f'{route_config.id}: computing possible arrivals')
 
     for dir_info in route_config.get_direction_infos():
 
@@ -190,6 +353,8 @@ def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config
                 print(f"excluding buses before {invalid_end_timestamp} ({end_time_str}) for direction {direction_id}")
                 valid_buses = valid_buses[valid_buses['TIME'] >= invalid_end_timestamp]
 
+        valid_bus_index = bus_index if valid_buses is buses else make_bus_index(valid_buses)
+
         dir_stops = dir_info.get_stop_ids()
         num_dir_stops = len(dir_stops)
         is_loop = dir_info.is_loop()
@@ -229,6 +394,9 @@ def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config
                 adjacent_stop_ids=adjacent_stop_ids,
                 radius=radius,
                 is_terminal=is_terminal,
+                include_eclipse_times=include_eclipse_times,
+                route_config=route_config,
+                bus_index=valid_bus_index,
             )
 
             possible_arrivals_arr.append(possible_arrivals)
@@ -236,27 +404,18 @@ def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config
     def concat_possible_arrivals():
         return pd.concat(possible_arrivals_arr, ignore_index=True)
 
-    possible_arrivals = concat_possible_arrivals()
-
-    if possible_arrivals.empty:
-        arrivals, num_trips = possible_arrivals, 0
-    else:
-        print(f'{route_id}: {round(time.time() - t0, 1)} cleaning arrivals')
-
-        arrivals = clean_arrivals(possible_arrivals, buses, route_config)
-
-        num_trips = len(np.unique(arrivals['TRIP'].values))
-
-    print(f"{route_id}: {round(time.time() - t0, 1)} found {len(arrivals['TIME'].values)} arrivals in {num_trips} trips")
-
-    return arrivals
+    return concat_possible_arrivals()
 
 def get_possible_arrivals_for_stop(buses: pd.DataFrame, stop_id: str,
     direction_id=None,            # DID field will be set to this value
     stop_index=-1,                # STOP_INDEX field will be set to this value
     adjacent_stop_ids=[],
     radius=200,
-    is_terminal=False
+    is_terminal=False,
+    include_eclipse_times=False,  # if True, adds ECLIPSE_START and ECLIPSE_END columns with the time of the
+                                  # first and last observation within the radius of the stop
+    route_config=None,            # used to compute distances that are not in DIST_{stop_id} columns
+    bus_index=None                # spatial_index.GridIndex of the observations in buses (optional)
 ) -> pd.DataFrame:
 
     # the "possible" arrivals include times when the bus passes stops in the opposite direction,
@@ -278,13 +437,31 @@ def get_possible_arrivals_for_stop(buses: pd.DataFrame, stop_id: str,
 
     dist_column = f'DIST_{stop_id}'
 
+    def get_distance_values(buses, stop_id):
+        column = f'DIST_{stop_id}'
+        if column in buses.columns:
+            return buses[column].values
+        stop_info = route_config.get_stop_info(stop_id)
+        return util.haver_distance(stop_info.lat, stop_info.lon, buses['LAT'].values, buses['LON'].values)
+
     def filter_by_radius_to_stop():
+        if bus_index is not None:
+            # only observations in grid cells near the stop are considered,
+            # so the distance from the stop to most observations is never computed
+            stop_info = route_config.get_stop_info(stop_id)
+            row_positions, distance_values = bus_index.query_radius(stop_info.lat, stop_info.lon, radius)
+            return buses.iloc[row_positions].assign(**{dist_column: distance_values})
+
+        if dist_column not in buses.columns:
+            buses_with_dist = buses.assign(**{dist_column: get_distance_values(buses, stop_id)})
+            return buses_with_dist[buses_with_dist[dist_column].values < radius]
+
         return buses[buses[dist_column] < radius] # meters
 
     eclipses = filter_by_radius_to_stop()
 
     def filter_by_adjacent_stop_distance(adjacent_stop_id):
-        return eclipses[eclipses[dist_column] <= eclipses[f'DIST_{adjacent_stop_id}']]
+        return eclipses[eclipses[dist_column].values <= get_distance_values(eclipses, adjacent_stop_id)]
 
     # require bus to be closer to this stop than to previous or next stop
     for adjacent_stop_id in adjacent_stop_ids:
@@ -299,172 +476,267 @@ def get_possible_arrivals_for_stop(buses: pd.DataFrame, stop_id: str,
 
     row_index_values = eclipses.index.values
 
+    extra_columns = eclipse_columns if include_eclipse_times else []
+
     num_rows = len(row_index_values)
     if num_rows == 0:
-        return make_arrivals_frame([])
+        return make_arrivals_frame([], extra_columns)
 
     eclipse_start_values = np.diff(row_index_values, prepend=-999999) > 1
     eclipse_start_indexes = np.nonzero(eclipse_start_values)[0]
     eclipse_end_indexes = np.r_[eclipse_start_indexes[1:], num_rows]
 
-    all_distance_values = eclipses[dist_column].values
-    all_time_values = eclipses['TIME'].values
-    all_vid_values = eclipses['VID'].values
-    all_obs_group_values = eclipses['OBS_GROUP'].values
+    time_values = eclipses['TIME'].values
 
-    def calc_nadir(eclipse_start_index, eclipse_end_index) -> tuple:
-        # this is called in the inner loop so it needs to be very fast
-        # or computing arrival times will take much longer!
+    arrival_time_values, departure_time_values, min_dist_values = get_eclipse_nadirs(
+        eclipses[dist_column].values, time_values, eclipse_start_indexes, eclipse_end_indexes, is_terminal
+    )
 
-        distance_values = all_distance_values[eclipse_start_index:eclipse_end_index]
+    num_eclipses = len(eclipse_start_indexes)
+
+    columns = {
+        'VID': eclipses['VID'].values[eclipse_start_indexes],
+        'TIME': arrival_time_values,
+        'DEPARTURE_TIME': departure_time_values,
+        'DIST': min_dist_values,
+        'SID': np.full(num_eclipses, stop_id, dtype=object),
+        'DID': np.full(num_eclipses, direction_id, dtype=object),
+        'STOP_INDEX': np.full(num_eclipses, stop_index, dtype=np.int64),
+        'OBS_GROUP': eclipses['OBS_GROUP'].values[eclipse_start_indexes],
+        'TRIP': np.full(num_eclipses, -1, dtype=np.int64),
+    }
+
+    if include_eclipse_times:
+        columns['ECLIPSE_START'] = time_values[eclipse_start_indexes]
+        columns['ECLIPSE_END'] = time_values[eclipse_end_indexes - 1]
+
+    return pd.DataFrame(columns, columns=arrival_columns + extra_columns)
+
+def get_eclipse_nadirs(distance_values: np.ndarray, time_values: np.ndarray,
+        eclipse_start_indexes: np.ndarray, eclipse_end_indexes: np.ndarray, is_terminal=False) -> tuple:
+    # Given the distance to a stop and the time of each observation within the radius of the stop,
+    # where each "eclipse" (a time when a bus is near the stop) is a consecutive range of observations
+    # from eclipse_start_indexes[i] to eclipse_end_indexes[i] (exclusive),
+    # returns a tuple of arrays (arrival_time_values, departure_time_values, min_dist_values)
+    # with the arrival time, departure time and closest distance for each eclipse.
+    #
+    # All eclipses are computed at once using numpy operations on segments of the arrays,
+    # since there can be a large number of eclipses for each stop.
 
-        min_dist = np.min(distance_values)
+    min_dist_values = np.minimum.reduceat(distance_values, eclipse_start_indexes)
 
-        # consider the bus to be "at" the stop whenever it is within some distance
-        # of its closest approach to the stop (within 200m).
-        # use larger fudge factor at a terminal where a bus might wait for a long time
-        # somewhere slightly before the stop, then start moving again toward the stop when it is
-        # ready to go in the opposite direction. without the fudge factor, the arrival time would
-        # be calculated after the long wait.
+    # consider the bus to be "at" the stop whenever it is within some distance
+    # of its closest approach to the stop (within 200m).
+    # use larger fudge factor at a terminal where a bus might wait for a long time
+    # somewhere slightly before the stop, then start moving again toward the stop when it is
+    # ready to go in the opposite direction. without the fudge factor, the arrival time would
+    # be calculated after the long wait.
+    max_dist_values = min_dist_values + (75 if is_terminal else 25)
 
-        # at_stop_indexes is an array of indexes into distance_values
-        # where the bus is considered 'at' the stop.
-        # element 0 is the index of the arrival time
-        # element -1 is the index of the departure time
-        at_stop_indexes = np.nonzero(
-            distance_values <= ((min_dist + 75) if is_terminal else (min_dist + 25))
-        )[0]
+    eclipse_lengths = eclipse_end_indexes - eclipse_start_indexes
 
-        time_values = all_time_values[eclipse_start_index:eclipse_end_index]
+    # at_stop_indexes is an array of indexes into distance_values where the bus is considered 'at' the stop.
+    # each eclipse has at least one index in at_stop_indexes (where the distance is the minimum).
+    # the first index for each eclipse is the index of the arrival time,
+    # and the last index for each eclipse is the index of the departure time.
+    at_stop_indexes = np.nonzero(distance_values <= np.repeat(max_dist_values, eclipse_lengths))[0]
 
-        return (
-            all_vid_values[eclipse_start_index],
-            time_values[at_stop_indexes[0]], # arrival time
-            time_values[at_stop_indexes[-1]], # departure time
-            min_dist,
-            stop_id,
-            direction_id,
-            stop_index,
-            all_obs_group_values[eclipse_start_index],
-            -1
-        )
+    arrival_indexes = at_stop_indexes[np.searchsorted(at_stop_indexes, eclipse_start_indexes)]
+    departure_indexes = at_stop_indexes[np.searchsorted(at_stop_indexes, eclipse_end_indexes) - 1]
 
-    return make_arrivals_frame([
-        calc_nadir(eclipse_start_index, eclipse_end_index)
-        for eclipse_start_index, eclipse_end_index in zip(eclipse_start_indexes, eclipse_end_indexes)
-    ])
+    return time_values[arrival_indexes], time_values[departure_indexes], min_dist_values
 
-def make_arrivals_frame(rows: list) -> pd.DataFrame:
-    return pd.DataFrame(rows, columns=[
-        'VID','TIME','DEPARTURE_TIME','DIST',
-        'SID','DID','STOP_INDEX','OBS_GROUP','TRIP'
-    ])
+arrival_columns = [
+    'VID','TIME','DEPARTURE_TIME','DIST',
+    'SID','DID','STOP_INDEX','OBS_GROUP','TRIP'
+]
 
-def clean_arrivals(possible_arrivals: pd.DataFrame, buses: pd.DataFrame, route_config: routeconfig.RouteConfig) -> tuple:
-    def make_buses_map():
-        return {vid: bus for vid, bus in buses.groupby('VID')}
-        '''
-        vid_values = buses['VID'].values
-        prev_vid_values = np.hstack(('', vid_values[:-1]))
-        start_values = vid_values != prev_vid_values
-        start_indexes = np.nonzero(start_values)[0]
-        end_indexes = np.r_[start_indexes[1:], len(vid_values)]
-
-        return {
-            vid_values[start_index]: buses.iloc[start_index:end_index]
-                for start_index, end_index in zip(start_indexes, end_indexes)
-        }
-        '''
-
-    buses_map = make_buses_map()
+eclipse_columns = ['ECLIPSE_START', 'ECLIPSE_END']
 
-    possible_arrivals = possible_arrivals.sort_values('TIME')
+def make_arrivals_frame(rows: list, extra_columns=[]) -> pd.DataFrame:
+    return pd.DataFrame(rows, columns=arrival_columns + extra_columns)
 
-    start_trip = 0
+def clean_arrivals(possible_arrivals: pd.DataFrame, buses: pd.DataFrame, route_config: routeconfig.RouteConfig) -> tuple:
 
-    '''
-    arrival_time_diffs = []
-    trip_times = []
-    '''
+    # arrivals with the same time are kept in the same order as arrival_history.DefaultVersion
+    # (changing the sort algorithm changes which arrivals are detected)
+    possible_arrivals = possible_arrivals.sort_values('TIME')
 
-    def get_arrivals_for_vehicle_direction(
-        dir_arrivals: pd.DataFrame,
-        vehicle_id: str,
-        direction_id: str,
-        obs_group: int,
-        bus: pd.DataFrame,
-        route_config: routeconfig.RouteConfig
-    ) -> pd.DataFrame:
+    # order possible arrivals by vehicle, direction and observation group (keeping them sorted by time within each group),
+    # so that the trips for all groups can be found in one pass over the arrays of possible arrivals
+    group_values = possible_arrivals.groupby(['VID', 'DID', 'OBS_GROUP']).ngroup().values
+    group_order = np.argsort(group_values, kind='mergesort')
+
+    possible_arrivals = possible_arrivals.iloc[group_order]
+    group_values = group_values[group_order]
+
+    group_start_indexes = np.nonzero(np.r_[True, group_values[1:] != group_values[:-1]])[0]
+    group_end_indexes = np.r_[group_start_indexes[1:], len(group_values)]
+
+    vid_values = possible_arrivals['VID'].values
+    did_values = possible_arrivals['DID'].values
+
+    row_indexes, trip_ids, _ = find_ascending_trips(
+        possible_arrivals['STOP_INDEX'].values,
+        possible_arrivals['TIME'].values,
+        possible_arrivals['DEPARTURE_TIME'].values,
+        possible_arrivals['DIST'].values,
+        group_start_indexes,
+        group_end_indexes,
+        [route_config.get_direction_info(did_values[start_index]) for start_index in group_start_indexes],
+        start_trip=0
+    )
 
-        nonlocal start_trip
+    # row_indexes are ordered by group, so the trips for each group are consecutive rows
+    trip_start_indexes = np.searchsorted(row_indexes, group_start_indexes)
+    trip_end_indexes = np.searchsorted(row_indexes, group_end_indexes)
 
-        debug = False #vehicle_id == 'S005' and direction_id == '0' # and obs_group == 1
+    trip_stop_index_values = possible_arrivals['STOP_INDEX'].values[row_indexes]
+    trip_time_values = possible_arrivals['TIME'].values[row_indexes]
+    trip_departure_time_values = possible_arrivals['DEPARTURE_TIME'].values[row_indexes]
 
-        if debug:
-            print(f"vehicle_id = {vehicle_id}, direction_id = {direction_id}, obs_group = {obs_group}")
+    buses_map = make_buses_map(buses)
 
-        dir_info = route_config.get_direction_info(direction_id)
+    # find arrivals at stops missed in each group, and the index of the row in the trips
+    # that each missing arrival should be inserted before
+    gap_arrivals_arr = []
+    gap_row_indexes = []
 
-        dir_arrivals, start_trip = get_arrivals_with_ascending_stop_index(dir_arrivals, dir_info, start_trip, debug=debug)
-        dir_arrivals = add_missing_arrivals_for_vehicle_direction(dir_arrivals, vehicle_id, direction_id, bus, route_config)
+    for group_index, start_index in enumerate(group_start_indexes):
+        trip_start_index = trip_start_indexes[group_index]
+        trip_end_index = trip_end_indexes[group_index]
 
-        return dir_arrivals
+        if trip_start_index == trip_end_index:
+            continue
 
-    arrivals = pd.concat([
-        get_arrivals_for_vehicle_direction(dir_arrivals, vehicle_id, direction_id, obs_group, buses_map[vehicle_id], route_config)
-            for (vehicle_id, direction_id, obs_group), dir_arrivals in possible_arrivals.groupby(['VID', 'DID', 'OBS_GROUP'])
-    ])
+        vehicle_id = vid_values[start_index]
+
+        for row_index, gap_arrival in find_missing_arrivals_for_vehicle_direction(
+            trip_stop_index_values[trip_start_index:trip_end_index],
+            trip_time_values[trip_start_index:trip_end_index],
+            trip_departure_time_values[trip_start_index:trip_end_index],
+            trip_ids[trip_start_index:trip_end_index],
+            vehicle_id,
+            did_values[start_index],
+            buses_map[vehicle_id],
+            route_config
+        ):
+            gap_arrivals_arr.append(gap_arrival)
+            gap_row_indexes.append(trip_start_index + row_index)
+
+    # create the data frame of arrivals once, with missing arrivals in the correct position in each trip.
+    # row order only matters for arrivals with the same time, since the arrivals are sorted by time at the end.
+    arrivals = possible_arrivals.iloc[row_indexes]
+    arrivals = arrivals.assign(TRIP=trip_ids)
+
+    if len(gap_arrivals_arr) > 0:
+        arrivals = pd.concat([arrivals] + gap_arrivals_arr, sort=False)
+
+        num_trip_rows = len(row_indexes)
+        row_order = np.argsort(np.r_[
+            np.arange(num_trip_rows) * 2 + 1,
+            np.array(gap_row_indexes, dtype=np.int64) * 2
+        ], kind='mergesort')
+
+        arrivals = arrivals.iloc[row_order]
 
-    '''
-    if len(arrival_time_diffs) > 0:
-        arrival_time_diffs = np.concatenate(arrival_time_diffs)
-        diff_quantiles = np.quantile(arrival_time_diffs, [0.5, 0.9, 1])
+    return arrivals.sort_values('TIME')
 
-        print(f' arrival time diffs median={diff_quantiles[0]} 90%={diff_quantiles[1]} max={diff_quantiles[2]}')
+def make_buses_map(buses: pd.DataFrame) -> dict:
+    # Returns a dict of vehicle ID => data frame of observations for that vehicle.
+    # buses is usually ordered by vehicle (see resample_buses),
+    # so the observations for each vehicle are slices of the buses data frame.
+    vid_codes, vids = pd.factorize(buses['VID'].values)
 
-        trip_times = np.concatenate(trip_times)
-        diff_quantiles = np.quantile(trip_times, [0.5, 0.9, 1])
+    if np.any(vid_codes[1:] < vid_codes[:-1]):
+        vehicle_order = np.argsort(vid_codes, kind='mergesort')
+        buses = buses.iloc[vehicle_order]
+        vid_codes = vid_codes[vehicle_order]
 
-        print(f' adjacent stop times median={diff_quantiles[0]} 90%={diff_quantiles[1]} max={diff_quantiles[2]}')
-    '''
+    start_indexes = np.searchsorted(vid_codes, np.arange(len(vids)), side='left')
+    end_indexes = np.searchsorted(vid_codes, np.arange(len(vids)), side='right')
 
-    return arrivals.sort_values('TIME')
+    return {
+        vid: buses.iloc[start_index:end_index]
+            for vid, start_index, end_index in zip(vids, start_indexes, end_indexes)
+    }
 
 class StopSequence:
-    # helper used by get_arrivals_with_ascending_stop_index,
-    # representing a possible subset of the rows in the dir_arrivals data frame
+    # helper used by find_ascending_trips,
+    # representing a possible subset of the rows in the possible arrivals
     # associated with one "trip".
+    #
+    # The row indexes in each sequence are stored as a linked list of nodes in a SequenceNodes object
+    # shared by all possible sequences (each node has the index of the previous node in the same sequence),
+    # so that copying a sequence or replacing its last row doesn't need to copy all of its row indexes.
 
-    def __init__(self):
+    __slots__ = ('nodes', 'tail', 'length', 'last_row_index', 'last_stop_index', 'last_departure_time', 'num_loops')
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.tail = -1 # index of last node, or -1 if the sequence is empty
+        self.length = 0
+        self.last_row_index = None
         self.last_stop_index = None
         self.last_departure_time = None
         self.num_loops = 0
-        self.stop_indexes = []
-        self.row_indexes = []
 
     def append(self, row_index, stop_index, departure_time):
         if self.last_stop_index is not None and stop_index < self.last_stop_index:
             self.num_loops += 1
 
+        self.tail = self.nodes.add(row_index, self.tail)
+        self.length += 1
+        self.last_row_index = row_index
         self.last_stop_index = stop_index
         self.last_departure_time = departure_time
-        self.stop_indexes.append(stop_index)
-        self.row_indexes.append(row_index)
+
+    def replace_last(self, row_index, departure_time):
+        # replaces the last row with another row at the same stop
+        self.tail = self.nodes.add(row_index, self.nodes.prev_node_indexes[self.tail])
+        self.last_row_index = row_index
+        self.last_departure_time = departure_time
 
     def copy(self):
-        other = StopSequence()
+        other = StopSequence(self.nodes)
+        other.tail = self.tail
+        other.length = self.length
+        other.last_row_index = self.last_row_index
         other.last_stop_index = self.last_stop_index
         other.last_departure_time = self.last_departure_time
-        other.stop_indexes = self.stop_indexes.copy()
-        other.row_indexes = self.row_indexes.copy()
         other.num_loops = self.num_loops
         return other
 
+    def get_row_indexes(self) -> list:
+        row_indexes = [0] * self.length
+        node_row_indexes = self.nodes.row_indexes
+        prev_node_indexes = self.nodes.prev_node_indexes
+        node_index = self.tail
+        for i in range(self.length - 1, -1, -1):
+            row_indexes[i] = node_row_indexes[node_index]
+            node_index = prev_node_indexes[node_index]
+        return row_indexes
+
+class SequenceNodes:
+    # nodes of the linked lists of row indexes for all StopSequence objects for one trip
+
+    __slots__ = ('row_indexes', 'prev_node_indexes')
+
+    def __init__(self):
+        self.row_indexes = []
+        self.prev_node_indexes = []
+
+    def add(self, row_index, prev_node_index):
+        self.row_indexes.append(row_index)
+        self.prev_node_indexes.append(prev_node_index)
+        return len(self.row_indexes) - 1
+
 def get_arrivals_with_ascending_stop_index(
     dir_arrivals: pd.DataFrame,
     dir_info: routeconfig.DirectionInfo,
     start_trip: int,
-    debug=False
+    debug=False,
+    finish_points=None
 ) -> pd.DataFrame:
     # Given a data frame containing all "possible" arrivals
     # for one vehicle in one direction (sorted by arrival time),
@@ -475,9 +747,66 @@ def get_arrivals_with_ascending_stop_index(
     # The 'TRIP' column in the returned data frame is set to the unique trip ID, starting
     # at `start_trip`.
     #
-    # For routes with 2 directions, the given data frame of possible arrivals contains
-    # arrivals for stops in both directions. However, the stop_index values will typically be decreasing
-    # over time for stops that are not in the direction that the vehicle is actually traveling.
+    # See find_ascending_trips for details.
+
+    num_arrivals = len(dir_arrivals)
+    if num_arrivals < 2:
+        return make_arrivals_frame([]), start_trip
+
+    if debug:
+        with pd.option_context("display.max_rows", None):
+            print(dir_arrivals)
+
+    row_indexes, trip_ids, next_trip = find_ascending_trips(
+        dir_arrivals['STOP_INDEX'].values,
+        dir_arrivals['TIME'].values,
+        dir_arrivals['DEPARTURE_TIME'].values,
+        dir_arrivals['DIST'].values,
+        [0],
+        [num_arrivals],
+        [dir_info],
+        start_trip,
+        debug=debug,
+        finish_points=[finish_points] if finish_points is not None else None
+    )
+
+    ascending_dir_arrivals = dir_arrivals.iloc[row_indexes].copy()
+
+    ascending_dir_arrivals['TRIP'] = trip_ids.tolist()
+
+    if debug:
+        with pd.option_context("display.max_rows", None):
+            print(ascending_dir_arrivals)
+
+    return ascending_dir_arrivals, next_trip
+
+def find_ascending_trips(
+    stop_index_values: np.ndarray,
+    arrival_time_values: np.ndarray,
+    departure_time_values: np.ndarray,
+    dist_values: np.ndarray,
+    group_start_indexes,
+    group_end_indexes,
+    dir_infos: list,
+    start_trip: int,
+    debug=False,
+    finish_points=None
+) -> tuple:
+    # Given arrays with the stop index, arrival time, departure time, and distance of "possible" arrivals
+    # in one or more groups, where each group contains possible arrivals for one vehicle in one direction
+    # (in the rows from group_start_indexes[i] to group_end_indexes[i] (exclusive), sorted by arrival time),
+    # and dir_infos[i] is the DirectionInfo for the direction of group i,
+    # finds the subset of rows in each group where arrivals are grouped into trips
+    # and each trip contains arrivals where the stop_index is ascending over time.
+    #
+    # Returns a tuple (row_indexes, trip_ids, next_trip), where row_indexes is an array of
+    # the indexes of the rows in the trips (in the order of the groups, then trips),
+    # trip_ids is an array of the unique trip ID for each row (starting at `start_trip`),
+    # and next_trip is the next unused trip ID.
+    #
+    # For routes with 2 directions, the possible arrivals contain arrivals for stops in both directions.
+    # However, the stop_index values will typically be decreasing over time for stops that are not in
+    # the direction that the vehicle is actually traveling.
     #
     # For twisty routes where a single direction doubles back on itself (or nearly so), such as
     # SF Muni's 39-Coit, 36-Teresita, 30-Stockton, 9-San Bruno, etc., it is possible that there may
@@ -498,326 +827,322 @@ def get_arrivals_with_ascending_stop_index(
     #
     # After it finds the end of a trip, it resets the possible sequences and continues processing
     # possible arrivals where the previous sequence ended.
+    #
+    # If finish_points is a list, finish_points[i] should be a list which will be appended with tuples
+    # (row_index, next_row_index) relative to the start of group i, with the row index that caused each trip
+    # to finish and the row index where the next trip starts looking for arrivals,
+    # so that it's possible to resume processing from that point (see arrival_checkpoints.py)
+
+    # convert arrays to lists once, since indexing python lists is faster than indexing numpy arrays
+    if isinstance(stop_index_values, np.ndarray):
+        stop_index_values = stop_index_values.tolist()
+    if isinstance(arrival_time_values, np.ndarray):
+        arrival_time_values = arrival_time_values.tolist()
+    if isinstance(departure_time_values, np.ndarray):
+        departure_time_values = departure_time_values.tolist()
+    if isinstance(dist_values, np.ndarray):
+        dist_values = dist_values.tolist()
 
-    stop_index_values = dir_arrivals['STOP_INDEX'].values
-
-    num_arrivals = len(stop_index_values)
-    if num_arrivals < 2:
-        return make_arrivals_frame([]), start_trip
+    all_row_indexes = []
+    trip_ids = []
 
-    arrival_time_values = dir_arrivals['TIME'].values
-    departure_time_values = dir_arrivals['DEPARTURE_TIME'].values
-    dist_values = dir_arrivals['DIST'].values
+    next_trip = start_trip
 
-    if debug:
-        #dir_arrivals = dir_arrivals.copy()
-        #dir_arrivals['ROW_INDEX'] = np.arange(0, num_arrivals)
+    max_small_gap_index_diff = 5
+    max_large_gap_seconds = 300
 
-        with pd.option_context("display.max_rows", None):
-            print(dir_arrivals)
+    for group_index, dir_info in enumerate(dir_infos):
+        group_start_index = group_start_indexes[group_index]
+        group_end_index = group_end_indexes[group_index]
 
-    next_sequence_key = None
-    possible_sequences = None
+        if group_end_index - group_start_index < 2:
+            continue
 
-    next_trip = start_trip
+        group_finish_points = finish_points[group_index] if finish_points is not None else None
 
-    def reset_possible_sequences():
-        nonlocal possible_sequences, next_sequence_key
+        is_loop = dir_info.is_loop()
 
-        possible_sequences = {
-            0: StopSequence()
-        }
-        next_sequence_key = 1
+        num_stops = len(dir_info.get_stop_ids())
+        terminal_stop_index = num_stops if is_loop else (num_stops - 1) # never reaches terminal_stop_index for loop routes
 
-    reset_possible_sequences()
+        min_trip_length = min(3, num_stops)
 
-    is_loop = dir_info.is_loop()
+        nodes = None
+        possible_sequences = None
+        next_sequence_key = None
 
-    def print_sequences():
-        for sequence_key, sequence in possible_sequences.items():
-            print(f'{sequence_key}: {sequence.stop_indexes} {sequence.row_indexes}{f" ({sequence.num_loops} loops)" if is_loop else ""}')
-        print('-')
+        def reset_possible_sequences():
+            nonlocal nodes, possible_sequences, next_sequence_key
 
-    all_row_indexes = []
-    trip_ids = []
+            nodes = SequenceNodes()
+            possible_sequences = {
+                0: StopSequence(nodes)
+            }
+            next_sequence_key = 1
 
-    row_index = 0
+        reset_possible_sequences()
 
-    dir_stop_ids = dir_info.get_stop_ids()
-    num_stops = len(dir_stop_ids)
-    terminal_stop_index = num_stops if is_loop else (num_stops - 1) # never reaches terminal_stop_index for loop routes
+        def print_sequences():
+            for sequence_key, sequence in possible_sequences.items():
+                row_indexes = sequence.get_row_indexes()
+                stop_indexes = [stop_index_values[row_index] for row_index in row_indexes]
+                print(f'{sequence_key}: {stop_indexes} {[row_index - group_start_index for row_index in row_indexes]}{f" ({sequence.num_loops} loops)" if is_loop else ""}')
+            print('-')
 
-    min_trip_length = min(3, num_stops)
-    max_small_gap_index_diff = 5
-    max_large_gap_seconds = 300
-    num_non_ascending_stop_indexes = 0
+        row_index = group_start_index
+        num_non_ascending_stop_indexes = 0
 
-    def finish_trip():
-        nonlocal row_index, next_trip, num_non_ascending_stop_indexes
+        def finish_trip():
+            nonlocal row_index, next_trip, num_non_ascending_stop_indexes
 
-        longest_sequence = None
-        for sequence in possible_sequences.values():
-            if longest_sequence is None:
-                if len(sequence.row_indexes) > 0:
-                    longest_sequence = sequence
-            else:
-                len_diff = len(sequence.row_indexes) - len(longest_sequence.row_indexes)
+            longest_sequence = None
+            for sequence in possible_sequences.values():
+                if longest_sequence is None:
+                    if sequence.length > 0:
+                        longest_sequence = sequence
+                else:
+                    len_diff = sequence.length - longest_sequence.length
 
-                # if multiple possible sequences have the same number of stops, choose the one that finishes first
-                if len_diff > 0 or (len_diff == 0 and sequence.row_indexes[-1] < longest_sequence.row_indexes[-1]):
-                    longest_sequence = sequence
+                    # if multiple possible sequences have the same number of stops, choose the one that finishes first
+                    if len_diff > 0 or (len_diff == 0 and sequence.last_row_index < longest_sequence.last_row_index):
+                        longest_sequence = sequence
 
-        num_non_ascending_stop_indexes = 0
+            num_non_ascending_stop_indexes = 0
 
-        if longest_sequence is not None:
+            if longest_sequence is not None:
 
-            if len(longest_sequence.row_indexes) >= min_trip_length:
+                trip_len = longest_sequence.length
 
-                trip_row_indexes = longest_sequence.row_indexes
+                if trip_len >= min_trip_length:
 
-                trip_len = len(trip_row_indexes)
+                    trip_row_indexes = longest_sequence.get_row_indexes()
 
-                if debug:
-                    print(f'trip {next_trip}:')
-                    print(f'{longest_sequence.stop_indexes}')
-                    print(f'{longest_sequence.row_indexes}')
-                    print('---')
+                    if debug:
+                        print(f'trip {next_trip}:')
+                        print(f'{[stop_index_values[i] for i in trip_row_indexes]}')
+                        print(f'{[i - group_start_index for i in trip_row_indexes]}')
+                        print('---')
 
-                all_row_indexes.extend(trip_row_indexes)
+                    all_row_indexes.extend(trip_row_indexes)
+                    trip_ids.extend([next_trip] * trip_len)
 
-                for i in range(trip_len):
-                    trip_ids.append(next_trip)
+                    next_trip += 1
 
-                next_trip += 1
+                if group_finish_points is not None and row_index < group_end_index:
+                    group_finish_points.append((row_index - group_start_index, longest_sequence.last_row_index + 1 - group_start_index))
 
-            # loop may have continued a few rows past the end of the longest sequence.
-            # in this case we back up the loop so it doesn't skip any rows
-            # (row_index will be incremented once after this)
-            row_index = longest_sequence.row_indexes[-1]
+                # loop may have continued a few rows past the end of the longest sequence.
+                # in this case we back up the loop so it doesn't skip any rows
+                # (row_index will be incremented once after this)
+                row_index = longest_sequence.last_row_index
 
-            reset_possible_sequences()
+                reset_possible_sequences()
 
-    while row_index < num_arrivals:
-        stop_index = stop_index_values[row_index]
-        arrival_time = arrival_time_values[row_index]
-        departure_time = departure_time_values[row_index]
+        while row_index < group_end_index:
+            stop_index = stop_index_values[row_index]
+            arrival_time = arrival_time_values[row_index]
+            departure_time = departure_time_values[row_index]
 
-        if debug:
-            print(f'row_index = {row_index} stop_index = {stop_index}')
+            if debug:
+                print(f'row_index = {row_index - group_start_index} stop_index = {stop_index}')
 
-        new_sequences = {}
-        updated_sequences = False
+            new_sequences = {}
+            updated_sequences = False
 
-        for sequence_key, sequence in possible_sequences.items():
-            last_stop_index = sequence.last_stop_index
+            for sequence_key, sequence in possible_sequences.items():
+                last_stop_index = sequence.last_stop_index
 
-            if last_stop_index is None:
-                updated_sequences = True
-                if stop_index == 0 or is_loop:
-                    sequence.append(row_index, stop_index, departure_time)
-                else:
-                    # if the first stop_index is not zero, leave an empty possible sequence
-                    # which can still accept smaller stop indexes.
-                    alt_sequence = sequence.copy()
-                    new_sequences[next_sequence_key] = alt_sequence
-                    next_sequence_key += 1
-                    sequence.append(row_index, stop_index, departure_time)
-            else:
-                index_diff = stop_index - last_stop_index
-                trip_time = arrival_time - sequence.last_departure_time
-
-                if is_loop and index_diff < 0:
-                    # make sure that index_diff is non-negative for loops so that
-                    # we continue appending to the same trip after completing a loop
-                    index_diff = (index_diff + num_stops) % num_stops
-
-                if trip_time <= 0:
-                    # arrival times within in a trip must be strictly ascending,
-                    # otherwise it wouldn't be possible to ensure the correct sort order
-                    # when displaying arrivals for a vehicle in order
-                    pass
-                elif index_diff == 1:
-                    # if stops appear in sequential order, just append to this sequence
-                    # without creating any more possibilities.
+                if last_stop_index is None:
                     updated_sequences = True
-                    sequence.append(row_index, stop_index, departure_time)
-                elif index_diff > 1 and (index_diff <= max_small_gap_index_diff or trip_time < max_large_gap_seconds):
-                    # if this arrival skipped one or more stops, create possibilities that
-                    # contain or don't contain this arrival
-                    updated_sequences = True
-                    alt_sequence = sequence.copy()
-                    new_sequences[next_sequence_key] = alt_sequence
-                    next_sequence_key += 1
-                    sequence.append(row_index, stop_index, departure_time)
-                elif index_diff == 0:
-                    # If there are two consecutive arrivals for the same vehicle at the same stop,
-                    # use the arrival with the smaller distance.
-                    last_row_index = sequence.row_indexes[-1]
-                    if dist_values[row_index] < dist_values[last_row_index]:
-                        sequence.row_indexes[-1] = row_index
-                        sequence.last_departure_time = departure_time
+                    if stop_index == 0 or is_loop:
+                        sequence.append(row_index, stop_index, departure_time)
+                    else:
+                        # if the first stop_index is not zero, leave an empty possible sequence
+                        # which can still accept smaller stop indexes.
+                        new_sequences[next_sequence_key] = sequence.copy()
+                        next_sequence_key += 1
+                        sequence.append(row_index, stop_index, departure_time)
+                else:
+                    index_diff = stop_index - last_stop_index
+                    trip_time = arrival_time - sequence.last_departure_time
+
+                    if is_loop and index_diff < 0:
+                        # make sure that index_diff is non-negative for loops so that
+                        # we continue appending to the same trip after completing a loop
+                        index_diff = (index_diff + num_stops) % num_stops
+
+                    if trip_time <= 0:
+                        # arrival times within in a trip must be strictly ascending,
+                        # otherwise it wouldn't be possible to ensure the correct sort order
+                        # when displaying arrivals for a vehicle in order
+                        pass
+                    elif index_diff == 1:
+                        # if stops appear in sequential order, just append to this sequence
+                        # without creating any more possibilities.
                         updated_sequences = True
-                        if debug:
-                            print(f"stop_index = {stop_index} dist[{row_index}] = {dist_values[row_index]}")
+                        sequence.append(row_index, stop_index, departure_time)
+                    elif index_diff > 1 and (index_diff <= max_small_gap_index_diff or trip_time < max_large_gap_seconds):
+                        # if this arrival skipped one or more stops, create possibilities that
+                        # contain or don't contain this arrival
+                        updated_sequences = True
+                        new_sequences[next_sequence_key] = sequence.copy()
+                        next_sequence_key += 1
+                        sequence.append(row_index, stop_index, departure_time)
+                    elif index_diff == 0:
+                        # If there are two consecutive arrivals for the same vehicle at the same stop,
+                        # use the arrival with the smaller distance.
+                        if dist_values[row_index] < dist_values[sequence.last_row_index]:
+                            sequence.replace_last(row_index, departure_time)
+                            updated_sequences = True
+                            if debug:
+                                print(f"stop_index = {stop_index} dist[{row_index - group_start_index}] = {dist_values[row_index]}")
+
+            if not updated_sequences:
+                num_non_ascending_stop_indexes += 1
 
-        if not updated_sequences:
-            num_non_ascending_stop_indexes += 1
+                if debug:
+                    print(f'no updated sequences, num_non_ascending_stop_indexes = {num_non_ascending_stop_indexes}')
 
-            if debug:
-                print(f'no updated sequences, num_non_ascending_stop_indexes = {num_non_ascending_stop_indexes}')
-
-            # as a heuristic that seems to work in practice without making things too slow,
-            # finish the current trip if 4 rows are processed without being able to extend any possible sequences.
-            # (SF Muni's 39-Coit sometimes has 3 rows with non-ascending stop indexes before another ascending stop index.)
-            if num_non_ascending_stop_indexes >= 4:
-                finish_trip()
-        else:
-            num_non_ascending_stop_indexes = 0
+                # as a heuristic that seems to work in practice without making things too slow,
+                # finish the current trip if 4 rows are processed without being able to extend any possible sequences.
+                # (SF Muni's 39-Coit sometimes has 3 rows with non-ascending stop indexes before another ascending stop index.)
+                if num_non_ascending_stop_indexes >= 4:
+                    finish_trip()
+            else:
+                num_non_ascending_stop_indexes = 0
 
-            possible_sequences.update(new_sequences)
+                possible_sequences.update(new_sequences)
 
-            if len(possible_sequences) > 1:
-                # If there are multiple possible sequences, remove sequences that appear to be worse than
-                # other sequences in order to avoid creating a large number of possible sequences
+                if len(possible_sequences) > 1:
+                    # If there are multiple possible sequences, remove sequences that appear to be worse than
+                    # other sequences in order to avoid creating a large number of possible sequences
 
-                if is_loop:
-                    # If this is a loop route, remove sequences with extra loops
-                    # (can happen in certain geometries due to passing stops out of order, like TriMet route 50)
-                    min_loops_by_stop_index = {}
-                    for sequence_key, sequence in possible_sequences.items():
-                        num_loops = sequence.num_loops
-                        last_stop_index = sequence.last_stop_index
+                    if is_loop:
+                        # If this is a loop route, remove sequences with extra loops
+                        # (can happen in certain geometries due to passing stops out of order, like TriMet route 50)
+                        min_loops_by_stop_index = {}
+                        for sequence in possible_sequences.values():
+                            num_loops = sequence.num_loops
+                            last_stop_index = sequence.last_stop_index
 
-                        if last_stop_index not in min_loops_by_stop_index:
-                            min_loops_by_stop_index[last_stop_index] = num_loops
-                        else:
-                            best_num_loops = min_loops_by_stop_index[last_stop_index]
-                            if num_loops < best_num_loops:
+                            if last_stop_index not in min_loops_by_stop_index:
+                                min_loops_by_stop_index[last_stop_index] = num_loops
+                            elif num_loops < min_loops_by_stop_index[last_stop_index]:
                                 min_loops_by_stop_index[last_stop_index] = num_loops
 
-                    extra_loop_sequence_keys = []
-                    for sequence_key, sequence in possible_sequences.items():
-                        if min_loops_by_stop_index[sequence.last_stop_index] < sequence.num_loops:
-                            extra_loop_sequence_keys.append(sequence_key)
+                        extra_loop_sequence_keys = [
+                            sequence_key for sequence_key, sequence in possible_sequences.items()
+                            if min_loops_by_stop_index[sequence.last_stop_index] < sequence.num_loops
+                        ]
+
+                        for sequence_key in extra_loop_sequence_keys:
+                            del possible_sequences[sequence_key]
+
+                    terminal_sequence_keys = []
+
+                    longest_sequence_len = 0
+                    for sequence in possible_sequences.values():
+                        if sequence.length > longest_sequence_len:
+                            longest_sequence_len = sequence.length
+
+                    # Construct a dict of sequence length => key in the `possible_sequences` dict
+                    # for the sequence of that length (or longer) with the smallest last_stop_index value.
+                    # These are the keys of the sequences we want to keep.
+                    #
+                    # Suppose the possible arrivals have the stop indexes [1,3,5] and the
+                    # possible sequences are:
+                    #
+                    # 0: [1, 3, 5]
+                    # 2: [1, 5]
+                    # 3: [5]
+                    # 4: [1, 3]
+                    # 5: [1]
+                    # 6: []
+                    #
+                    # There is only one sequence of length 3 or more, with key 0.
+                    # There are two sequences of length 2 or more, with keys 0, 2, and 4 (key 4 has the smallest last stop index).
+                    # There are two sequences of length 1 or more, with keys 0, 2, 3, and 5 (key 5 has the smallest last stop index).
+                    # There is one sequence of length 0, with key 6.
+                    #
+                    # smallest_last_index_keys_by_length should end up like this:
+                    # {0: 6, 1: 5, 2: 4, 3: 0}
+                    #
+                    # This indicates that we can remove the sequences 2 and 3 (which are not in the values)
+                    # since the sequences [5] and [1,5] are guaranteed to be worse than the sequence [1,3,5].
+                    #
+                    # The sequence [1,3] is kept because we might see 4,5 in the future.
+                    # The sequence [1] is kept because we might see 2,3,4,5 in the future.
+                    # The sequence [] is kept because we might see 0,1,2,3,4,5 in the future.
+
+                    smallest_last_index_keys_by_length = {}
+
+                    # as a heuristic to avoid losing long but incomplete sequences (e.g. missing stop index 0),
+                    # avoid creating new sequences that are much shorter than the best sequence
+                    min_sequence_len = max(0, longest_sequence_len - 3)
 
-                    for sequence_key in extra_loop_sequence_keys:
-                        del possible_sequences[sequence_key]
+                    for sequence_key, sequence in possible_sequences.items():
+                        sequence_len = sequence.length
 
-                terminal_sequence_keys = []
+                        if sequence_len < min_sequence_len:
+                            continue
 
-                longest_sequence_len = 0
-                for sequence in possible_sequences.values():
-                    sequence_len = len(sequence.row_indexes)
-                    if sequence_len > longest_sequence_len:
-                        longest_sequence_len = sequence_len
-
-                # Construct a dict of sequence length => key in the `possible_sequences` dict
-                # for the sequence of that length (or longer) with the smallest last_stop_index value.
-                # These are the keys of the sequences we want to keep.
-                #
-                # Suppose the possible arrivals have the stop indexes [1,3,5] and the
-                # possible sequences are:
-                #
-                # 0: [1, 3, 5]
-                # 2: [1, 5]
-                # 3: [5]
-                # 4: [1, 3]
-                # 5: [1]
-                # 6: []
-                #
-                # There is only one sequence of length 3 or more, with key 0.
-                # There are two sequences of length 2 or more, with keys 0, 2, and 4 (key 4 has the smallest last stop index).
-                # There are two sequences of length 1 or more, with keys 0, 2, 3, and 5 (key 5 has the smallest last stop index).
-                # There is one sequence of length 0, with key 6.
-                #
-                # smallest_last_index_keys_by_length should end up like this:
-                # {0: 6, 1: 5, 2: 4, 3: 0}
-                #
-                # This indicates that we can remove the sequences 2 and 3 (which are not in the values)
-                # since the sequences [5] and [1,5] are guaranteed to be worse than the sequence [1,3,5].
-                #
-                # The sequence [1,3] is kept because we might see 4,5 in the future.
-                # The sequence [1] is kept because we might see 2,3,4,5 in the future.
-                # The sequence [] is kept because we might see 0,1,2,3,4,5 in the future.
-
-                smallest_last_index_keys_by_length = {}
-
-                # as a heuristic to avoid losing long but incomplete sequences (e.g. missing stop index 0),
-                # avoid creating new sequences that are much shorter than the best sequence
-                min_sequence_len = max(0, longest_sequence_len - 3)
-
-                for sequence_key, sequence in possible_sequences.items():
-                    sequence_len = len(sequence.row_indexes)
-
-                    if sequence_len < min_sequence_len:
-                        continue
-
-                    last_stop_index = sequence.last_stop_index
-
-                    if last_stop_index == terminal_stop_index:
-                        terminal_sequence_keys.append(sequence_key)
-
-                    if sequence_len == 0:
-                        smallest_last_index_keys_by_length[sequence_len] = sequence_key
-                    else:
-                        for seq_len in range(min_sequence_len, sequence_len+1):
-                            if seq_len not in smallest_last_index_keys_by_length:
-                                smallest_last_index_keys_by_length[seq_len] = sequence_key
-                            else:
-                                smallest_last_index_key = smallest_last_index_keys_by_length[seq_len]
-                                best_sequence = possible_sequences[smallest_last_index_key]
-
-                                # For loop routes, different sequences may contain a different number of loops.
-                                # In this case, the one with the smallest last_stop_index for a particular length
-                                # isn't necessarily the best one, since it may contain more loops than another sequence.
-                                # To handle this case, add the total number of stops in each loop for each sequence.
-                                total_stops = num_stops * sequence.num_loops + last_stop_index
-                                best_total_stops = num_stops * best_sequence.num_loops + best_sequence.last_stop_index
-
-                                if total_stops < best_total_stops:
-                                    smallest_last_index_keys_by_length[seq_len] = sequence_key
+                        last_stop_index = sequence.last_stop_index
 
-                unneded_sequence_keys = set(possible_sequences.keys()) - set(smallest_last_index_keys_by_length.values())
+                        if last_stop_index == terminal_stop_index:
+                            terminal_sequence_keys.append(sequence_key)
 
-                if debug:
-                    print(smallest_last_index_keys_by_length)
+                        if sequence_len == 0:
+                            smallest_last_index_keys_by_length[sequence_len] = sequence_key
+                        else:
+                            # For loop routes, different sequences may contain a different number of loops.
+                            # In this case, the one with the smallest last_stop_index for a particular length
+                            # isn't necessarily the best one, since it may contain more loops than another sequence.
+                            # To handle this case, add the total number of stops in each loop for each sequence.
+                            total_stops = num_stops * sequence.num_loops + last_stop_index
+
+                            for seq_len in range(min_sequence_len, sequence_len+1):
+                                if seq_len not in smallest_last_index_keys_by_length:
+                                    smallest_last_index_keys_by_length[seq_len] = sequence_key
+                                else:
+                                    best_sequence = possible_sequences[smallest_last_index_keys_by_length[seq_len]]
+                                    best_total_stops = num_stops * best_sequence.num_loops + best_sequence.last_stop_index
 
-                # if a possible sequence ends in a terminal, keep it as a possibility even if
-                # there is another sequence of the same length that ends before the terminal. this is needed to
-                # avoid losing the terminal sequence if we only see the second-to-last stop *after* seeing the terminal
-                # (which happens sometimes with with the 39-Coit at Coit Tower)
-                if len(terminal_sequence_keys) > 0:
-                    unneded_sequence_keys = unneded_sequence_keys - set(terminal_sequence_keys)
+                                    if total_stops < best_total_stops:
+                                        smallest_last_index_keys_by_length[seq_len] = sequence_key
 
-                for sequence_key in unneded_sequence_keys:
-                    del possible_sequences[sequence_key]
+                    unneded_sequence_keys = set(possible_sequences.keys()) - set(smallest_last_index_keys_by_length.values())
 
-            all_terminals = True
-            for sequence in possible_sequences.values():
-                if sequence.last_stop_index is None or sequence.last_stop_index < terminal_stop_index:
-                    all_terminals = False
-                    break
+                    if debug:
+                        print(smallest_last_index_keys_by_length)
 
-            # if all possible sequences end in a terminal, choose the best one as the actual trip.
-            if all_terminals:
-                finish_trip()
+                    # if a possible sequence ends in a terminal, keep it as a possibility even if
+                    # there is another sequence of the same length that ends before the terminal. this is needed to
+                    # avoid losing the terminal sequence if we only see the second-to-last stop *after* seeing the terminal
+                    # (which happens sometimes with with the 39-Coit at Coit Tower)
+                    if len(terminal_sequence_keys) > 0:
+                        unneded_sequence_keys = unneded_sequence_keys - set(terminal_sequence_keys)
 
-        if debug:
-            print_sequences()
+                    for sequence_key in unneded_sequence_keys:
+                        del possible_sequences[sequence_key]
 
-        row_index += 1
+                all_terminals = True
+                for sequence in possible_sequences.values():
+                    if sequence.last_stop_index is None or sequence.last_stop_index < terminal_stop_index:
+                        all_terminals = False
+                        break
 
-    finish_trip()
+                # if all possible sequences end in a terminal, choose the best one as the actual trip.
+                if all_terminals:
+                    finish_trip()
 
-    ascending_dir_arrivals = dir_arrivals.iloc[all_row_indexes].copy()
+            if debug:
+                print_sequences()
 
-    ascending_dir_arrivals['TRIP'] = trip_ids
+            row_index += 1
 
-    if debug:
-        with pd.option_context("display.max_rows", None):
-            print(ascending_dir_arrivals)
+        finish_trip()
 
-    return ascending_dir_arrivals, next_trip
+    return np.array(all_row_indexes, dtype=np.int64), np.array(trip_ids, dtype=np.int64), next_trip
 
 def add_missing_arrivals_for_vehicle_direction(
     dir_arrivals: pd.DataFrame,
@@ -827,18 +1152,68 @@ def add_missing_arrivals_for_vehicle_direction(
     route_config: routeconfig.RouteConfig
 ) -> pd.DataFrame:
 
+    # Returns the data frame of arrivals for one vehicle in one direction (sorted by time)
+    # with arrivals at missing stops added by find_missing_arrivals_for_vehicle_direction.
+
+    num_arrivals = len(dir_arrivals)
+
+    if num_arrivals < 1:
+        return make_arrivals_frame([])
+
+    missing_arrivals = find_missing_arrivals_for_vehicle_direction(
+        dir_arrivals['STOP_INDEX'].values,
+        dir_arrivals['TIME'].values,
+        dir_arrivals['DEPARTURE_TIME'].values,
+        dir_arrivals['TRIP'].values,
+        vehicle_id,
+        direction_id,
+        bus,
+        route_config
+    )
+
+    if len(missing_arrivals) == 0:
+        return dir_arrivals
+
+    all_arrivals = [dir_arrivals]
+
+    row_index_after_prev_gap_arrival = 0
+    num_gap_arrivals = 0
+    new_row_indexes = []
+
+    for i, gap_arrival in missing_arrivals:
+        all_arrivals.append(gap_arrival)
+        new_row_indexes.extend(range(row_index_after_prev_gap_arrival, i))
+        new_row_indexes.append(num_arrivals + num_gap_arrivals)
+        row_index_after_prev_gap_arrival = i
+        num_gap_arrivals += 1
+
+    new_row_indexes.extend(range(row_index_after_prev_gap_arrival, num_arrivals))
+
+    return pd.concat(all_arrivals, sort=False).iloc[new_row_indexes]
+
+def find_missing_arrivals_for_vehicle_direction(
+    stop_index_values: np.ndarray,
+    time_values: np.ndarray,
+    departure_time_values: np.ndarray,
+    trip_values: np.ndarray,
+    vehicle_id: str,
+    direction_id: str,
+    bus: pd.DataFrame,
+    route_config: routeconfig.RouteConfig
+) -> list:
+
     # If there is a small gap in STOP_INDEX, try looking for the missing stops
     # between the last departure time and the next arrival time. Maybe the radius
     # was too small or we never saw it closer to that stop than the prev/next stop.
-
-    stop_index = dir_arrivals['STOP_INDEX']
-
-    stop_index_values = stop_index.values
+    #
+    # Given arrays for the arrivals of one vehicle in one direction (sorted by time),
+    # returns a list of (i, gap_arrival) tuples, where gap_arrival is a data frame with one arrival
+    # that should be inserted before the i-th arrival (in order).
 
     num_arrivals = len(stop_index_values)
 
     if num_arrivals < 1:
-        return make_arrivals_frame([])
+        return []
 
     prev_stop_index_values = np.r_[999999, stop_index_values[:-1]]
 
@@ -847,11 +1222,10 @@ def add_missing_arrivals_for_vehicle_direction(
     gaps_values = stop_index_diff_values > 1
 
     if not np.any(gaps_values):
-        return dir_arrivals
+        return []
 
     # only fix gaps of 1 or 2 stops, with less than a few minutes gap
-    prev_departure_time_values = np.r_[0, dir_arrivals['DEPARTURE_TIME'].values[:-1]]
-    time_values = dir_arrivals['TIME'].values
+    prev_departure_time_values = np.r_[0, departure_time_values[:-1]]
 
     gap_time_values = time_values - prev_departure_time_values
 
@@ -867,23 +1241,16 @@ def add_missing_arrivals_for_vehicle_direction(
     )
 
     if not np.any(fixable_gaps_values):
-        return dir_arrivals
+        return []
 
     dir_info = route_config.get_direction_info(direction_id)
     dir_stops = dir_info.get_stop_ids()
 
-    all_arrivals = [dir_arrivals]
-
-    row_index_after_prev_gap_arrival = 0
-    num_gap_arrivals = 0
-    new_row_indexes = []
+    missing_arrivals = []
 
     fixable_gap_indexes = np.nonzero(fixable_gaps_values)[0]
 
     all_time_values = bus['TIME'].values
-    num_all_time_values = len(all_time_values)
-
-    trip_values = dir_arrivals['TRIP'].values
 
     for i in fixable_gap_indexes:
         next_arrival_time = time_values[i]
@@ -914,7 +1281,8 @@ def add_missing_arrivals_for_vehicle_direction(
                 return get_possible_arrivals_for_stop(gap_bus, gap_stop_id,
                     direction_id=direction_id,
                     stop_index=gap_stop_index,
-                    radius=300
+                    radius=300,
+                    route_config=route_config
                 )
 
             gap_arrival = find_gap_arrival()
@@ -940,15 +1308,6 @@ def add_missing_arrivals_for_vehicle_direction(
 
             gap_arrival['TRIP'] = trip_values[i]
 
-            all_arrivals.append(gap_arrival)
-            new_row_indexes.extend(range(row_index_after_prev_gap_arrival, i))
-            new_row_indexes.append(num_arrivals + num_gap_arrivals)
-            row_index_after_prev_gap_arrival = i
-            num_gap_arrivals += 1
-
-    if len(all_arrivals) == 1:
-        return dir_arrivals
-
-    new_row_indexes.extend(range(row_index_after_prev_gap_arrival, num_arrivals))
+            missing_arrivals.append((i, gap_arrival))
 
-    return pd.concat(all_arrivals, sort=False).iloc[new_row_indexes]
+    return missing_arrivals
@@ -0,0 +1,208 @@
+import csv
+import json
+import os
+import time
+import tracemalloc
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from . import config, util
+
+# Instrumentation for command line scripts that compute arrivals, download state and compute stats.
+#
+# A script calls start_report() once, then the code it calls records how long each stage takes
+# (`with instrumentation.stage('resample_buses', route=route_id):`) and counts things
+# (`instrumentation.count('arrivals', len(arrivals), route=route_id)`), with labels such as the route and date.
+# At the end, the script calls save_report() to write all records to a JSON or CSV file,
+# so that runs can be compared to find the routes and stages that became slower.
+#
+# If no report was started (e.g. in the API server or in tests), stage() and count() don't record anything.
+
+class RunReport:
+    def __init__(self, name, trace_memory=False):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.start_time = time.time()
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, **labels):
+        start_memory = tracemalloc.get_traced_memory()[0] if self.trace_memory else None
+        t1 = time.time()
+        try:
+            yield
+        finally:
+            record = {'type': 'stage', 'name': name, **labels, 'seconds': round(time.time() - t1, 4)}
+            if start_memory is not None:
+                current_memory, peak_memory = tracemalloc.get_traced_memory()
+                record['memory_mb'] = round((current_memory - start_memory) / 1024 / 1024, 2)
+                record['peak_memory_mb'] = round(peak_memory / 1024 / 1024, 2)
+            self.records.append(record)
+
+    def count(self, name, value=1, **labels):
+        self.records.append({'type': 'counter', 'name': name, **labels, 'value': value})
+
+    def snapshot_memory(self, name, limit=10, **labels):
+        # records the lines of code that allocated the most memory that is still in use (if tracing memory)
+        if not self.trace_memory:
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        for stat in snapshot.statistics('lineno')[:limit]:
+            frame = stat.traceback[0]
+            self.records.append({
+                'type': 'memory',
+                'name': name,
+                **labels,
+                'location': f'{frame.filename}:{frame.lineno}',
+                'memory_mb': round(stat.size / 1024 / 1024, 2),
+                'value': stat.count,
+            })
+
+    def add_records(self, records):
+        self.records.extend(records)
+
+    def get_summary(self) -> dict:
+        # total seconds for each stage and total value of each counter, for all labels
+        stages = {}
+        counters = {}
+        for record in self.records:
+            if record['type'] == 'stage':
+                stage_summary = stages.setdefault(record['name'], {'count': 0, 'seconds': 0})
+                stage_summary['count'] += 1
+                stage_summary['seconds'] = round(stage_summary['seconds'] + record['seconds'], 4)
+            elif record['type'] == 'counter':
+                counters[record['name']] = counters.get(record['name'], 0) + record['value']
+
+        return {'stages': stages, 'counters': counters}
+
+    def get_data(self) -> dict:
+        return {
+            'name': self.name,
+            'start_time': round(self.start_time, 3),
+            'seconds': round(time.time() - self.start_time, 3),
+            'peak_rss_mb': util.get_peak_rss_mb(),
+            'summary': self.get_summary(),
+            'records': self.records,
+        }
+
+    def save(self, path):
+        # saves the report as CSV (one row per record) if path ends with .csv, otherwise as JSON
+        report_dir = Path(path).parent
+        if not report_dir.exists():
+            report_dir.mkdir(parents = True, exist_ok = True)
+
+        if str(path).endswith('.csv'):
+            columns = []
+            for record in self.records:
+                for key in record:
+                    if key not in columns:
+                        columns.append(key)
+
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=['run'] + columns)
+                writer.writeheader()
+                for record in self.records:
+                    writer.writerow({'run': self.name, **record})
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.get_data(), f)
+
+current_report = None
+
+def start_report(name, trace_memory=False) -> RunReport:
+    global current_report
+
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    current_report = RunReport(name, trace_memory)
+    return current_report
+
+def get_report() -> RunReport:
+    return current_report
+
+def get_report_path(report: RunReport) -> str:
+    # default path of the report in the directory from the OPENTRANSIT_REPORT_DIR environment variable,
+    # or None if it is not set
+    if config.report_dir is None:
+        return None
+
+    time_str = datetime.fromtimestamp(report.start_time).strftime('%Y%m%d-%H%M%S')
+    return os.path.join(config.report_dir, f'{report.name}_{time_str}_{os.getpid()}.json')
+
+def save_report(path=None):
+    report = current_report
+    if report is None:
+        return
+
+    if path is None:
+        path = get_report_path(report)
+        if path is None:
+            return
+
+    print(f'saving run report to {path}')
+    report.save(path)
+
+@contextmanager
+def stage(name, **labels):
+    if current_report is None:
+        yield
+    else:
+        with current_report.stage(name, **labels):
+            yield
+
+def count(name, value=1, **labels):
+    if current_report is not None:
+        current_report.count(name, value, **labels)
+
+def snapshot_memory(name, **labels):
+    if current_report is not None:
+        current_report.snapshot_memory(name, **labels)
+
+def add_report_arguments(parser):
+    # adds command line arguments for saving a report to an argparse.ArgumentParser
+    parser.add_argument('--report', help='path of JSON or CSV file to write timings and counters for this run '
+        '(default: a JSON file in $OPENTRANSIT_REPORT_DIR, if set)')
+    parser.add_argument('--trace-memory', dest='trace_memory', action='store_true',
+        help='record memory allocated in each stage in the report (slower)')
+    parser.set_defaults(trace_memory=False)
+
+def call_with_report(name, trace_memory, fn, args):
+    # runs fn(*args) in a worker process with a separate report, returning the result and the recorded records
+    global current_report
+
+    prev_report = current_report
+    report = start_report(name, trace_memory)
+    try:
+        result = fn(*args)
+    finally:
+        current_report = prev_report
+
+    return result, report.records
+
+def submit(executor, fn, *args) -> Future:
+    '''
+    Like executor.submit(fn, *args), but if a report was started and executor is a ProcessPoolExecutor,
+    the records from the worker process are added to the report when fn finishes.
+    (Functions running in other threads of this process add records to the report directly.)
+    '''
+    report = current_report
+    if report is None or not isinstance(executor, ProcessPoolExecutor):
+        return executor.submit(fn, *args)
+
+    future = Future()
+
+    def on_done(worker_future):
+        try:
+            result, records = worker_future.result()
+        except BaseException as err:
+            future.set_exception(err)
+        else:
+            report.add_records(records)
+            future.set_result(result)
+
+    executor.submit(call_with_report, report.name, report.trace_memory, fn, args).add_done_callback(on_done)
+
+    return future
@@ -1,8 +1,11 @@
+import os
 import pytz
 import sys
 import time
-from datetime import date
-from . import wait_times, util, arrival_history, trip_times, constants, timetables, routeconfig, config, precomputed_stats
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import partial
+from . import wait_times, util, arrival_history, trip_times, constants, timetables, routeconfig, config, precomputed_stats, cache
 
 import pandas as pd
 import numpy as np
@@ -16,12 +19,32 @@ class Range:
         self.end_time_str = end_time_str        # if None, no end time filter
         self.tz = tz
 
+    def get_key(self) -> tuple:
+        # tuple of the time range and time zone name for cache keys
+        return (self.start_time_str, self.end_time_str, self.tz.zone if self.tz is not None else None)
+
+    def get_day_windows(self, dates=None) -> tuple:
+        # returns a tuple of arrays with the start and end timestamps of the time range on each date
+        # (or None instead of an array if there is no start/end time), computed for all dates at once
+        if dates is None:
+            dates = self.dates
+        return (
+            util.get_timestamps_or_none(dates, self.start_time_str, self.tz),
+            util.get_timestamps_or_none(dates, self.end_time_str, self.tz),
+        )
+
+# Arrival histories, timetables, data frames, precomputed stats and metrics computed by RouteMetrics and AgencyMetrics
+# are cached in memory for all requests in this process (in the shared cache, up to config.metrics_cache_mb and
+# config.metrics_cache_max_files memory-mapped files), with tuple keys
+# starting with the type of data, the agency ID, the route ID (or stat ID) and the date.
+metrics_cache = cache.shared_cache
+
 # RouteMetrics allows computing various metrics for a particular route,
 # such as headways, wait times, and trip times,
 # including over various date and time ranges.
 #
-# It caches the arrival history and data frames so that the different
-# metrics calculations can reuse the same arrivals data without
+# It caches the arrival history, data frames and metrics for each date (in metrics_cache)
+# so that the different metrics calculations can reuse the same arrivals data without
 # needing to reload it from disk each time.
 #
 class RouteMetrics:
@@ -29,82 +52,155 @@ class RouteMetrics:
         self.agency_metrics = agency_metrics
         self.agency_id = agency_metrics.agency_id
         self.route_id = route_id
-        self.arrival_histories = {}
-        self.data_frames = {}
-        self.timetables = {}
-        self.wait_time_stats = {}
-        self.trip_times = {}
-        self.schedule_adherence = {}
-        self.headways = {}
-        self.counts = {}
-        self.headway_schedule_deltas = {}
 
     def get_arrival_history(self, d):
-        if d in self.arrival_histories:
-            return self.arrival_histories[d]
+        key = ('arrival_history', self.agency_id, self.route_id, d)
+        cache_path = arrival_history.get_cache_path(self.agency_id, self.route_id, d)
+
+        entry = metrics_cache.get(key)
+        if entry is not None:
+            history, mtime = entry
+            # arrival histories for recent dates (or that were not found) are loaded again if they were saved since then,
+            # e.g. by compute_new.py
+            if (history is None or self.agency_metrics.is_recent_date(d)) and get_file_mtime(cache_path) != mtime:
+                self.remove_cached_data(d)
+            else:
+                return history if history is not None else arrival_history.ArrivalHistory(self.agency_id, self.route_id, {})
 
         print(f'loading arrival history for route {self.route_id} on {d}', file=sys.stderr)
 
+        mtime = get_file_mtime(cache_path)
+
         try:
-            self.arrival_histories[d] = history = arrival_history.get_by_date(self.agency_id, self.route_id, d)
+            history = arrival_history.get_by_date(self.agency_id, self.route_id, d)
+            # convert the arrivals to numpy arrays now so that their size is included in the cache
+            history.get_columns()
         except FileNotFoundError as ex:
             print(f'Arrival history not found for route {self.route_id} on {d}', file=sys.stderr)
-            history = arrival_history.ArrivalHistory(self.agency_id, self.route_id, {});
-        return history
+            history = None
+
+        metrics_cache.set(key, (history, mtime))
+
+        return history if history is not None else arrival_history.ArrivalHistory(self.agency_id, self.route_id, {})
+
+    def remove_cached_data(self, d):
+        # removes arrival histories, data frames and stats for this route for date d from the cache
+        metrics_cache.remove_where(lambda key: key[0] != 'precomputed_stats' and key[1:4] == (self.agency_id, self.route_id, d))
+
+    def check_cached_data(self, dates):
+        # removes cached data for recent dates if the arrival history was saved again since it was loaded,
+        # so that stats are computed again from the new arrival history
+        for d in dates:
+            if self.agency_metrics.is_recent_date(d):
+                entry = metrics_cache.get(('arrival_history', self.agency_id, self.route_id, d))
+                if entry is not None and get_file_mtime(arrival_history.get_cache_path(self.agency_id, self.route_id, d)) != entry[1]:
+                    self.remove_cached_data(d)
+
+    def prefetch(self, dates, arrival_histories=True, timetables=False):
+        '''
+        Loads the arrival histories (and/or timetables) for multiple dates concurrently, so that metrics for a range of dates
+        don't need to download each file from S3 one at a time when it is not cached locally.
+        '''
+        self.check_cached_data(dates)
+
+        fns = []
+
+        if arrival_histories:
+            fns.extend(
+                partial(self.get_arrival_history, d) for d in dates
+                if ('arrival_history', self.agency_id, self.route_id, d) not in metrics_cache
+            )
 
-    def get_history_data_frame(self, d, direction_id=None, stop_id=None):
-        key = f'history_{str(d)}_{stop_id}_{direction_id}'
+        missing_timetable_dates = [
+            d for d in dates if ('timetable', self.agency_id, self.route_id, d) not in metrics_cache
+        ] if timetables else []
+        if len(missing_timetable_dates) > 0:
+            # multiple dates may use the same timetable file, which should only be downloaded once.
+            # if the date keys can't be loaded, the timetables can't be loaded either (the error is raised when they are used)
+            try:
+                date_keys = self.agency_metrics.get_date_keys()
+            except Exception as ex:
+                date_keys = None
+
+            if date_keys is not None:
+                dates_by_key = {}
+                for d in missing_timetable_dates:
+                    # dates without a date key use the most recent timetable for the same day of the week
+                    date_key = date_keys.get(str(d), f'weekday-{d.isoweekday()}')
+                    dates_by_key.setdefault(date_key, []).append(d)
 
-        if key in self.data_frames:
-            return self.data_frames[key]
+                for key_dates in dates_by_key.values():
+                    fns.append(partial(self.get_timetables, key_dates))
 
+        fetch_concurrently(fns)
+
+    def get_timetables(self, dates):
+        return [self.get_timetable(d) for d in dates]
+
+    def get_history_data_frame(self, d, direction_id=None, stop_id=None):
         history = self.get_arrival_history(d)
 
-        print(f'loading data frame {key} for route {self.route_id}', file=sys.stderr)
+        # arrival histories loaded from memory-mapped columnar files are shared by all processes (e.g. gunicorn workers),
+        # so data frames are created from views of the arrays when needed, instead of keeping a copy in each process
+        if history.is_memory_mapped():
+            return history.get_data_frame(stop_id=stop_id, direction_id=direction_id)
+
+        key = ('history_data_frame', self.agency_id, self.route_id, d, stop_id, direction_id)
+
+        df = metrics_cache.get(key)
+        if df is None:
+            print(f'loading data frame {key} for route {self.route_id}', file=sys.stderr)
+
+            df = metrics_cache.set(key, history.get_data_frame(stop_id=stop_id, direction_id=direction_id))
 
-        df = history.get_data_frame(stop_id=stop_id, direction_id=direction_id)
-        self.data_frames[key] = df
         return df
 
     def get_timetable(self, d):
-        if d not in self.timetables.keys():
-            self.timetables[d] = timetables.get_by_date(self.agency_id, self.route_id, d)
+        key = ('timetable', self.agency_id, self.route_id, d)
 
-        return self.timetables[d]
+        timetable = metrics_cache.get(key)
+        if timetable is None:
+            timetable = metrics_cache.set(key, timetables.get_by_date(self.agency_id, self.route_id, d))
+
+        return timetable
 
     def get_timetable_data_frame(self, d, direction_id=None, stop_id=None):
         timetable = self.get_timetable(d)
 
-        timetable_key = f'timetable_{str(d)}_{stop_id}_{direction_id}'
+        if timetable.is_memory_mapped():
+            return timetable.get_data_frame(stop_id=stop_id, direction_id=direction_id)
 
-        if timetable_key not in self.data_frames:
-            self.data_frames[timetable_key] = timetable.get_data_frame(stop_id=stop_id, direction_id=direction_id)
+        key = ('timetable_data_frame', self.agency_id, self.route_id, d, stop_id, direction_id)
 
-        return self.data_frames[timetable_key]
+        df = metrics_cache.get(key)
+        if df is None:
+            df = metrics_cache.set(key, timetable.get_data_frame(stop_id=stop_id, direction_id=direction_id))
 
-    def get_wait_time_stats(self, direction_id, stop_id, rng: Range, scheduled=False):
-        wait_stats_arr = []
+        return df
 
+    def get_wait_time_stats(self, direction_id, stop_id, rng: Range, scheduled=False):
         get_data_frame = self.get_timetable_data_frame if scheduled else self.get_history_data_frame
 
-        for d in rng.dates:
-            key = f'{direction_id}-{stop_id}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}-{scheduled}'
+        self.prefetch(rng.dates, arrival_histories=not scheduled, timetables=scheduled)
 
-            if key not in self.wait_time_stats:
-                #print(f'_get_wait_time_stats {key}', file=sys.stderr)
+        def get_key(d):
+            return ('wait_time_stats', self.agency_id, self.route_id, d, direction_id, stop_id, *rng.get_key(), scheduled)
 
-                start_time = util.get_timestamp_or_none(d, rng.start_time_str, rng.tz)
-                end_time = util.get_timestamp_or_none(d, rng.end_time_str, rng.tz)
+        wait_stats_by_date = {d: metrics_cache.get(get_key(d)) for d in rng.dates}
+
+        missing_dates = [d for d in rng.dates if wait_stats_by_date[d] is None]
+        if len(missing_dates) > 0:
+            start_times, end_times = rng.get_day_windows(missing_dates)
 
+            for i, d in enumerate(missing_dates):
                 df = get_data_frame(d, stop_id=stop_id, direction_id=direction_id)
 
                 departure_time_values = np.sort(df['DEPARTURE_TIME'].values)
 
-                wait_stats = wait_times.get_stats(departure_time_values, start_time, end_time)
+                wait_stats_by_date[d] = metrics_cache.set(get_key(d), wait_times.get_stats(departure_time_values,
+                    get_day_window_value(start_times, i), get_day_window_value(end_times, i)))
 
-                self.wait_time_stats[key] = wait_stats
-
-            wait_stats_arr.append(self.wait_time_stats[key])
+        wait_stats_arr = [wait_stats_by_date[d] for d in rng.dates]
 
         if len(wait_stats_arr) == 1:
             return wait_stats_arr[0]
@@ -115,31 +211,28 @@ class RouteMetrics:
         if stop_id is None:
             return None
 
-        count = 0
-
         get_data_frame = self.get_timetable_data_frame if scheduled else self.get_history_data_frame
 
-        for d in rng.dates:
-            key = f'{direction_id}-{stop_id}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}-{scheduled}-{time_field}'
-            if key not in self.counts:
-                #print(f'_get_count {key}', file=sys.stderr)
+        self.prefetch(rng.dates, arrival_histories=not scheduled, timetables=scheduled)
 
-                df = get_data_frame(d, direction_id=direction_id, stop_id=stop_id)
+        def get_key(d):
+            return ('count', self.agency_id, self.route_id, d, direction_id, stop_id, *rng.get_key(), scheduled, time_field)
 
-                start_time = util.get_timestamp_or_none(d, rng.start_time_str, rng.tz)
-                end_time = util.get_timestamp_or_none(d, rng.end_time_str, rng.tz)
+        counts_by_date = {d: metrics_cache.get(get_key(d)) for d in rng.dates}
 
-                if start_time is not None:
-                    df = df[df[time_field] >= start_time]
+        missing_dates = [d for d in rng.dates if counts_by_date[d] is None]
+        if len(missing_dates) > 0:
+            time_values_arr = [
+                get_data_frame(d, direction_id=direction_id, stop_id=stop_id)[time_field].values
+                for d in missing_dates
+            ]
 
-                if end_time is not None:
-                    df = df[df[time_field] < end_time]
-
-                self.counts[key] = len(df)
+            day_counts = count_by_day(time_values_arr, *rng.get_day_windows(missing_dates))
 
-            count += self.counts[key]
+            for d, day_count in zip(missing_dates, day_counts):
+                counts_by_date[d] = metrics_cache.set(get_key(d), int(day_count))
 
-        return count
+        return sum(counts_by_date[d] for d in rng.dates)
 
     def _get_schedule_adherence(self, direction_id, stop_id, early_sec, late_sec, rng: Range, time_field):
         if stop_id is None:
@@ -149,9 +242,13 @@ class RouteMetrics:
 
         now = time.time()
 
+        self.prefetch(rng.dates, timetables=True)
+
         for d in rng.dates:
-            key = f'{direction_id}-{stop_id}-{early_sec}-{late_sec}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}-{time_field}'
-            if key not in self.schedule_adherence:
+            key = ('schedule_adherence', self.agency_id, self.route_id, d, direction_id, stop_id, early_sec, late_sec, *rng.get_key(), time_field)
+
+            comparison_df = metrics_cache.get(key)
+            if comparison_df is None:
                 #print(f'_get_schedule_adherence {key}', file=sys.stderr)
 
                 stop_timetable = self.get_timetable_data_frame(d, direction_id=direction_id, stop_id=stop_id)
@@ -180,9 +277,11 @@ class RouteMetrics:
                 if end_time is not None:
                     comparison_df = comparison_df[comparison_df[time_field] < end_time]
 
-                self.schedule_adherence[key] = comparison_df
+                # results for recent dates depend on the current time, so they are not cached
+                if not self.agency_metrics.is_recent_date(d):
+                    metrics_cache.set(key, comparison_df)
 
-            compared_timetable_arr.append(self.schedule_adherence[key])
+            compared_timetable_arr.append(comparison_df)
 
         if len(compared_timetable_arr) == 1:
             return compared_timetable_arr[0]
@@ -197,9 +296,13 @@ class RouteMetrics:
 
         now = time.time()
 
+        self.prefetch(rng.dates, timetables=True)
+
         for d in rng.dates:
-            key = f'{direction_id}-{stop_id}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}'
-            if key not in self.headway_schedule_deltas:
+            key = ('headway_schedule_deltas', self.agency_id, self.route_id, d, direction_id, stop_id, *rng.get_key())
+
+            headway_deltas = metrics_cache.get(key)
+            if headway_deltas is None:
                 timetable_df = self.get_timetable_data_frame(d, direction_id=direction_id, stop_id=stop_id)
                 history_df = self.get_history_data_frame(d, direction_id=direction_id, stop_id=stop_id)
 
@@ -232,9 +335,12 @@ class RouteMetrics:
                 if end_time is not None:
                     comparison_df = comparison_df[comparison_df['DEPARTURE_TIME'] < end_time]
 
-                self.headway_schedule_deltas[key] = comparison_df['headway'].values - comparison_df['closest_scheduled_headway'].values
+                headway_deltas = comparison_df['headway'].values - comparison_df['closest_scheduled_headway'].values
+
+                if not self.agency_metrics.is_recent_date(d):
+                    metrics_cache.set(key, headway_deltas)
 
-            headway_delta_arr.append(self.headway_schedule_deltas[key])
+            headway_delta_arr.append(headway_deltas)
 
         if len(headway_delta_arr) == 0:
             return None
@@ -247,8 +353,6 @@ class RouteMetrics:
         return self.agency_metrics.get_route_config(self.route_id)
 
     def get_trip_times(self, direction_id, start_stop_id, end_stop_id, rng: Range, scheduled=False):
-        completed_trips_arr = []
-
         if end_stop_id is None:
             return None
 
@@ -266,17 +370,23 @@ class RouteMetrics:
 
         get_data_frame = self.get_timetable_data_frame if scheduled else self.get_history_data_frame
 
-        for d in rng.dates:
-            key = f'{direction_id}-{start_stop_id}-{end_stop_id}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}-{scheduled}'
+        self.prefetch(rng.dates, arrival_histories=not scheduled, timetables=scheduled)
+
+        def get_key(d):
+            return ('trip_times', self.agency_id, self.route_id, d, direction_id, start_stop_id, end_stop_id, *rng.get_key(), scheduled)
+
+        trip_times_by_date = {d: metrics_cache.get(get_key(d)) for d in rng.dates}
 
-            if key not in self.trip_times:
-                #print(f'_get_trip_time_stats {key}', file=sys.stderr)
+        missing_dates = [d for d in rng.dates if trip_times_by_date[d] is None]
+        if len(missing_dates) > 0:
+            start_times, end_times = rng.get_day_windows(missing_dates)
 
+            for i, d in enumerate(missing_dates):
                 s1_df = get_data_frame(d, stop_id=start_stop_id, direction_id=direction_id)
                 s2_df = get_data_frame(d, stop_id=end_stop_id, direction_id=direction_id)
 
-                start_time = util.get_timestamp_or_none(d, rng.start_time_str, rng.tz)
-                end_time = util.get_timestamp_or_none(d, rng.end_time_str, rng.tz)
+                start_time = get_day_window_value(start_times, i)
+                end_time = get_day_window_value(end_times, i)
 
                 if start_time is not None:
                     s1_df = s1_df[s1_df['DEPARTURE_TIME'] >= start_time]
@@ -284,15 +394,15 @@ class RouteMetrics:
                 if end_time is not None:
                     s1_df = s1_df[s1_df['DEPARTURE_TIME'] < end_time]
 
-                self.trip_times[key] = trip_times.get_completed_trip_times(
+                trip_times_by_date[d] = metrics_cache.set(get_key(d), trip_times.get_completed_trip_times(
                     s1_df['TRIP'].values,
                     s1_df['DEPARTURE_TIME'].values,
                     s2_df['TRIP'].values,
                     s2_df['TIME'].values,
                     is_loop = is_loop
-                )
+                ))
 
-            completed_trips_arr.append(self.trip_times[key])
+        completed_trips_arr = [trip_times_by_date[d] for d in rng.dates]
 
         if len(completed_trips_arr) == 1:
             return completed_trips_arr[0]
@@ -302,25 +412,29 @@ class RouteMetrics:
             return None
 
     def get_headways(self, direction_id, stop_id, rng: Range, scheduled=False):
-        headway_min_arr = []
-
         get_data_frame = self.get_timetable_data_frame if scheduled else self.get_history_data_frame
 
-        for d in rng.dates:
-            key = f'{direction_id}-{stop_id}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}-{scheduled}'
+        self.prefetch(rng.dates, arrival_histories=not scheduled, timetables=scheduled)
 
-            if key not in self.headways:
-                #print(f'_get_headways {key}', file=sys.stderr)
-                df = get_data_frame(d, direction_id=direction_id, stop_id=stop_id)
+        def get_key(d):
+            return ('headways', self.agency_id, self.route_id, d, direction_id, stop_id, *rng.get_key(), scheduled)
 
-                start_time = util.get_timestamp_or_none(d, rng.start_time_str, rng.tz)
-                end_time = util.get_timestamp_or_none(d, rng.end_time_str, rng.tz)
+        headways_by_date = {d: metrics_cache.get(get_key(d)) for d in rng.dates}
 
-                departure_time_values = np.sort(df['DEPARTURE_TIME'].values)
+        # headways for all dates that aren't cached yet are computed at once
+        missing_dates = [d for d in rng.dates if headways_by_date[d] is None]
+        if len(missing_dates) > 0:
+            departure_time_values_arr = [
+                np.sort(get_data_frame(d, direction_id=direction_id, stop_id=stop_id)['DEPARTURE_TIME'].values)
+                for d in missing_dates
+            ]
 
-                self.headways[key] = compute_headway_minutes(departure_time_values, start_time, end_time)
+            day_headways = compute_headway_minutes_by_day(departure_time_values_arr, *rng.get_day_windows(missing_dates))
 
-            headway_min_arr.append(self.headways[key])
+            for d, headways in zip(missing_dates, day_headways):
+                headways_by_date[d] = metrics_cache.set(get_key(d), headways)
+
+        headway_min_arr = [headways_by_date[d] for d in rng.dates]
 
         if len(headway_min_arr) == 1:
             return headway_min_arr[0]
@@ -423,6 +537,9 @@ class DirectionIntervalMetrics:
     def get_num_trips(self, start_stop_id, end_stop_id, scheduled=False):
         total_trips = None
 
+        self.agency_metrics.prefetch_precomputed_stats(precomputed_stats.StatIds.Combined,
+            self.rng.dates, self.rng.start_time_str, self.rng.end_time_str, scheduled=scheduled)
+
         for d in self.rng.dates:
             stats = self.agency_metrics.get_precomputed_stats(
                 precomputed_stats.StatIds.Combined,
@@ -491,6 +608,9 @@ class DirectionIntervalMetrics:
 
         rng = self.rng
 
+        self.agency_metrics.prefetch_precomputed_stats(precomputed_stats.StatIds.Combined,
+            rng.dates, rng.start_time_str, rng.end_time_str, scheduled=scheduled)
+
         for d in rng.dates:
             stats = self.agency_metrics.get_precomputed_stats(
                 precomputed_stats.StatIds.Combined,
@@ -512,6 +632,9 @@ class DirectionIntervalMetrics:
 
         rng = self.rng
 
+        self.agency_metrics.prefetch_precomputed_stats(precomputed_stats.StatIds.Combined,
+            rng.dates, rng.start_time_str, rng.end_time_str, scheduled=scheduled)
+
         for d in rng.dates:
             stats = self.agency_metrics.get_precomputed_stats(
                 precomputed_stats.StatIds.Combined,
@@ -537,6 +660,9 @@ class DirectionIntervalMetrics:
         first_stop_id, last_stop_id = dir_info.get_endpoint_stop_ids()
         rng = self.rng
 
+        self.agency_metrics.prefetch_precomputed_stats(precomputed_stats.StatIds.Combined,
+            rng.dates, rng.start_time_str, rng.end_time_str)
+
         for d in rng.dates:
             stats = self.agency_metrics.get_precomputed_stats(
                 precomputed_stats.StatIds.Combined,
@@ -580,6 +706,10 @@ class DirectionIntervalMetrics:
             return None
 
         rng = self.rng
+
+        self.agency_metrics.prefetch_precomputed_stats(precomputed_stats.StatIds.Combined,
+            rng.dates, rng.start_time_str, rng.end_time_str, scheduled=scheduled)
+
         for d in rng.dates:
             stats = self.agency_metrics.get_precomputed_stats(
                 precomputed_stats.StatIds.Combined,
@@ -631,10 +761,14 @@ class AgencyMetrics:
     def __init__(self, agency_id):
         self.agency_id = agency_id
         self.agency = config.get_agency(agency_id)
-        self.precomputed_stats = {}
         self.route_metrics = {}
         self.date_keys = None
         self.route_configs = None
+        self.created_time = time.time()
+
+    def is_recent_date(self, d: date):
+        # arrivals and stats for today (or yesterday, before the day start hour) may be computed again later
+        return d >= datetime.now(self.agency.tz).date() - timedelta(days=1)
 
     def get_date_keys(self):
         if self.date_keys is None:
@@ -656,33 +790,98 @@ class AgencyMetrics:
     def get_route_config(self, route_id):
         return self.get_route_configs().get(route_id, None)
 
-    def get_precomputed_stats(self, stat_id, d: date, start_time_str, end_time_str, scheduled=False):
+    def get_stats_date(self, d: date, scheduled=False) -> date:
+        # returns the date of the precomputed stats for date d, or None if date d is not in the timetable
         if scheduled:
             date_keys = self.get_date_keys()
             date_str = str(d)
             if date_str not in date_keys:
-                print(f'date {d} not in timetable', file=sys.stderr)
                 return None
-            stats_date = util.parse_date(date_keys[date_str])
+            return util.parse_date(date_keys[date_str])
         else:
-            stats_date = d
+            return d
 
-        key = f'{stat_id}-{stats_date}-{start_time_str}-{end_time_str}-{scheduled}'
-        if key not in self.precomputed_stats:
-            try:
-                self.precomputed_stats[key] = precomputed_stats.get_precomputed_stats(
-                    self.agency_id, stat_id, stats_date,
-                    start_time_str = start_time_str, end_time_str = end_time_str,
-                    scheduled=scheduled
-                )
-            except FileNotFoundError as e:
-                self.precomputed_stats[key] = None
+    def get_precomputed_stats(self, stat_id, d: date, start_time_str, end_time_str, scheduled=False):
+        stats_date = self.get_stats_date(d, scheduled)
+        if stats_date is None:
+            print(f'date {d} not in timetable', file=sys.stderr)
+            return None
+
+        key = ('precomputed_stats', self.agency_id, stat_id, stats_date, start_time_str, end_time_str, scheduled)
+        cache_path = precomputed_stats.get_cache_path(self.agency_id, stat_id, stats_date, start_time_str, end_time_str, scheduled)
+
+        entry = metrics_cache.get(key)
+        if entry is not None:
+            stats, mtime = entry
+            # like arrival histories, stats for recent dates are loaded again if they were saved since then
+            if not ((stats is None or self.is_recent_date(stats_date)) and get_file_mtime(cache_path) != mtime):
+                return stats
+
+        mtime = get_file_mtime(cache_path)
+
+        try:
+            stats = precomputed_stats.get_precomputed_stats(
+                self.agency_id, stat_id, stats_date,
+                start_time_str = start_time_str, end_time_str = end_time_str,
+                scheduled=scheduled
+            )
+        except FileNotFoundError as e:
+            stats = None
+
+        metrics_cache.set(key, (stats, mtime))
+        return stats
+
+    def prefetch_precomputed_stats(self, stat_id, dates, start_time_str, end_time_str, scheduled=False):
+        # loads the precomputed stats for multiple dates concurrently (see RouteMetrics.prefetch)
+        try:
+            stats_dates = [self.get_stats_date(d, scheduled) for d in dates]
+        except Exception as ex:
+            return
+
+        fns = {}
+        for d, stats_date in zip(dates, stats_dates):
+            key = ('precomputed_stats', self.agency_id, stat_id, stats_date, start_time_str, end_time_str, scheduled)
+            if stats_date is not None and key not in metrics_cache and key not in fns:
+                fns[key] = partial(self.get_precomputed_stats, stat_id, d, start_time_str, end_time_str, scheduled)
 
-        return self.precomputed_stats[key]
+        fetch_concurrently(list(fns.values()))
 
     def get_route_ids(self):
         return self.get_route_configs().keys()
 
+# AgencyMetrics objects (and their RouteMetrics) are reused by all requests in this process,
+# but are created again after this many seconds so that route configs and timetable date keys are reloaded.
+agency_metrics_max_age = 3600
+
+agency_metrics_by_id = {}
+
+def get_agency_metrics(agency_id) -> AgencyMetrics:
+    agency_metrics = agency_metrics_by_id.get(agency_id, None)
+    if agency_metrics is None or time.time() - agency_metrics.created_time > agency_metrics_max_age:
+        agency_metrics = agency_metrics_by_id[agency_id] = AgencyMetrics(agency_id)
+    return agency_metrics
+
+def get_file_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+def fetch_concurrently(fns):
+    # Calls each function in a pool of threads, so that files that are not cached locally are downloaded in parallel
+    # (with at most config.s3_fetch_concurrency requests at a time).
+    # Errors are only logged, since they are raised again when the same data is loaded without prefetching.
+    if len(fns) <= 1:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(config.s3_fetch_concurrency, len(fns))) as executor:
+        futures = [executor.submit(fn) for fn in fns]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as ex:
+                print(f'error prefetching data: {repr(ex)}', file=sys.stderr)
+
 def compute_headway_minutes(time_values, start_time=None, end_time=None):
     if start_time is not None:
         start_index = np.searchsorted(time_values, start_time, 'left')
@@ -700,3 +899,63 @@ def compute_headway_minutes(time_values, start_time=None, end_time=None):
         end_index = start_index
 
     return (time_values[start_index:end_index] - time_values[start_index - 1 : end_index - 1]) / 60
+
+def compute_headway_minutes_by_day(time_values_arr, start_times=None, end_times=None) -> list:
+    '''
+    Returns a list with the headways for each day (the same as calling compute_headway_minutes for each day),
+    given a list with a sorted array of times for each day, and arrays with the start/end timestamp
+    for each day (or None), as returned by Range.get_day_windows.
+
+    The times for all days are stacked into one array so that the headways for all days
+    are computed with a few numpy operations instead of a loop over each day.
+    '''
+    time_values, day_indexes, day_offsets = stack_days(time_values_arr)
+
+    headways = np.diff(time_values, prepend=time_values[:1]) / 60
+
+    # the first time of each day has no previous time on the same day
+    is_headway = get_day_windows_mask(time_values, day_indexes, start_times, end_times)
+    is_headway[day_offsets[:-1][day_offsets[:-1] < day_offsets[1:]]] = False
+
+    return split_by_day(headways[is_headway], day_indexes[is_headway], len(time_values_arr))
+
+def count_by_day(time_values_arr, start_times=None, end_times=None) -> np.ndarray:
+    # returns an array with the number of times within the time range for each day
+    # (see compute_headway_minutes_by_day for the parameters)
+    time_values, day_indexes, day_offsets = stack_days(time_values_arr)
+
+    is_in_range = get_day_windows_mask(time_values, day_indexes, start_times, end_times)
+
+    return np.bincount(day_indexes[is_in_range], minlength=len(time_values_arr))
+
+def stack_days(time_values_arr) -> tuple:
+    # Returns a tuple of (time_values, day_indexes, day_offsets) where time_values contains the times for all days,
+    # day_indexes is a parallel array with the index of the day of each time,
+    # and the times for day i are in time_values[day_offsets[i]:day_offsets[i+1]].
+    day_lengths = np.array([len(values) for values in time_values_arr], dtype=np.int64)
+    day_offsets = np.r_[0, np.cumsum(day_lengths)]
+
+    # empty data frames have an object dtype, so they aren't included to keep numeric times
+    non_empty_values_arr = [values for values in time_values_arr if len(values) > 0]
+    time_values = np.concatenate(non_empty_values_arr) if len(non_empty_values_arr) > 0 else np.zeros(0, dtype=np.int64)
+
+    day_indexes = np.repeat(np.arange(len(time_values_arr)), day_lengths)
+
+    return time_values, day_indexes, day_offsets
+
+def get_day_windows_mask(time_values, day_indexes, start_times=None, end_times=None) -> np.ndarray:
+    # returns a boolean array which is True for times within the time range of their day
+    mask = np.full(len(time_values), True)
+    if start_times is not None:
+        mask &= (time_values >= start_times[day_indexes])
+    if end_times is not None:
+        mask &= (time_values < end_times[day_indexes])
+    return mask
+
+def split_by_day(values, day_indexes, num_days) -> list:
+    # splits an array of values for multiple days (in order of day index) into a list with an array for each day
+    return np.split(values, np.cumsum(np.bincount(day_indexes, minlength=num_days))[:-1])
+
+def get_day_window_value(day_windows, i):
+    # returns the start/end timestamp of day i as an int from the arrays returned by Range.get_day_windows (or None)
+    return int(day_windows[i]) if day_windows is not None else None
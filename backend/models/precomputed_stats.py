@@ -2,7 +2,6 @@ from . import util, config
 from datetime import date
 import sys
 import re
-import requests
 from pathlib import Path
 import json
 import boto3
@@ -101,7 +100,7 @@ def get_precomputed_stats(agency_id, stat_id: str, d: date, start_time_str = Non
     s3_path = get_s3_path(agency_id, stat_id, d, start_time_str, end_time_str, scheduled, version)
 
     s3_url = f"http://{s3_bucket}.s3.amazonaws.com/{s3_path}"
-    r = requests.get(s3_url)
+    r = util.get_http_session().get(s3_url)
 
     if r.status_code == 404:
         raise FileNotFoundError(f"{s3_url} not found")
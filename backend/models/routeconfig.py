@@ -127,6 +127,11 @@ def get_cache_path(agency_id, version=DefaultVersion):
 def get_s3_path(agency_id, version=DefaultVersion):
     return f'routes/{version}/routes_{version}_{agency_id}.json.gz'
 
+# map of (agency_id, version) => (mtime, route list) for route lists loaded from the local cache,
+# so that long-running processes (e.g. workers computing arrivals for many routes and dates)
+# only parse the cache file again when it changes
+route_lists_by_mtime = {}
+
 def get_route_list(agency_id, version=DefaultVersion):
     if re.match('^[\w\-]+$', agency_id) is None:
         raise Exception(f"Invalid agency id: {agency_id}")
@@ -140,10 +145,16 @@ def get_route_list(agency_id, version=DefaultVersion):
         mtime = os.stat(cache_path).st_mtime
         now = time.time()
         if now - mtime < 86400:
+            cache_key = (agency_id, version)
+            if cache_key in route_lists_by_mtime and route_lists_by_mtime[cache_key][0] == mtime:
+                return route_lists_by_mtime[cache_key][1]
+
             with open(cache_path, mode='r', encoding='utf-8') as f:
                 data_str = f.read()
                 try:
-                    return route_list_from_data(json.loads(data_str))
+                    route_list = route_list_from_data(json.loads(data_str))
+                    route_lists_by_mtime[cache_key] = (mtime, route_list)
+                    return route_list
                 except Exception as err:
                     print(err)
     except FileNotFoundError as err:
@@ -623,10 +623,10 @@ class Query(ObjectType):
     )
 
     def resolve_agencies(parent, info, agency_ids):
-        return [metrics.AgencyMetrics(agency_id) for agency_id in agency_ids]
+        return [metrics.get_agency_metrics(agency_id) for agency_id in agency_ids]
 
     def resolve_agency(parent, info, agency_id):
-        return metrics.AgencyMetrics(agency_id)
+        return metrics.get_agency_metrics(agency_id)
 
 def round_or_none(number, num_digits=ROUND_DIGITS):
     if number is None:
@@ -0,0 +1,99 @@
+import math
+import numpy as np
+from . import util
+
+meters_per_lat_degree = 111195 # 6371000 * pi / 180, using the same earth radius as util.haver_distance
+
+class GridIndex:
+    '''
+    Index of points (e.g. resampled GPS observations) in a uniform grid of square cells,
+    which allows finding the points within a radius of a location (e.g. a stop)
+    without computing the distance from that location to every point.
+
+    Points are projected onto a plane in meters around the mean latitude/longitude,
+    and the indexes of the points are sorted by cell, so that the points in each
+    column of cells are found with a binary search.
+    '''
+    def __init__(self, lat_values: np.ndarray, lon_values: np.ndarray, cell_size=200):
+        self.lat_values = np.asarray(lat_values, dtype=np.float64)
+        self.lon_values = np.asarray(lon_values, dtype=np.float64)
+        self.cell_size = cell_size
+
+        num_points = len(self.lat_values)
+
+        if num_points > 0:
+            self.origin_lat = float(np.mean(self.lat_values))
+            self.origin_lon = float(np.mean(self.lon_values))
+        else:
+            self.origin_lat = self.origin_lon = 0
+
+        self.meters_per_lon_degree = meters_per_lat_degree * math.cos(math.radians(self.origin_lat))
+
+        cell_x_values = self.get_cell_x(self.lon_values)
+        cell_y_values = self.get_cell_y(self.lat_values)
+
+        if num_points > 0:
+            self.min_cell_x = int(np.min(cell_x_values))
+            self.max_cell_x = int(np.max(cell_x_values))
+            self.min_cell_y = int(np.min(cell_y_values))
+            self.max_cell_y = int(np.max(cell_y_values))
+        else:
+            self.min_cell_x = self.min_cell_y = 0
+            self.max_cell_x = self.max_cell_y = -1
+
+        self.num_rows = self.max_cell_y - self.min_cell_y + 1
+
+        cell_keys = self.get_cell_keys(cell_x_values, cell_y_values)
+
+        self.sort_order = np.argsort(cell_keys, kind='mergesort')
+        self.sorted_cell_keys = cell_keys[self.sort_order]
+
+    def __len__(self):
+        return len(self.lat_values)
+
+    def get_cell_x(self, lon_values):
+        return np.floor((lon_values - self.origin_lon) * self.meters_per_lon_degree / self.cell_size).astype(np.int64)
+
+    def get_cell_y(self, lat_values):
+        return np.floor((lat_values - self.origin_lat) * meters_per_lat_degree / self.cell_size).astype(np.int64)
+
+    def get_cell_keys(self, cell_x_values, cell_y_values):
+        # cells in the same column have consecutive keys
+        return (cell_x_values - self.min_cell_x) * self.num_rows + (cell_y_values - self.min_cell_y)
+
+    def query_radius(self, lat, lon, radius):
+        '''
+        Returns a tuple (indexes, distances) containing the sorted indexes of all points
+        less than `radius` meters from (lat, lon), and the distance in meters from (lat, lon)
+        to each of those points (computed with util.haver_distance).
+        '''
+        if len(self) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+        # bounding box around the circle, with a small margin for the difference between
+        # the projected coordinates and the haversine distance
+        lat_radius = radius * 1.01 / meters_per_lat_degree + 1e-6
+        lon_radius = lat_radius / max(math.cos(math.radians(abs(lat) + lat_radius)), 1e-6)
+
+        min_cell_x = max(int(self.get_cell_x(lon - lon_radius)), self.min_cell_x)
+        max_cell_x = min(int(self.get_cell_x(lon + lon_radius)), self.max_cell_x)
+        min_cell_y = max(int(self.get_cell_y(lat - lat_radius)), self.min_cell_y)
+        max_cell_y = min(int(self.get_cell_y(lat + lat_radius)), self.max_cell_y)
+
+        if min_cell_x > max_cell_x or min_cell_y > max_cell_y:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+        column_keys = self.get_cell_keys(np.arange(min_cell_x, max_cell_x + 1), min_cell_y)
+        start_indexes = np.searchsorted(self.sorted_cell_keys, column_keys, side='left')
+        end_indexes = np.searchsorted(self.sorted_cell_keys, column_keys + (max_cell_y - min_cell_y), side='right')
+
+        candidate_indexes = np.sort(np.concatenate([
+            self.sort_order[start_index:end_index]
+            for start_index, end_index in zip(start_indexes, end_indexes)
+        ]))
+
+        distances = util.haver_distance(lat, lon, self.lat_values[candidate_indexes], self.lon_values[candidate_indexes])
+
+        is_nearby = distances < radius
+
+        return candidate_indexes[is_nearby], distances[is_nearby]
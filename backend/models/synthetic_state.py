@@ -0,0 +1,156 @@
+import math
+import numpy as np
+import pandas as pd
+from . import routeconfig
+
+# Helpers for generating a synthetic route and GPS observations of vehicles
+# driving back and forth along it, for testing and benchmarking arrival detection
+# without downloading any data.
+
+def get_shape_positions(shape, num_stops, stop_spacing) -> list:
+    # Returns a list of (x, y) positions in meters of the stops along a route with the given shape:
+    #   'line': a straight line from west to east
+    #   'curve': an arc that turns 270 degrees, so the last stops are near the first stops
+    #   'loop': a circle, with stop_spacing meters between the last stop and the first stop
+    if shape == 'line':
+        return [(i * stop_spacing, 0) for i in range(num_stops)]
+    elif shape == 'curve':
+        angle = 1.5 * math.pi
+        radius = max(num_stops - 1, 1) * stop_spacing / angle
+    elif shape == 'loop':
+        angle = 2 * math.pi * (num_stops - 1) / num_stops
+        radius = num_stops * stop_spacing / (2 * math.pi)
+    else:
+        raise Exception(f"Invalid shape: {shape}")
+
+    angles = [angle * i / max(num_stops - 1, 1) for i in range(num_stops)]
+    return [(radius * math.sin(a), radius * (1 - math.cos(a))) for a in angles]
+
+def make_route_config(agency_id='test', route_id='R1', num_stops=12, stop_spacing=300, shape='line') -> routeconfig.RouteConfig:
+    '''
+    Returns a RouteConfig with num_stops stops in each direction, stop_spacing meters apart along the given shape
+    (see get_shape_positions). Routes with the 'loop' shape have a single direction which is a loop;
+    other routes have two directions with stops on opposite sides of the street.
+    '''
+    lat0 = 37.77
+    lon0 = -122.45
+    lon_per_meter = 1 / (111320 * math.cos(math.radians(lat0)))
+
+    stops = {}
+    directions = []
+
+    is_loop = (shape == 'loop')
+
+    positions = get_shape_positions(shape, num_stops, stop_spacing)
+
+    for direction_id, lat_offset in ([('0', 0)] if is_loop else [('0', 0), ('1', 0.0002)]):
+        stop_ids = []
+        for i in range(num_stops):
+            stop_id = f'{route_id}_{direction_id}_{i}'
+            x, y = positions[i if direction_id == '0' else num_stops - 1 - i]
+            stops[stop_id] = {
+                'id': stop_id,
+                'title': f'Stop {stop_id}',
+                'lat': lat0 + lat_offset + y / 111320,
+                'lon': lon0 + x * lon_per_meter,
+            }
+            stop_ids.append(stop_id)
+
+        direction = {
+            'id': direction_id,
+            'title': f'Direction {direction_id}',
+            'gtfs_direction_id': direction_id,
+            'gtfs_shape_id': direction_id,
+            'stop_geometry': {},
+            'stops': stop_ids,
+        }
+        if is_loop:
+            direction['loop'] = True
+
+        directions.append(direction)
+
+    return routeconfig.RouteConfig(agency_id, {
+        'id': route_id,
+        'title': f'Route {route_id}',
+        'url': None,
+        'type': 3,
+        'sort_order': 0,
+        'gtfs_route_id': route_id,
+        'directions': directions,
+        'stops': stops,
+    })
+
+def make_route_state(route_config: routeconfig.RouteConfig, start_time, end_time, num_vehicles=4, seed=0,
+        noise_meters=4, gap_probability=0.2, layover_seconds=(400, 700), dwell_seconds=(5, 40)) -> pd.DataFrame:
+    '''
+    Returns a data frame of GPS observations (TIME, VID, LAT, LON) sorted by time, for vehicles that drive trips
+    in alternating directions (or around a loop) at 5-10 m/s, with a layover at the first stop of each trip,
+    noisy positions (with a standard deviation of noise_meters), duplicate observations,
+    and gaps of more than 30 minutes after a fraction (gap_probability) of trips.
+    '''
+    rng = np.random.RandomState(seed)
+
+    dir_infos = route_config.get_direction_infos()
+
+    all_states = []
+
+    for vehicle_index in range(num_vehicles):
+        vid = f'V{vehicle_index + 1}'
+
+        # times and positions of the vehicle at the start and end of each stop and gap
+        knot_times = []
+        knot_lats = []
+        knot_lons = []
+        gaps = []
+
+        t = start_time + vehicle_index * 300 + rng.randint(0, 60)
+        dir_index = vehicle_index % len(dir_infos)
+
+        while t < end_time:
+            dir_info = dir_infos[dir_index]
+            for stop_index, stop_id in enumerate(dir_info.get_stop_ids()):
+                stop_info = route_config.get_stop_info(stop_id)
+                # vehicles on loop routes drive from the last stop back to the first stop
+                if stop_index > 0 or (dir_info.is_loop() and len(knot_times) > 0):
+                    t += stop_spacing_seconds(route_config, prev_stop_info, stop_info, rng)
+                dwell = rng.randint(*layover_seconds) if stop_index == 0 else rng.randint(*dwell_seconds)
+
+                knot_times.extend([t, t + dwell])
+                knot_lats.extend([stop_info.lat, stop_info.lat])
+                knot_lons.extend([stop_info.lon, stop_info.lon])
+                t += dwell
+                prev_stop_info = stop_info
+
+            if rng.rand() < gap_probability:
+                gap = rng.randint(1900, 4000)
+                gaps.append((t, t + gap))
+                t += gap
+
+            dir_index = (dir_index + 1) % len(dir_infos)
+
+        obs_times = []
+        obs_time = start_time + vehicle_index * 300
+        while obs_time < min(t, end_time):
+            if not any(gap_start < obs_time < gap_end for gap_start, gap_end in gaps):
+                obs_times.append(obs_time)
+                if rng.rand() < 0.1:
+                    obs_times.append(obs_time + 1)
+            obs_time += rng.randint(10, 45)
+
+        obs_times = np.array(obs_times, dtype=np.int64)
+
+        all_states.append(pd.DataFrame({
+            'TIME': obs_times,
+            'VID': vid,
+            'LAT': np.interp(obs_times, knot_times, knot_lats) + rng.normal(0, noise_meters / 111320, len(obs_times)),
+            'LON': np.interp(obs_times, knot_times, knot_lons) + rng.normal(0, noise_meters / 88000, len(obs_times)),
+        }, columns=['TIME', 'VID', 'LAT', 'LON']))
+
+    state = pd.concat(all_states, ignore_index=True)
+    return state.sort_values('TIME', kind='mergesort').reset_index(drop=True)
+
+def stop_spacing_seconds(route_config, stop_info, next_stop_info, rng):
+    dx = (next_stop_info.lon - stop_info.lon) * 88000
+    dy = (next_stop_info.lat - stop_info.lat) * 111320
+    speed = rng.uniform(5, 10) # meters per second
+    return int(math.sqrt(dx * dx + dy * dy) / speed) + 1
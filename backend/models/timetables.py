@@ -1,22 +1,29 @@
 from datetime import date, time, datetime
 import pytz
 import json
-import requests
+import os
 import re
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
-from . import config, util, metrics
+from . import config, util, metrics, columnar
 
 DefaultVersion = 'v1'
 
+timetable_columns = ("TIME", "DEPARTURE_TIME", "SID", "DID", "TRIP")
+
 class Timetable:
-    def __init__(self, agency_id, route_id, arrivals_data, date_start_time):
+    def __init__(self, agency_id, route_id, arrivals_data, date_start_time, columns: columnar.ColumnTable = None):
         self.agency_id = agency_id
         self.route_id = route_id
         self.arrivals_data = arrivals_data
         self.date_start_time = date_start_time
+        self.columns = columns  # columnar table of arrivals (see get_columns_table), used instead of arrivals_data if not None
+
+    def is_memory_mapped(self) -> bool:
+        # True if the arrivals are views of a memory-mapped columnar file shared with other processes
+        return self.columns is not None and columnar.is_memory_mapped(self.columns.columns['TIME'])
 
     def get_data_frame(self, direction_id = None, stop_id = None,
             start_time = None, end_time = None) -> pd.DataFrame:
@@ -29,10 +36,14 @@ class Timetable:
             end_time (unix timestamp)
 
         '''
+        if self.columns is not None:
+            return self.get_columns_data_frame(direction_id=direction_id, stop_id=stop_id,
+                start_time=start_time, end_time=end_time)
+
         arrivals_by_direction = self.arrivals_data
         data = []
 
-        columns = ("TIME", "DEPARTURE_TIME", "SID", "DID", "TRIP")
+        columns = timetable_columns
 
         date_start_time = self.date_start_time
 
@@ -71,11 +82,59 @@ class Timetable:
 
         return pd.DataFrame(data = data, columns = columns)
 
+    def get_columns_data_frame(self, direction_id = None, stop_id = None,
+            start_time = None, end_time = None) -> pd.DataFrame:
+        # same as get_data_frame, but selects the arrivals for each (direction_id, stop_id) pair
+        # with slices of the columnar arrays, in the same order as the JSON timetable
+        table = self.columns
+        group_keys = table.meta['groups']
+        group_offsets = table.meta['offsets']
+
+        group_indexes = [
+            group_index for group_index, (did, sid) in enumerate(group_keys)
+            if (direction_id is None or did == direction_id) and (stop_id is None or sid == stop_id)
+        ]
+
+        if len(group_indexes) == 1:
+            rows = slice(group_offsets[group_indexes[0]], group_offsets[group_indexes[0] + 1])
+        elif len(group_indexes) > 0:
+            rows = np.concatenate([np.arange(group_offsets[i], group_offsets[i + 1]) for i in group_indexes])
+        else:
+            rows = np.zeros(0, dtype=np.int64)
+
+        time_values = table.columns['TIME'][rows] + self.date_start_time
+
+        if len(time_values) == 0:
+            return pd.DataFrame(data = [], columns = timetable_columns)
+
+        group_lengths = np.diff(np.array(group_offsets, dtype=np.int64))[group_indexes]
+
+        def get_group_values(key_index):
+            return np.repeat(np.array([group_keys[i][key_index] for i in group_indexes], dtype=object), group_lengths)
+
+        df = pd.DataFrame({
+            "TIME": time_values,
+            "DEPARTURE_TIME": table.columns['DEPARTURE_TIME'][rows] + self.date_start_time,
+            "SID": get_group_values(1),
+            "DID": get_group_values(0),
+            "TRIP": table.get_values('TRIP')[rows],
+        }, columns = timetable_columns)
+
+        if start_time is not None or end_time is not None:
+            is_in_range = np.full(len(time_values), True)
+            if start_time is not None:
+                is_in_range &= (time_values >= start_time)
+            if end_time is not None:
+                is_in_range &= (time_values < end_time)
+            df = df[is_in_range].reset_index(drop=True)
+
+        return df
+
 def get_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion) -> Timetable:
     date_key = get_date_key(agency_id, d, version)
-    data = get_data_by_date_key(agency_id, route_id, date_key, version)
+    table = get_columns_by_date_key(agency_id, route_id, date_key, version)
 
-    timezone_id = data['timezone_id']
+    timezone_id = table.meta['timezone_id']
     tz = pytz.timezone(timezone_id)
 
     date_start_time = int(tz.localize(datetime.combine(d, time())).timestamp())
@@ -83,8 +142,9 @@ def get_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion
     return Timetable(
         agency_id = agency_id,
         route_id = route_id,
-        arrivals_data = data['arrivals'],
-        date_start_time = date_start_time
+        arrivals_data = None,
+        date_start_time = date_start_time,
+        columns = table
     )
 
 def match_actual_times_to_schedule(actual_times, scheduled_times) -> pd.DataFrame:
@@ -268,7 +328,7 @@ def get_data_by_date_key(agency_id: str, route_id: str, date_key: str, version =
     s3_path = get_s3_path(agency_id, route_id, date_key, version)
 
     s3_url = f"http://{s3_bucket}.s3.amazonaws.com/{s3_path}"
-    r = requests.get(s3_url)
+    r = util.get_http_session().get(s3_url)
 
     if r.status_code == 404:
         raise FileNotFoundError(f"{s3_url} not found")
@@ -288,7 +348,51 @@ def get_data_by_date_key(agency_id: str, route_id: str, date_key: str, version =
 
     return data
 
-def get_cache_path(agency_id, route_id, date_key, version = DefaultVersion):
+def get_columns_table(data) -> columnar.ColumnTable:
+    # Returns the JSON timetable data as a columnar table, with arrival/departure times as offsets from the start
+    # of the date, and the (direction_id, stop_id) pairs and the offset of the arrivals for each pair in the metadata.
+    group_keys = []
+    group_offsets = [0]
+    arrivals = []
+
+    for did, stops_map in data['arrivals'].items():
+        for sid, stop_arrivals in stops_map.items():
+            group_keys.append([did, sid])
+            arrivals.extend(stop_arrivals)
+            group_offsets.append(len(arrivals))
+
+    return columnar.ColumnTable({
+            'TIME': np.array([arrival['t'] for arrival in arrivals], dtype=np.int64),
+            'DEPARTURE_TIME': np.array([arrival.get('e', arrival['t']) for arrival in arrivals], dtype=np.int64),
+            'TRIP': np.array([arrival['i'] for arrival in arrivals], dtype=np.int64),
+        },
+        meta={
+            'timezone_id': data['timezone_id'],
+            'groups': group_keys,
+            'offsets': group_offsets,
+        },
+    )
+
+def get_columns_by_date_key(agency_id: str, route_id: str, date_key: str, version = DefaultVersion) -> columnar.ColumnTable:
+    # Returns the timetable as a memory-mapped columnar table, so that API server processes
+    # loading the same timetable share the same physical memory instead of each parsing the JSON file.
+    # The columnar file is saved next to the JSON file the first time the timetable is loaded.
+    cache_path = get_cache_path(agency_id, route_id, date_key, version)
+    columns_cache_path = get_cache_path(agency_id, route_id, date_key, version, extension='cols')
+
+    try:
+        columns_mtime = os.stat(columns_cache_path).st_mtime
+        if not os.path.exists(cache_path) or os.stat(cache_path).st_mtime <= columns_mtime:
+            return columnar.read_table(columns_cache_path)
+    except FileNotFoundError as err:
+        pass
+
+    table = get_columns_table(get_data_by_date_key(agency_id, route_id, date_key, version))
+    columnar.write_table(columns_cache_path, table.columns, table.meta)
+
+    return columnar.read_table(columns_cache_path)
+
+def get_cache_path(agency_id, route_id, date_key, version = DefaultVersion, extension = 'json'):
     if re.match('^[\w\-]+$', agency_id) is None:
         raise Exception(f"Invalid agency id: {agency_id}")
 
@@ -301,7 +405,7 @@ def get_cache_path(agency_id, route_id, date_key, version = DefaultVersion):
     if re.match('^[\w\-]+$', version) is None:
         raise Exception(f"Invalid version: {version}")
 
-    return f"{util.get_data_dir()}/timetables_{version}_{agency_id}/{date_key}/timetables_{version}_{agency_id}_{date_key}_{route_id}.json"
+    return f"{util.get_data_dir()}/timetables_{version}_{agency_id}/{date_key}/timetables_{version}_{agency_id}_{date_key}_{route_id}.{extension}"
 
 def get_s3_path(agency_id, route_id, date_key, version=DefaultVersion):
     return f'timetables/{version}/{agency_id}/{date_key}/timetables_{version}_{agency_id}_{date_key}_{route_id}.json.gz'
@@ -350,7 +454,7 @@ def get_date_keys(agency_id, version = DefaultVersion):
     s3_path = get_date_keys_s3_path(agency_id, version)
 
     s3_url = f"http://{s3_bucket}.s3.amazonaws.com/{s3_path}"
-    r = requests.get(s3_url)
+    r = util.get_http_session().get(s3_url)
 
     if r.status_code == 404:
         raise FileNotFoundError(f"{s3_url} not found")
@@ -1,7 +1,13 @@
 from datetime import datetime, date, timedelta
+from functools import lru_cache
 import os
+import sys
+import threading
 import pytz
+import requests
 import numpy as np
+import pandas as pd
+from . import config
 
 def quantile_sorted(sorted_arr, quantile):
     # For small arrays (less than about 4000 items) np.quantile is significantly
@@ -83,28 +89,118 @@ def render_delta(value, round_digits=1):
     rounded = round(value, 1)
     return f'+{rounded}' if value > 0 else f'{rounded}'
 
+def get_peak_rss_mb():
+    # peak resident set size of the current process, or None if not supported on this platform
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS but in kilobytes on Linux
+    if sys.platform == 'darwin':
+        max_rss = max_rss / 1024
+
+    return round(max_rss / 1024, 1)
+
+http_session = None
+http_session_lock = threading.Lock()
+
+def get_http_session() -> requests.Session:
+    # Returns a requests.Session shared by all threads in this process, so that requests to the same host
+    # (e.g. files in the S3 bucket) reuse connections instead of connecting again for each file.
+    global http_session
+
+    with http_session_lock:
+        if http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=config.s3_fetch_concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            http_session = session
+
+    return http_session
+
 def get_data_dir():
     return f"{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/data"
 
+# maximum number of (date, time_str, tz) values cached by get_timestamp_or_none and get_localized_datetime.
+# The same day boundaries are used for many stats, stops and intervals, so they are only parsed and localized once.
+timestamp_cache_size = 16384
+
+@lru_cache(maxsize=timestamp_cache_size)
 def get_timestamp_or_none(d: date, time_str: str, tz: pytz.timezone):
     return int(get_localized_datetime(d, time_str, tz).timestamp()) if time_str is not None else None
 
+@lru_cache(maxsize=timestamp_cache_size)
 def get_localized_datetime(d: date, time_str: str, tz: pytz.timezone):
+    dt = datetime.combine(d, datetime.min.time()) + timedelta(seconds=get_time_offset_sec(time_str))
+    return tz.localize(dt)
 
+@lru_cache(maxsize=1024)
+def get_time_offset_sec(time_str: str) -> int:
+    # returns the number of seconds after midnight for a time string in the format HH:MM or HH:MM:SS,
+    # optionally followed by +N for times N days after the date
     time_str_parts = time_str.split('+') # + number of days
 
     if len(time_str_parts[0].split(':')) == 2:
-        format = "%Y-%m-%d %H:%M"
+        format = "%H:%M"
     else:
-        format = "%Y-%m-%d %H:%M:%S"
+        format = "%H:%M:%S"
 
-    dt_str = f"{d.isoformat()} {time_str_parts[0]}"
+    t = datetime.strptime(time_str_parts[0], format)
 
-    dt = datetime.strptime(dt_str, format)
+    offset_sec = t.hour * 3600 + t.minute * 60 + t.second
     if len(time_str_parts) > 1:
-        dt = dt + timedelta(days=int(time_str_parts[1]))
+        offset_sec += int(time_str_parts[1]) * 86400
 
-    return tz.localize(dt)
+    return offset_sec
+
+def get_timestamps(dates, time_strs, tz: pytz.timezone) -> np.ndarray:
+    '''
+    Returns an array with the unix timestamp for each pair of date and local time string from parallel lists
+    (the same as calling get_timestamp_or_none for each pair).
+
+    Each distinct time string is only parsed once, and the local times are converted to timestamps
+    all at once with pandas instead of calling tz.localize for each date.
+    '''
+    if len(dates) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    offsets_sec = np.array([get_time_offset_sec(time_str) for time_str in time_strs], dtype=np.int64)
+
+    local_datetimes = pd.DatetimeIndex(np.array(dates, dtype='datetime64[D]') + offsets_sec.astype('timedelta64[s]'))
+
+    # like tz.localize, ambiguous times (when clocks are set back) use standard time.
+    # times that don't exist (when clocks are set forward) are converted with tz.localize below
+    localized_datetimes = local_datetimes.tz_localize(tz,
+        ambiguous=np.zeros(len(local_datetimes), dtype=bool),
+        nonexistent='NaT'
+    )
+
+    is_nonexistent = np.asarray(localized_datetimes.isna())
+
+    timestamps = localized_datetimes.tz_convert('UTC').tz_localize(None).values.astype('datetime64[s]').astype(np.int64)
+
+    for i in np.nonzero(is_nonexistent)[0]:
+        timestamps[i] = get_timestamp_or_none(dates[i], time_strs[i], tz)
+
+    return timestamps
+
+def get_timestamps_or_none(dates: list, time_str: str, tz: pytz.timezone) -> np.ndarray:
+    # returns an array with the unix timestamp of the same local time on each date (see get_timestamps),
+    # or None if time_str is None
+    if time_str is None:
+        return None
+
+    return get_timestamps(dates, [time_str] * len(dates), tz)
+
+def format_timestamps(timestamps, tz: pytz.timezone, format='%Y-%m-%d %H:%M:%S') -> np.ndarray:
+    # returns an array of strings with the local time in tz of each unix timestamp,
+    # formatting all timestamps at once instead of creating a datetime object for each timestamp
+    local_datetimes = pd.to_datetime(np.asarray(timestamps, dtype=np.int64), unit='s', utc=True).tz_convert(tz)
+    return np.asarray(local_datetimes.strftime(format), dtype=object)
 
 def get_intervals(start_time, end_time, interval_length):
     # round start_time down and end_time up to allow for even intervals
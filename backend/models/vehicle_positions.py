@@ -3,53 +3,117 @@ import os
 import re
 import json
 import math
-from . import config
+from . import config, columnar, util, instrumentation
 import time
 from pathlib import Path
 from datetime import datetime, date
 import pandas as pd
+import numpy as np
 import gzip
 import boto3
 import aiohttp
 import asyncio
-import functools
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 # Properties of each vehicle as stored by opentransit-collector,
-# used for writing and reading chunk states to and from CSV files
+# used for reading state cached in CSV files by older versions
 vehicle_keys = ['timestamp','vehicleId', 'latitude', 'longitude']
 
+# File extension for per-route state cache files in the columnar format (see models/columnar.py).
+# Older versions cached state as CSV files, which are still loaded if a columnar file doesn't exist.
+state_table_extension = 'cols'
+
+# Columns of the data frame of GPS observations returned by CachedState.get_for_route
+state_columns = ['TIME', 'VID', 'LAT', 'LON']
+
+# number of seconds after the end of an hour before all raw state objects for that hour
+# are assumed to have been saved in S3, so that the hour can be saved in the state cache
+complete_hour_delay = 300
+
 class CachedState:
     def __init__(self):
         self.cache_paths = {}
 
-    def add(self, route_id, cache_path):
-        self.cache_paths[route_id] = cache_path
+    def add(self, route_id, cache_path, partial_cache_path=None):
+        # partial_cache_path contains observations from hours that may not have been completely
+        # saved to S3 yet, which are not included in the main cache file (see get_state)
+        self.cache_paths[route_id] = (cache_path, partial_cache_path)
 
     def get_for_route(self, route_id) -> pd.DataFrame:
         if route_id not in self.cache_paths:
             return None
 
-        cache_path = self.cache_paths[route_id]
+        cache_path, partial_cache_path = self.cache_paths[route_id]
         print(f'loading state for route {route_id} from cache: {cache_path}')
-        buses = pd.read_csv(
-                cache_path,
-                dtype={
-                    'vehicleId': str,
-                },
-                float_precision='high', # keep precision for rounding lat/lon
-            ) \
-            .rename(columns={
-                'latitude': 'LAT',
-                'longitude': 'LON',
-                'vehicleId': 'VID',
-                'timestamp': 'TIME'
-            }) \
-            .reindex(['TIME', 'VID', 'LAT', 'LON'], axis='columns')
-
-        buses = buses.sort_values('TIME', axis=0)
+
+        if cache_path.endswith('.csv'):
+            return read_state_csv(cache_path)
+
+        buses = read_state_table(cache_path)
+
+        if partial_cache_path is not None:
+            print(f'loading partial state for route {route_id} from cache: {partial_cache_path}')
+            buses = sort_state(pd.concat([buses, read_state_table(partial_cache_path)], ignore_index=True))
 
         return buses
 
+def read_state_csv(cache_path) -> pd.DataFrame:
+    buses = pd.read_csv(
+            cache_path,
+            dtype={
+                'vehicleId': str,
+            },
+            float_precision='high', # keep precision for rounding lat/lon
+        ) \
+        .rename(columns={
+            'latitude': 'LAT',
+            'longitude': 'LON',
+            'vehicleId': 'VID',
+            'timestamp': 'TIME'
+        }) \
+        .reindex(state_columns, axis='columns')
+
+    buses = buses.sort_values('TIME', axis=0)
+
+    return buses
+
+def read_state_table(cache_path) -> pd.DataFrame:
+    # columnar state files are already sorted by TIME, and the numeric columns
+    # are memory-mapped rather than parsed
+    return columnar.read_table(cache_path).get_data_frame(state_columns)
+
+def sort_state(buses: pd.DataFrame) -> pd.DataFrame:
+    # use a stable sort so that observations with the same timestamp stay in the order they were written
+    order = np.argsort(buses['TIME'].values, kind='mergesort')
+    return buses.iloc[order].reset_index(drop=True)
+
+def write_state_table(cache_path, buses: pd.DataFrame):
+    buses = sort_state(buses)
+
+    columnar.write_table(cache_path, {
+        'TIME': buses['TIME'].values.astype(np.int64),
+        'VID': buses['VID'].values.astype(str).astype(object),
+        'LAT': buses['LAT'].values.astype(np.float64),
+        'LON': buses['LON'].values.astype(np.float64),
+    })
+
+def convert_csv_cache(csv_path, remove_csv=False) -> str:
+    '''
+    Converts a CSV state cache file (as written by previous versions of get_state) to the columnar format,
+    saved in the same directory. Returns the path of the columnar file.
+    '''
+    table_path = re.sub(r'\.csv$', f'.{state_table_extension}', csv_path)
+
+    buses = read_state_csv(csv_path)
+
+    write_state_table(table_path, buses)
+
+    if remove_csv:
+        os.remove(csv_path)
+
+    return table_path
+
 def get_key_timestamp(key: str):
     key_parts = key.split('_')
     timestamp_str = key_parts[-1].split('.json')[0]
@@ -60,9 +124,40 @@ def get_bucket_hour_prefix(agency_id: str, timestamp) -> str:
     dt_path_segment = dt.strftime('%Y/%m/%d/%H')
     return f'state/v1/{agency_id}/{dt_path_segment}/'
 
-async def fetch_state_object(session, s3_key, timestamp, route_csv_lines):
-
-    s3_url = f"http://{config.s3_bucket}.s3.amazonaws.com/{s3_key}"
+class S3StateSource:
+    # Lists and locates the raw state objects saved in S3 by opentransit-collector.
+    #
+    # By default this uses the public S3 endpoint for config.s3_bucket. Setting the endpoint_url
+    # (or the OPENTRANSIT_S3_ENDPOINT_URL environment variable) allows fetching state
+    # from a local S3-compatible server instead.
+
+    def __init__(self, bucket_name=None, endpoint_url=None):
+        self.bucket_name = bucket_name if bucket_name is not None else config.s3_bucket
+        self.endpoint_url = endpoint_url if endpoint_url is not None else config.s3_endpoint_url
+        self.bucket = None
+
+    def list_keys(self, key_prefix):
+        # boto3 is only used for listing keys; this is called in a thread pool since it blocks
+        if self.bucket is None:
+            s3 = boto3.resource("s3", endpoint_url=self.endpoint_url)
+            self.bucket = s3.Bucket(self.bucket_name)
+
+        return [obj.key for obj in self.bucket.objects.filter(Prefix=key_prefix)]
+
+    def get_url(self, s3_key):
+        if self.endpoint_url is not None:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket_name}/{s3_key}"
+        return f"http://{self.bucket_name}.s3.amazonaws.com/{s3_key}"
+
+    def get_keys_and_timestamps(self, key_prefix, start_time, end_time):
+        res = []
+        for key in self.list_keys(key_prefix):
+            timestamp = get_key_timestamp(key)
+            if timestamp >= start_time and timestamp < end_time:
+                res.append((key, timestamp))
+        return res
+
+async def fetch_state_object(session, s3_url, timestamp, state_buffers):
 
     async with session.get(s3_url) as r:
         print(s3_url)
@@ -79,59 +174,347 @@ async def fetch_state_object(session, s3_key, timestamp, route_csv_lines):
 
         vehicles = json.loads(text)
 
-        append_vehicles_to_csv(vehicles, timestamp, route_csv_lines)
+        state_buffers.append_vehicles(vehicles, timestamp)
+
+class RouteStateBuffers:
+    # Accumulates GPS observations for each route in numpy record buffers while state objects are fetched.
+    #
+    # When a route's buffer is full, or when the total size of all buffers exceeds max_buffer_bytes,
+    # the buffered observations are appended to a binary temp file for each route and the buffers are released.
+    # Temp files are only opened while flushing, so there isn't an open file handle for every route.
+    # Temp file names include a unique ID for each RouteStateBuffers object, so that multiple downloads
+    # for the same route (e.g. for different dates in backfill.py) don't overwrite each other's files.
+    #
+    # This keeps memory usage bounded regardless of the number of routes or the number of observations per hour.
+
+    record_dtype = np.dtype([
+        ('TIME', '<i8'),
+        ('VID', '<i4'), # index into vid_dictionaries[route_id]
+        ('LAT', '<f8'),
+        ('LON', '<f8'),
+    ])
+
+    min_route_buffer_rows = 256
+    max_route_buffer_rows = 65536
+
+    def __init__(self, agency_id: str, route_ids, max_buffer_bytes, name='state'):
+        self.agency_id = agency_id
+        self.name = name
+        self.route_ids = set(route_ids)
+        self.max_buffer_bytes = max_buffer_bytes
+        self.buffers = {}
+        self.buffer_lengths = {}
+        self.buffer_bytes = 0
+        self.peak_buffer_bytes = 0
+        self.vid_dictionaries = {route_id: {} for route_id in route_ids}
+        self.num_observations = 0
+        self.temp_id = f'{os.getpid()}_{uuid.uuid4().hex[:12]}'
 
-def append_vehicles_to_csv(vehicles, timestamp, route_csv_lines):
-    for vehicle in vehicles:
-        route_id = vehicle['routeId']
+        for route_id in route_ids:
+            with open(self.get_temp_path(route_id), 'wb'):
+                pass
 
-        if route_id not in route_csv_lines:
-            route_csv_lines[route_id] = []
+    def get_temp_path(self, route_id):
+        return get_route_temp_cache_path(self.agency_id, route_id, self.name, self.temp_id)
+
+    def remove_temp_files(self):
+        # removes the temp files created by this object that weren't already removed by get_data_frame
+        for route_id in self.route_ids:
+            temp_path = self.get_temp_path(route_id)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def append_vehicles(self, vehicles, timestamp, route_ids=None):
+        # appends observations from a state object to the buffers for each route.
+        # if route_ids is not None, only observations for those routes are appended.
+        route_rows = {}
+
+        if route_ids is None:
+            route_ids = self.route_ids
+
+        for vehicle in vehicles:
+            route_id = vehicle['routeId']
+
+            if route_id not in route_ids:
+                continue
+
+            vid_dictionary = self.vid_dictionaries[route_id]
+            vid = str(vehicle.get('vehicleId', ''))
+            vid_code = vid_dictionary.get(vid, None)
+            if vid_code is None:
+                vid_code = vid_dictionary[vid] = len(vid_dictionary)
+
+            if route_id not in route_rows:
+                route_rows[route_id] = []
+
+            route_rows[route_id].append((
+                # adjust each observation time for the number of seconds old the GPS location was when the observation was recorded
+                timestamp - vehicle.get('secsSinceReport', 0),
+                vid_code,
+                vehicle.get('latitude', np.nan),
+                vehicle.get('longitude', np.nan),
+            ))
+
+        for route_id, rows in route_rows.items():
+            self.append_rows(route_id, np.array(rows, dtype=self.record_dtype))
+
+        if self.buffer_bytes > self.max_buffer_bytes:
+            self.flush()
+
+    def append_rows(self, route_id, records):
+        num_records = len(records)
+        self.num_observations += num_records
+
+        while num_records > 0:
+            buffer = self.buffers.get(route_id, None)
+            length = self.buffer_lengths.get(route_id, 0)
+
+            if buffer is None or length == len(buffer):
+                if buffer is not None and len(buffer) >= self.max_route_buffer_rows:
+                    self.flush_route(route_id)
+                    length = 0
+                buffer = self.grow_buffer(route_id, length + num_records)
+
+            num_copied = min(num_records, len(buffer) - length)
+            buffer[length:length + num_copied] = records[:num_copied]
+            self.buffer_lengths[route_id] = length + num_copied
+
+            records = records[num_copied:]
+            num_records -= num_copied
+
+    def grow_buffer(self, route_id, min_rows):
+        buffer = self.buffers.get(route_id, None)
+        length = self.buffer_lengths.get(route_id, 0)
+        old_rows = len(buffer) if buffer is not None else 0
+
+        num_rows = max(self.min_route_buffer_rows, old_rows)
+        while num_rows < min_rows and num_rows < self.max_route_buffer_rows:
+            num_rows *= 2
+        num_rows = min(num_rows, self.max_route_buffer_rows)
+
+        new_buffer = np.empty(num_rows, dtype=self.record_dtype)
+        if buffer is not None:
+            new_buffer[:length] = buffer[:length]
+
+        self.buffers[route_id] = new_buffer
+        self.buffer_bytes += (num_rows - old_rows) * self.record_dtype.itemsize
+        self.peak_buffer_bytes = max(self.peak_buffer_bytes, self.buffer_bytes)
+        return new_buffer
+
+    def flush_route(self, route_id):
+        buffer = self.buffers.pop(route_id, None)
+        length = self.buffer_lengths.pop(route_id, 0)
+
+        if buffer is None:
+            return
+
+        self.buffer_bytes -= len(buffer) * self.record_dtype.itemsize
+
+        if length > 0:
+            with open(self.get_temp_path(route_id), 'ab') as f:
+                f.write(buffer[:length].tobytes())
+
+    def flush(self):
+        for route_id in list(self.buffers.keys()):
+            self.flush_route(route_id)
+
+    def get_data_frame(self, route_id) -> pd.DataFrame:
+        # returns all observations for a route (sorted by time), and removes the route's temp file
+        self.flush_route(route_id)
+
+        temp_path = self.get_temp_path(route_id)
+        records = np.fromfile(temp_path, dtype=self.record_dtype)
+        os.remove(temp_path)
+
+        vid_dictionary = self.vid_dictionaries[route_id]
+        vid_values = np.empty(len(vid_dictionary), dtype=object)
+        for vid, vid_code in vid_dictionary.items():
+            vid_values[vid_code] = vid
+
+        return sort_state(pd.DataFrame({
+            'TIME': records['TIME'],
+            'VID': vid_values[records['VID']],
+            'LAT': records['LAT'],
+            'LON': records['LON'],
+        }, columns=state_columns))
+
+    def save(self, route_id, cache_path):
+        # writes all observations for a route to a columnar state cache file
+        write_state_table(cache_path, self.get_data_frame(route_id))
+
+class IncrementalStateBuffers:
+    # Buffers observations for the hours of raw state that are not already cached for each route.
+    #
+    # Observations from hours that ended (or whose part before `end_time` ended) before `complete_before`
+    # are appended to `complete_buffers`,
+    # and will be merged into each route's cache file so they are never downloaded again.
+    # Observations from more recent hours (which may still be missing some state objects in S3)
+    # are appended to `partial_buffers`, which will be saved to a separate file that
+    # is replaced each time get_state runs.
+
+    def __init__(self, agency_id: str, route_ids, route_ids_by_hour: dict, end_time, complete_before, max_buffer_bytes):
+        self.route_ids_by_hour = route_ids_by_hour # map of hour start timestamp => set of route IDs that need that hour
+        self.end_time = end_time
+        self.complete_before = complete_before
+        self.complete_buffers = RouteStateBuffers(agency_id, route_ids, max_buffer_bytes / 2, name='complete')
+        self.partial_buffers = RouteStateBuffers(agency_id, route_ids, max_buffer_bytes / 2, name='partial')
+
+    def append_vehicles(self, vehicles, timestamp):
+        hour = get_hour_start(timestamp)
+
+        route_ids = self.route_ids_by_hour.get(hour, None)
+        if not route_ids:
+            return
+
+        if is_complete_hour(hour, self.end_time, self.complete_before):
+            self.complete_buffers.append_vehicles(vehicles, timestamp, route_ids)
+        else:
+            self.partial_buffers.append_vehicles(vehicles, timestamp, route_ids)
 
-        # adjust each observation time for the number of seconds old the GPS location was when the observation was recorded
-        vehicle['timestamp'] = timestamp - vehicle.get('secsSinceReport', 0)
+    @property
+    def num_observations(self):
+        return self.complete_buffers.num_observations + self.partial_buffers.num_observations
 
-        route_csv_lines[route_id].append(','.join([
-            str(vehicle.get(vehicle_key, ''))
-            for vehicle_key in vehicle_keys
-        ]) + '\n')
+    def remove_temp_files(self):
+        self.complete_buffers.remove_temp_files()
+        self.partial_buffers.remove_temp_files()
 
-async def fetch_state_objects(s3_keys_and_timestamps, route_csv_lines):
-    conn = aiohttp.TCPConnector(limit=8)
-    async with aiohttp.ClientSession(connector=conn) as session:
-        tasks = []
-        for s3_key, timestamp in s3_keys_and_timestamps:
-            task = asyncio.create_task(fetch_state_object(session, s3_key, timestamp, route_csv_lines))
-            tasks.append(task)
+    @property
+    def peak_buffer_bytes(self):
+        return self.complete_buffers.peak_buffer_bytes + self.partial_buffers.peak_buffer_bytes
 
-        return await asyncio.gather(*tasks)
+def get_hour_start(timestamp):
+    # UTC hours always start with a timestamp at multiples of 3600 seconds
+    return int(timestamp - (timestamp % 3600))
+
+def is_complete_hour(hour, end_time, complete_before):
+    # an hour is complete if the part of the hour before end_time (which is all that is fetched)
+    # ended before complete_before, even if end_time is not at the end of an hour
+    return min(hour + 3600, end_time) <= complete_before
+
+async def fetch_state_objects(source: S3StateSource, hour_prefixes, start_time, end_time, state_buffers,
+        concurrency=8, max_pending_keys=1000, list_concurrency=4):
+    # Lists the keys for all hour prefixes concurrently (in a thread pool since boto3 blocks),
+    # and downloads the state objects with `concurrency` parallel requests.
+    #
+    # Keys are passed from the listing tasks to the download tasks via a bounded queue,
+    # so downloads start as soon as the first prefix is listed, continue across hour boundaries
+    # without waiting for the next hour to be listed, and listing can't get too far ahead of downloading.
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max_pending_keys)
+
+    executor = ThreadPoolExecutor(max_workers=list_concurrency)
+
+    async def list_prefix(hour_prefix):
+        s3_keys_and_timestamps = await loop.run_in_executor(executor,
+            source.get_keys_and_timestamps, hour_prefix, start_time, end_time)
+
+        print(f'{hour_prefix}: {len(s3_keys_and_timestamps)} keys')
+
+        for s3_key_and_timestamp in s3_keys_and_timestamps:
+            await queue.put(s3_key_and_timestamp)
+
+    async def list_prefixes():
+        try:
+            await asyncio.gather(*[list_prefix(hour_prefix) for hour_prefix in hour_prefixes])
+        finally:
+            # tell each download task that there are no more keys
+            for _ in range(concurrency):
+                await queue.put(None)
+
+    num_fetched = 0
+
+    async def download(session):
+        nonlocal num_fetched
+        while True:
+            s3_key_and_timestamp = await queue.get()
+            if s3_key_and_timestamp is None:
+                break
+
+            s3_key, timestamp = s3_key_and_timestamp
+            await fetch_state_object(session, source.get_url(s3_key), timestamp, state_buffers)
+            num_fetched += 1
+
+    conn = aiohttp.TCPConnector(limit=concurrency)
+    try:
+        async with aiohttp.ClientSession(connector=conn) as session:
+            tasks = [asyncio.ensure_future(list_prefixes())] + \
+                [asyncio.ensure_future(download(session)) for _ in range(concurrency)]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+    finally:
+        executor.shutdown(wait=False)
+
+    return num_fetched
+
+def get_state(agency_id: str, d: date, start_time, end_time, route_ids, max_buffer_mb=None,
+        concurrency=None, source: S3StateSource = None) -> CachedState:
 
-def get_s3_keys_and_timestamps_with_prefix(bucket, key_prefix, start_time, end_time):
-    res = []
-    for obj in bucket.objects.filter(Prefix=key_prefix):
-        timestamp = get_key_timestamp(obj.key)
-        if timestamp >= start_time and timestamp < end_time:
-            res.append((obj.key, timestamp))
-    return res
+    # The state cache for each route is keyed on the requested time range.
+    # When computing arrivals for the current day, the time range includes hours in the future,
+    # so the cache is built incrementally: a manifest records which hours of raw state
+    # have been saved in the cache for each route, so that running get_state again later in the day
+    # only fetches the hours that are not in the cache yet.
+    start_time = int(start_time)
+    end_time = int(end_time)
 
-def get_state(agency_id: str, d: date, start_time, end_time, route_ids) -> CachedState:
     # don't try to fetch historical vehicle data from the future
     now = int(time.time())
-    if end_time > now:
-        end_time = now
-        print(f'end_time set to current time ({end_time})')
+    fetch_end_time = end_time
+    if fetch_end_time > now:
+        fetch_end_time = now
+        print(f'end_time set to current time ({fetch_end_time})')
+
+    # state objects may be saved to S3 a little while after their timestamp,
+    # so the most recent hours are fetched again the next time get_state runs
+    complete_before = now - complete_hour_delay
+
+    hours = list(range(get_hour_start(start_time), fetch_end_time, 3600))
 
     # saves state to local file system, since keeping the state for all routes in memory
     # while computing arrival times causes causes Python to spend more time doing GC
     state = CachedState()
 
+    manifest_path = get_manifest_path(agency_id, d, start_time, end_time)
+    manifest = load_manifest(manifest_path)
+
+    route_ids_by_hour = {}
     uncached_route_ids = []
+    cached_hours = {}
+
     for route_id in route_ids:
         cache_path = get_cache_path(agency_id, d, start_time, end_time, route_id)
+        csv_cache_path = get_cache_path(agency_id, d, start_time, end_time, route_id, extension='csv')
+
         if Path(cache_path).exists():
-            state.add(route_id, cache_path)
+            if route_id not in manifest:
+                # cache files saved without a manifest (by older versions) always contain all hours
+                state.add(route_id, cache_path)
+                continue
+            cached_hours[route_id] = set(manifest[route_id])
+        elif Path(csv_cache_path).exists():
+            state.add(route_id, csv_cache_path)
+            continue
+        else:
+            cached_hours[route_id] = set()
+
+        missing_hours = [hour for hour in hours if hour not in cached_hours[route_id]]
+        if len(missing_hours) == 0:
+            # if the time range hasn't started yet, there is no state (or cache file) for routes that weren't cached before
+            if Path(cache_path).exists():
+                state.add(route_id, cache_path)
         else:
             uncached_route_ids.append(route_id)
+            for hour in missing_hours:
+                if hour not in route_ids_by_hour:
+                    route_ids_by_hour[hour] = set()
+                route_ids_by_hour[hour].add(route_id)
+
+    instrumentation.count('cached_state_routes', len(route_ids) - len(uncached_route_ids), date=str(d))
 
     if len(uncached_route_ids) == 0:
         print('state already cached')
@@ -141,51 +524,42 @@ def get_state(agency_id: str, d: date, start_time, end_time, route_ids) -> Cache
     if not state_cache_dir.exists():
         state_cache_dir.mkdir(parents = True, exist_ok = True)
 
-    cur_time = start_time
-
-    # UTC hours always start with a timestamp at multiples of 3600 seconds
-    start_hour = start_time - (start_time % 3600)
-
     hour_prefixes = [
-        get_bucket_hour_prefix(agency_id, timestamp)
-        for timestamp in range(int(start_hour), int(end_time), 3600)
+        get_bucket_hour_prefix(agency_id, hour)
+        for hour in sorted(route_ids_by_hour.keys())
     ]
 
-    remove_route_temp_cache(agency_id)
-    route_temp_files = {}
-
-    try:
-        # cache state per route since that's how we need to access it to compute arrival times
-        for route_id in route_ids:
-            temp_cache_path = get_route_temp_cache_path(agency_id, route_id)
-
-            route_temp_file = open(temp_cache_path, 'w+')
-
-            route_temp_files[route_id] = route_temp_file
-
-            # write CSV header
-            route_temp_file.write(','.join(vehicle_keys) + '\n')
+    print(f'fetching {len(hour_prefixes)} of {len(hours)} hours for {len(uncached_route_ids)} routes')
 
-        s3_bucket = config.s3_bucket
+    if max_buffer_mb is None:
+        max_buffer_mb = config.state_buffer_mb
 
-        s3 = boto3.resource("s3")
-        bucket = s3.Bucket(s3_bucket)
+    # remove temp files left over from earlier runs that were interrupted
+    remove_route_temp_cache(agency_id, min_age=86400)
 
-        for hour_prefix in hour_prefixes:
-            print(hour_prefix)
+    # cache state per route since that's how we need to access it to compute arrival times
+    state_buffers = IncrementalStateBuffers(agency_id, uncached_route_ids,
+        route_ids_by_hour=route_ids_by_hour,
+        end_time=end_time,
+        complete_before=complete_before,
+        max_buffer_bytes=max_buffer_mb * 1024 * 1024)
 
-            route_csv_lines = {}
-            s3_keys_and_timestamps = get_s3_keys_and_timestamps_with_prefix(bucket, hour_prefix, start_time, end_time)
+    if concurrency is None:
+        concurrency = config.state_fetch_concurrency
 
-            loop = asyncio.get_event_loop()
-            loop.run_until_complete(fetch_state_objects(s3_keys_and_timestamps, route_csv_lines))
+    if source is None:
+        source = S3StateSource()
 
-            append_csv_lines_to_temp_files(route_csv_lines, route_temp_files)
+    try:
+        with instrumentation.stage('fetch_state', date=str(d)):
+            num_fetched = asyncio.run(fetch_state_objects(source, hour_prefixes, start_time, fetch_end_time, state_buffers,
+                concurrency=concurrency))
 
         created_cache_dir = False
 
-        for route_id in route_ids:
+        for route_id in uncached_route_ids:
             cache_path = get_cache_path(agency_id, d, start_time, end_time, route_id)
+            partial_cache_path = get_cache_path(agency_id, d, start_time, end_time, route_id, partial=True)
 
             if not created_cache_dir:
                 cache_dir = Path(cache_path).parent
@@ -193,31 +567,55 @@ def get_state(agency_id: str, d: date, start_time, end_time, route_ids) -> Cache
                     cache_dir.mkdir(parents = True, exist_ok = True)
                 created_cache_dir = True
 
-            route_temp_file = route_temp_files[route_id]
+            new_buses = state_buffers.complete_buffers.get_data_frame(route_id)
+
+            if len(cached_hours[route_id]) > 0:
+                new_buses = pd.concat([read_state_table(cache_path), new_buses], ignore_index=True)
 
-            temp_cache_path = route_temp_file.name
+            write_state_table(cache_path, new_buses)
 
-            route_temp_file.close()
-            del route_temp_files[route_id]
+            partial_buses = state_buffers.partial_buffers.get_data_frame(route_id)
 
-            os.rename(temp_cache_path, cache_path)
+            if len(partial_buses) > 0:
+                write_state_table(partial_cache_path, partial_buses)
+                state.add(route_id, cache_path, partial_cache_path)
+            else:
+                if Path(partial_cache_path).exists():
+                    os.remove(partial_cache_path)
+                state.add(route_id, cache_path)
 
-            state.add(route_id, cache_path)
+            manifest[route_id] = sorted(cached_hours[route_id].union(
+                hour for hour in route_ids_by_hour if route_id in route_ids_by_hour[hour] and is_complete_hour(hour, end_time, complete_before)
+            ))
+
+        save_manifest(manifest_path, manifest)
     finally:
-        for route_id, f in route_temp_files.items():
-            f.close()
+        state_buffers.remove_temp_files()
 
-    return state
+    instrumentation.count('fetched_state_objects', num_fetched, date=str(d))
+    instrumentation.count('fetched_observations', state_buffers.num_observations, date=str(d))
+    instrumentation.count('fetched_state_routes', len(uncached_route_ids), date=str(d))
+
+    print(f'fetched {state_buffers.num_observations} observations from {num_fetched} state objects, '
+        f'peak buffer size {round(state_buffers.peak_buffer_bytes / 1024 / 1024, 1)} MB, '
+        f'peak RSS {util.get_peak_rss_mb()} MB')
 
-def append_csv_lines_to_temp_files(route_csv_lines, route_temp_files):
-    # the CSV lines are likely not in chronological order since state files are fetched
-    # asynchronously, but it doesn't matter because they are sorted by CachedState.get_for_route
-    # after adjusting for secsSinceReport
-    for route_id, csv_lines in route_csv_lines.items():
-        route_temp_file = route_temp_files.get(route_id, None)
+    return state
 
-        if route_temp_file is not None:
-            route_temp_file.writelines(csv_lines)
+def load_manifest(manifest_path) -> dict:
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(manifest_path, manifest: dict):
+    # get_state may run for the same date in multiple processes (e.g. compute_new.py and get_state.py),
+    # so each one writes its own temp file before replacing the manifest
+    temp_path = f'{manifest_path}.tmp{os.getpid()}_{uuid.uuid4().hex[:12]}'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, manifest_path)
 
 def validate_agency_id(agency_id: str):
     if re.match('^[\w\-]+$', agency_id) is None:
@@ -229,34 +627,46 @@ def validate_agency_route_path_attributes(agency_id: str, route_id: str):
     if re.match('^[\w\-]+$', route_id) is None:
         raise Exception(f"Invalid route id: {route_id}")
 
-@functools.lru_cache()
 def get_state_cache_dir(agency_id):
     validate_agency_id(agency_id)
-    source_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
     return os.path.join(
-        source_dir,
-        'data',
+        util.get_data_dir(),
         f"state_v4_{agency_id}",
     )
 
-def get_route_temp_cache_path(agency_id: str, route_id: str) -> str:
+def get_route_temp_cache_path(agency_id: str, route_id: str, name='state', temp_id=None) -> str:
     validate_agency_route_path_attributes(agency_id, route_id)
+    temp_suffix = f"_{temp_id}" if temp_id is not None else ""
     return os.path.join(
         get_state_cache_dir(agency_id),
-        f"state_{agency_id}_{route_id}_temp_cache.csv",
+        f"{name}_{agency_id}_{route_id}{temp_suffix}_temp_cache.bin",
     )
 
-def remove_route_temp_cache(agency_id: str):
-    """Removes all files with the ending temp_cache.csv in the
-    source data directory"""
+def remove_route_temp_cache(agency_id: str, min_age=0):
+    """Removes all files with the ending temp_cache.bin (or temp_cache.csv,
+    written by older versions) in the source data directory that were last modified
+    at least min_age seconds ago"""
     dir = get_state_cache_dir(agency_id)
+    now = time.time()
     for path in os.listdir(dir):
-        if path.endswith('_temp_cache.csv'):
-            os.remove(os.path.join(dir, path))
-
-def get_cache_path(agency_id: str, d: date, start_time, end_time, route_id) -> str:
+        if path.endswith(('_temp_cache.bin', '_temp_cache.csv')):
+            full_path = os.path.join(dir, path)
+            try:
+                if now - os.stat(full_path).st_mtime >= min_age:
+                    os.remove(full_path)
+            except FileNotFoundError:
+                pass
+
+def get_cache_path(agency_id: str, d: date, start_time, end_time, route_id, extension=state_table_extension, partial=False) -> str:
     validate_agency_route_path_attributes(agency_id, route_id)
     return os.path.join(
         get_state_cache_dir(agency_id),
-        f"{str(d)}/state_{agency_id}_{route_id}_{int(start_time)}_{int(end_time)}.csv",
+        f"{str(d)}/state_{agency_id}_{route_id}_{int(start_time)}_{int(end_time)}{'_partial' if partial else ''}.{extension}",
+    )
+
+def get_manifest_path(agency_id: str, d: date, start_time, end_time) -> str:
+    validate_agency_id(agency_id)
+    return os.path.join(
+        get_state_cache_dir(agency_id),
+        f"{str(d)}/state_{agency_id}_{int(start_time)}_{int(end_time)}_hours.json",
     )
@@ -0,0 +1,10 @@
+import pandas as pd
+from backend.models.synthetic_state import make_route_config, make_route_state
+
+# Helpers for tests of arrival detection.
+# make_route_config and make_route_state generate a synthetic route and GPS observations (see models/synthetic_state.py).
+
+def sort_arrivals(arrivals: pd.DataFrame) -> list:
+    return sorted(arrivals[
+        ['VID', 'TIME', 'DEPARTURE_TIME', 'DIST', 'SID', 'DID', 'STOP_INDEX', 'OBS_GROUP', 'TRIP']
+    ].itertuples(index=False, name=None))
@@ -0,0 +1,57 @@
+import backend_path
+import unittest
+import tempfile
+from datetime import date
+from unittest import mock
+from backend.models import arrival_checkpoints, config, eclipses, util
+import arrivals_fixtures
+
+class ArrivalCheckpointsTest(unittest.TestCase):
+
+    def test_find_arrivals_incremental(self):
+        agency = config.get_agency('test')
+        route_config = arrivals_fixtures.make_route_config()
+        d = date(2019, 12, 28)
+        start_time = 1577534400
+        end_time = start_time + 86400
+
+        state = arrivals_fixtures.make_route_state(route_config, start_time, start_time + 8 * 3600, num_vehicles=4)
+
+        full_arrivals = eclipses.find_arrivals(agency, state, route_config, d)
+        self.assertGreater(len(full_arrivals), 100)
+        self.assertGreater(full_arrivals['OBS_GROUP'].max(), 1)
+
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(util, 'get_data_dir', return_value=temp_dir), \
+                mock.patch.object(eclipses, 'resample_buses', wraps=eclipses.resample_buses) as resample_buses:
+
+            for hours in [2, 3, 3.5, 4, 5, 6, 7, 7.9, 8]:
+                partial_state = state[state['TIME'] < start_time + hours * 3600]
+
+                expected_arrivals = eclipses.find_arrivals(agency, partial_state, route_config, d)
+
+                arrivals = arrival_checkpoints.find_arrivals(agency, partial_state, route_config, d, start_time, end_time)
+
+                self.assertEqual(arrivals_fixtures.sort_arrivals(arrivals), arrivals_fixtures.sort_arrivals(expected_arrivals))
+
+                # after the first run, only the most recent observations are processed again
+                num_processed = len(resample_buses.call_args[0][0])
+                if hours > 2:
+                    self.assertLess(num_processed, len(partial_state) / 2)
+
+            self.assertEqual(arrivals_fixtures.sort_arrivals(arrivals), arrivals_fixtures.sort_arrivals(full_arrivals))
+
+            # no new observations
+            arrivals = arrival_checkpoints.find_arrivals(agency, state, route_config, d, start_time, end_time)
+            self.assertEqual(arrivals_fixtures.sort_arrivals(arrivals), arrivals_fixtures.sort_arrivals(full_arrivals))
+
+            # if observations before the last processed observation change, that vehicle is processed again
+            late_state = state.drop(state.index[(state['VID'] == 'V2').values][100]).reset_index(drop=True)
+            arrivals = arrival_checkpoints.find_arrivals(agency, late_state, route_config, d, start_time, end_time)
+            self.assertEqual(
+                arrivals_fixtures.sort_arrivals(arrivals),
+                arrivals_fixtures.sort_arrivals(eclipses.find_arrivals(agency, late_state, route_config, d)),
+            )
+
+if __name__ == '__main__':
+    unittest.main()
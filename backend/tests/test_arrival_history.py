@@ -1,9 +1,15 @@
 import backend_path
 import unittest
 import datetime
+import itertools
+import json
+import os
+import tempfile
+import time
+from unittest import mock
 import numpy as np
 import pandas as pd
-from backend.models import arrival_history
+from backend.models import arrival_history, cache, util
 
 class ArrivalHistoryTest(unittest.TestCase):
 
@@ -29,9 +35,10 @@ class ArrivalHistoryTest(unittest.TestCase):
         )
 
         hist = arrival_history.from_data_frame('test', 'A', arrivals_df, start_time, end_time)
-        arrival_history.save_for_date(hist, d)
 
-        history = arrival_history.get_by_date('test', 'A', d)
+        with tempfile.TemporaryDirectory() as temp_dir, mock.patch.object(util, 'get_data_dir', return_value=temp_dir):
+            arrival_history.save_for_date(hist, d)
+            history = arrival_history.get_by_date('test', 'A', d)
 
         self.assertEqual(history.agency_id, 'test')
         self.assertEqual(history.route_id, 'A')
@@ -69,5 +76,188 @@ class ArrivalHistoryTest(unittest.TestCase):
         self.assertEqual(df['TIME'].values[0], 1577530990)
         self.assertEqual(df['TIME'].values[-1], 1577550900)
 
+    def test_to_json(self):
+        arrivals_df = pd.DataFrame([
+                ['V1', 1577530900, 1577530960, 3.4, 'S1', '1', 2],
+                ['V2', 1577530900, 1577530900, 7.5, 'S1', '1', 3],
+                ['V1', 1577530990, 1577531010, 4.6, 'S2', '1', 2],
+                ['V3', 1577530950, 1577530970, 0.0, 'S2', '0', 4],
+                ['V1', 1577550900, 1577550960, 9.0, 'S10', '0', 5],
+            ],
+            columns=[
+                'VID','TIME','DEPARTURE_TIME','DIST','SID','DID','TRIP'
+            ]
+        )
+
+        history = arrival_history.from_data_frame('test', 'A', arrivals_df, 1577530800, 1577617200)
+
+        stops_data = history.columns.get_stops_data()
+        self.assertEqual(list(stops_data.keys()), ['S1', 'S10', 'S2'])
+        self.assertEqual(list(stops_data['S2']['arrivals'].keys()), ['0', '1'])
+        self.assertEqual([arrival['d'] for arrival in stops_data['S1']['arrivals']['1']], [3, 8])
+
+        self.assertEqual(history.to_json(), json.dumps(history.get_data()))
+
+        empty_history = arrival_history.from_data_frame('test', 'A', arrivals_df.iloc[:0], 1577530800, 1577617200)
+        self.assertEqual(empty_history.to_json(), json.dumps(empty_history.get_data()))
+
+    def test_get_data_frame_filters(self):
+        stops_data = {
+            'S1': {'arrivals': {
+                '0': [{'t': 1000, 'e': 1010, 'd': 5, 'v': 1, 'i': 1}, {'t': 2000, 'e': 2030, 'd': 12, 'v': 22, 'i': 2}],
+                '1': [{'t': 1500, 'e': 1500, 'd': 0, 'v': 22, 'i': 3}],
+            }},
+            'S2': {'arrivals': {
+                '0': [{'t': 1100, 'e': 1120, 'd': 8, 'v': 1, 'i': 1}, {'t': 2100, 'e': 2100, 'd': 3, 'v': 22, 'i': 2}],
+            }},
+        }
+
+        def get_stops_data_frame(stops_data, direction_id=None, stop_id=None, vehicle_id=None):
+            # filters arrivals by looping over stops_data, like ArrivalHistory.get_data_frame did before using ArrivalColumns
+            data = []
+            for s, stop_info in stops_data.items():
+                if stop_id is not None and s != stop_id:
+                    continue
+                for did, arrivals in stop_info['arrivals'].items():
+                    if direction_id is not None and did != direction_id:
+                        continue
+                    for arrival in arrivals:
+                        if vehicle_id is not None and arrival['v'] != vehicle_id:
+                            continue
+                        data.append((arrival['v'], arrival['t'], arrival['e'], s, did, arrival['d'], arrival['i']))
+            return pd.DataFrame(data = data, columns = arrival_history.arrival_columns)
+
+        # vehicle IDs are ints in some arrival histories and strings in others
+        str_stops_data = json.loads(json.dumps(stops_data).replace('"v": 1,', '"v": "0001",').replace('"v": 22,', '"v": "V22",'))
+
+        for data in [stops_data, str_stops_data]:
+            history = arrival_history.ArrivalHistory('test', 'A', data, start_time=0, end_time=86400)
+
+            for stop_id, direction_id, vehicle_id in itertools.product(
+                    [None, 'S1', 'S2', 'S3'], [None, '0', '1'], [None, 1, 22, 5, '0001', 'V22', '1', 'V5']):
+                df = history.get_data_frame(stop_id=stop_id, direction_id=direction_id, vehicle_id=vehicle_id)
+                expected_df = get_stops_data_frame(data, stop_id=stop_id, direction_id=direction_id, vehicle_id=vehicle_id)
+                if expected_df.empty:
+                    self.assertTrue(df.empty)
+                    self.assertEqual(list(df.columns), list(expected_df.columns))
+                else:
+                    pd.testing.assert_frame_equal(df.reset_index(drop=True), expected_df, check_dtype=False)
+
+    def test_columns(self):
+        d = datetime.date(2019,12,28)
+
+        stops_data = {
+            'S1': {'arrivals': {
+                '0': [{'t': 1000, 'e': 1010, 'd': 5, 'v': 'V1', 'i': 1}, {'t': 2000, 'e': 2030, 'd': 12, 'v': 'V2', 'i': 2}],
+                '1': [{'t': 1500, 'e': 1500, 'd': 0, 'v': 'V2', 'i': 3}],
+            }},
+            'S2': {'arrivals': {
+                '0': [{'t': 1100, 'e': 1120, 'd': 8, 'v': 'V1', 'i': 1}, {'t': 2100, 'e': 2100, 'd': 3, 'v': 'V2', 'i': 2},
+                      {'t': 3100, 'e': 3110, 'd': 30, 'v': 'V1', 'i': 4}],
+            }},
+            'S3': {'arrivals': {'0': []}},
+        }
+
+        history = arrival_history.ArrivalHistory('test', 'A', stops_data, start_time=0, end_time=86400)
+
+        with tempfile.TemporaryDirectory() as temp_dir, mock.patch.object(util, 'get_data_dir', return_value=temp_dir):
+            arrival_history.save_for_date(history, d)
+
+            columns_history = arrival_history.get_by_date('test', 'A', d)
+            self.assertIsNotNone(columns_history.columns)
+            self.assertEqual(columns_history.get_data(), history.get_data())
+
+            # filtered data frames are the same as from the JSON arrival history
+            for stop_id, direction_id, vehicle_id, (start_time, end_time) in itertools.product(
+                    [None, 'S1', 'S2', 'S3', 'S4'], [None, '0', '1'], [None, 'V1', 'V3'],
+                    [(None, None), (1100, None), (None, 2100), (1050, 2100), (3000, 1000)]):
+                pd.testing.assert_frame_equal(
+                    columns_history.get_data_frame(stop_id=stop_id, direction_id=direction_id, vehicle_id=vehicle_id,
+                        start_time=start_time, end_time=end_time),
+                    history.get_data_frame(stop_id=stop_id, direction_id=direction_id, vehicle_id=vehicle_id,
+                        start_time=start_time, end_time=end_time)
+                )
+
+            # the JSON cache is used if it is newer than the columnar cache
+            json_path = arrival_history.get_cache_path('test', 'A', d)
+            with open(json_path, 'w') as f:
+                json.dump(arrival_history.ArrivalHistory('test', 'A', {}, start_time=0, end_time=86400).get_data(), f)
+
+            columns_path = arrival_history.get_cache_path('test', 'A', d, extension='cols')
+            columns_mtime = os.stat(json_path).st_mtime - 10
+            os.utime(columns_path, (columns_mtime, columns_mtime))
+
+            json_history = arrival_history.get_by_date('test', 'A', d)
+            self.assertEqual(json_history.stops_data, {})
+            self.assertTrue(json_history.get_data_frame().empty)
+
+    def test_compact_archive_agency_date(self):
+        # 2019-12-31 02:00 UTC is still 2019-12-30 in the agency's time zone (America/Los_Angeles)
+        class MockDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return datetime.datetime.fromtimestamp(1577757600, tz)
+
+        dates = [datetime.date(2019,12,29), datetime.date(2019,12,30)]
+
+        with tempfile.TemporaryDirectory() as temp_dir, mock.patch.object(util, 'get_data_dir', return_value=temp_dir), \
+                mock.patch.object(arrival_history, 'datetime', MockDatetime):
+            for d in dates:
+                arrival_history.save_for_date(arrival_history.ArrivalHistory('test', 'A', {}, start_time=0, end_time=86400), d)
+
+            archive_path = arrival_history.compact_archive('test', 'A', dates[0], remove_daily=True)
+
+            # arrivals for the agency's current date may still be computed again, so they are not archived
+            self.assertEqual(list(arrival_history.read_archive(archive_path).keys()), [dates[0]])
+            self.assertTrue(os.path.exists(arrival_history.get_cache_path('test', 'A', dates[1])))
+
+    def test_archive(self):
+        dates = [datetime.date(2019,12,28), datetime.date(2019,12,29), datetime.date(2019,12,31)]
+
+        histories = {}
+        for i, d in enumerate(dates):
+            stops_data = {
+                'S1': {'arrivals': {'0': [{'t': 1000 + i, 'e': 1010 + i, 'd': 5, 'v': f'V{i}', 'i': 1}]}},
+            }
+            histories[d] = arrival_history.ArrivalHistory('test', 'A', stops_data, start_time=i, end_time=86400 + i)
+
+        with tempfile.TemporaryDirectory() as temp_dir, mock.patch.object(util, 'get_data_dir', return_value=temp_dir):
+            for d, history in histories.items():
+                arrival_history.save_for_date(history, d)
+
+            archive_path = arrival_history.compact_archive('test', 'A', dates[0], remove_daily=True)
+            self.assertEqual(archive_path, arrival_history.get_archive_path('test', 'A', dates[-1]))
+            self.assertFalse(os.path.exists(arrival_history.get_cache_path('test', 'A', dates[0])))
+
+            for d, history in histories.items():
+                archived_history = arrival_history.get_by_date('test', 'A', d)
+                self.assertEqual(archived_history.get_data(), history.get_data())
+
+            self.assertEqual(sorted(arrival_history.read_archive(archive_path).keys()), dates)
+
+            # the open archive is kept in the shared cache
+            self.assertIn(('arrival_archive', archive_path), cache.shared_cache)
+
+            # arrival history saved again after the archive was written is loaded from the daily file
+            new_history = arrival_history.ArrivalHistory('test', 'A', {}, start_time=0, end_time=86400)
+            arrival_history.save_for_date(new_history, dates[1])
+
+            archive_mtime = os.stat(arrival_history.get_cache_path('test', 'A', dates[1])).st_mtime - 10
+            os.utime(archive_path, (archive_mtime, archive_mtime))
+
+            self.assertEqual(arrival_history.get_by_date('test', 'A', dates[1]).get_data_frame().empty, True)
+            self.assertEqual(arrival_history.get_by_date('test', 'A', dates[0]).get_data(), histories[dates[0]].get_data())
+
+            # compacting again adds the new daily file to the archive
+            arrival_history.compact_archive('test', 'A', dates[1], remove_daily=True)
+            self.assertEqual(arrival_history.get_by_date('test', 'A', dates[1]).get_data(), new_history.get_data())
+            self.assertEqual(len(arrival_history.read_archive(archive_path)), 3)
+
+            # archives written more than a day ago are still used
+            archive_mtime = time.time() - 2 * 86400
+            os.utime(archive_path, (archive_mtime, archive_mtime))
+            self.assertEqual(arrival_history.get_from_archive('test', 'A', dates[0]).get_data(), histories[dates[0]].get_data())
+            self.assertEqual(arrival_history.get_by_date('test', 'A', dates[2]).get_data(), histories[dates[2]].get_data())
+
 if __name__ == '__main__':
     unittest.main()
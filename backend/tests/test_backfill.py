@@ -0,0 +1,94 @@
+import backend_path
+import unittest
+import tempfile
+import threading
+import time
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from backend.models import backfill
+
+class BackfillTest(unittest.TestCase):
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            journal_path = f'{temp_dir}/backfill_test/backfill.jsonl'
+
+            journal = backfill.BackfillJournal(journal_path)
+            d = date(2019, 12, 28)
+
+            self.assertFalse(journal.is_done('arrivals', 'test', d, 'v4c', 'R1'))
+
+            journal.record('arrivals', 'test', d, 'v4c', 'R1', seconds=1.5)
+            journal.record('arrivals', 'test', d, 'v4c', 'R2', status='error', error='failed')
+            journal.record('stats', 'test', d, 'v2-v4c')
+
+            self.assertTrue(journal.is_done('arrivals', 'test', d, 'v4c', 'R1'))
+
+            # simulate a process being killed while writing a line
+            with open(journal_path, 'a') as f:
+                f.write('{"stage": "arrivals", "agency": "test", "date": "2019-12-28", "route": "R3"')
+
+            journal = backfill.BackfillJournal(journal_path)
+
+            self.assertTrue(journal.is_done('arrivals', 'test', d, 'v4c', 'R1'))
+            self.assertTrue(journal.is_done('arrivals', 'test', '2019-12-28', 'v4c', 'R1'))
+            self.assertFalse(journal.is_done('arrivals', 'test', d, 'v4d', 'R1'))
+            self.assertFalse(journal.is_done('arrivals', 'test', d, 'v4c', 'R2'))
+            self.assertFalse(journal.is_done('arrivals', 'test', d, 'v4c', 'R3'))
+            self.assertFalse(journal.is_done('arrivals', 'test', date(2019, 12, 29), 'v4c', 'R1'))
+            self.assertTrue(journal.is_done('stats', 'test', d, 'v2-v4c'))
+
+    def test_journal_threads(self):
+        # the download thread checks the journal while the main thread records work units
+        with tempfile.TemporaryDirectory() as temp_dir:
+            journal_path = f'{temp_dir}/backfill_test/backfill.jsonl'
+
+            journal = backfill.BackfillJournal(journal_path)
+            d = date(2019, 12, 28)
+            route_ids = [f'R{i}' for i in range(200)]
+
+            def check_routes():
+                return sum(journal.is_done('arrivals', 'test', d, 'v4c', route_id) for route_id in route_ids)
+
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = [executor.submit(journal.record, 'arrivals', 'test', d, 'v4c', route_id) for route_id in route_ids]
+                for _ in range(20):
+                    self.assertLessEqual(check_routes(), len(route_ids))
+                for future in futures:
+                    future.result()
+
+            self.assertEqual(check_routes(), len(route_ids))
+
+            # every line was written completely
+            self.assertEqual(backfill.BackfillJournal(journal_path).done, journal.done)
+            with open(journal_path) as f:
+                self.assertEqual(len(f.readlines()), len(route_ids))
+
+    def test_run_bounded(self):
+        lock = threading.Lock()
+        inflight_bytes = 0
+        max_observed_bytes = 0
+
+        def run_task(num_bytes):
+            nonlocal inflight_bytes, max_observed_bytes
+            with lock:
+                inflight_bytes += num_bytes
+                max_observed_bytes = max(max_observed_bytes, inflight_bytes)
+            time.sleep(0.01)
+            with lock:
+                inflight_bytes -= num_bytes
+            return num_bytes * 2
+
+        sizes = [30, 50, 20, 100, 10, 40, 40, 5]
+        tasks = [(i, size, run_task, (size,)) for i, size in enumerate(sizes)]
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = {key: future.result() for key, future in backfill.run_bounded(executor, tasks, 60)}
+
+        self.assertEqual(results, {i: size * 2 for i, size in enumerate(sizes)})
+
+        # the task with 100 bytes is allowed to run by itself
+        self.assertEqual(max_observed_bytes, 100)
+
+if __name__ == '__main__':
+    unittest.main()
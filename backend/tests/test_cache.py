@@ -0,0 +1,108 @@
+import backend_path
+import unittest
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from backend.models import cache, columnar, arrival_history
+
+class CacheTest(unittest.TestCase):
+
+    def test_lru_cache(self):
+        lru_cache = cache.LRUCache(max_bytes=100)
+
+        lru_cache.set(('a', 1), 'A', size=40)
+        lru_cache.set(('b', 1), 'B', size=40)
+        self.assertEqual(lru_cache.get(('a', 1)), 'A')
+
+        # ('b', 1) is the least recently used
+        lru_cache.set(('c', 1), 'C', size=40)
+        self.assertEqual(lru_cache.get(('b', 1)), None)
+        self.assertEqual(lru_cache.get(('a', 1)), 'A')
+        self.assertEqual(lru_cache.get(('c', 1)), 'C')
+        self.assertEqual(lru_cache.total_bytes, 80)
+
+        # replacing a value updates the total size
+        lru_cache.set(('c', 1), 'C2', size=10)
+        self.assertEqual(lru_cache.total_bytes, 50)
+
+        lru_cache.remove_where(lambda key: key[0] == 'a')
+        self.assertEqual(len(lru_cache), 1)
+        self.assertEqual(lru_cache.total_bytes, 10)
+
+        # a value larger than max_bytes is kept until another value is added
+        lru_cache.set('big', 'X', size=500)
+        self.assertEqual(lru_cache.get('big'), 'X')
+        self.assertEqual(len(lru_cache), 1)
+
+    def test_get_stats(self):
+        lru_cache = cache.LRUCache(max_bytes=100)
+
+        lru_cache.set(('headways', 'A', 1), 'H1', size=30)
+        lru_cache.set(('headways', 'A', 2), 'H2', size=20)
+        lru_cache.set(('trip_times', 'A', 1), 'T1', size=10)
+
+        lru_cache.get(('headways', 'A', 1))
+        lru_cache.get(('headways', 'A', 2))
+        lru_cache.get(('headways', 'A', 3))
+        lru_cache.get(('wait_time_stats', 'A', 1))
+
+        stats = lru_cache.get_stats()
+        self.assertEqual(stats['entries'], 3)
+        self.assertEqual(stats['bytes'], 60)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['types']['headways'], {'entries': 2, 'bytes': 50, 'hits': 2, 'misses': 1})
+        self.assertEqual(stats['types']['trip_times'], {'entries': 1, 'bytes': 10, 'hits': 0, 'misses': 0})
+        self.assertEqual(stats['types']['wait_time_stats'], {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 1})
+
+    def test_get_size(self):
+        values = np.zeros(1000, dtype=np.int64)
+        self.assertGreaterEqual(cache.get_size(values), 8000)
+        self.assertGreaterEqual(cache.get_size({'a': values, 'b': [values]}), 8000)
+        self.assertLess(cache.get_size({'a': values, 'b': [values]}), 16000)
+
+        df = pd.DataFrame({'TIME': values, 'SID': ['S1'] * 1000})
+        self.assertGreaterEqual(cache.get_size(df), 8000 + 8000)
+
+    @unittest.skipIf(not os.path.exists('/proc/self/fd'), 'requires /proc/self/fd')
+    def test_mapped_files(self):
+        def get_num_open_files():
+            return len(os.listdir('/proc/self/fd'))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # memory-mapped arrays don't count towards max_bytes, but each file keeps a file descriptor open
+            lru_cache = cache.LRUCache(max_bytes=1024 * 1024 * 1024, max_mapped_files=10)
+
+            num_open_files = get_num_open_files()
+
+            for i in range(300):
+                path = os.path.join(temp_dir, f'history_{i}.cols')
+                history = arrival_history.from_data_frame('test', 'A', pd.DataFrame({
+                    'VID': ['V1', 'V2'], 'TIME': [1000 + i, 2000], 'DEPARTURE_TIME': [1010 + i, 2010],
+                    'SID': ['S1', 'S2'], 'DID': ['0', '0'], 'DIST': [1, 2], 'TRIP': [1, 2],
+                }), 0, 86400)
+                arrival_history.write_columns_file(path, history)
+
+                lru_cache.set(('arrival_history', i), (arrival_history.read_columns_file(path), i))
+
+                self.assertLessEqual(get_num_open_files(), num_open_files + 10)
+
+            # tables from the same file are only counted once
+            table = columnar.read_table(path)
+            lru_cache.set(('table', 1), table)
+            lru_cache.set(('table', 2), {'TIME': table.columns['TIME'][1:]})
+
+            stats = lru_cache.get_stats()
+            self.assertEqual(stats['mapped_files'], 10)
+            self.assertEqual(len(lru_cache), 11)
+            self.assertLess(stats['bytes'], 1024 * 1024)
+            self.assertIsNotNone(lru_cache.get(('arrival_history', 291)))
+            self.assertIsNone(lru_cache.get(('arrival_history', 290)))
+
+            del history, table
+            lru_cache.clear()
+            self.assertEqual(get_num_open_files(), num_open_files)
+
+if __name__ == '__main__':
+    unittest.main()
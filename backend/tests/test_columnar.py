@@ -0,0 +1,91 @@
+import backend_path
+import unittest
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from backend.models import columnar, vehicle_positions
+
+class ColumnarTest(unittest.TestCase):
+
+    def test_write_read_table(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'table.cols')
+
+            columnar.write_table(path, {
+                'TIME': np.array([100, 200, 300], dtype=np.int64),
+                'VID': np.array(['b', 'a', 'b'], dtype=object),
+                'LAT': np.array([37.1234567891234, 37.2, 37.3]),
+                'EMPTY': np.array([], dtype=np.float64),
+            }, meta={'route_id': '1'})
+
+            for use_mmap in [True, False]:
+                table = columnar.read_table(path, use_mmap=use_mmap)
+
+                self.assertEqual(table.meta, {'route_id': '1'})
+                self.assertEqual(table.get_column_names(), ['TIME', 'VID', 'LAT', 'EMPTY'])
+                self.assertEqual(table.columns['TIME'].dtype, np.int64)
+                self.assertEqual(table.columns['TIME'].tolist(), [100, 200, 300])
+                self.assertEqual(table.columns['LAT'].tolist(), [37.1234567891234, 37.2, 37.3])
+                self.assertEqual(len(table.columns['EMPTY']), 0)
+                self.assertEqual(columnar.is_memory_mapped(table.columns['TIME'][1:]), use_mmap)
+
+                # string columns are dictionary-encoded
+                self.assertEqual(table.columns['VID'].dtype, np.int32)
+                self.assertEqual(table.columns['VID'].tolist(), [1, 0, 1])
+                self.assertEqual(table.get_values('VID').tolist(), ['b', 'a', 'b'])
+
+                # columns are views of the file contents, not writable copies
+                self.assertFalse(table.columns['TIME'].flags.writeable)
+
+                df = table.get_data_frame(['VID', 'TIME'])
+                self.assertEqual(list(df.columns), ['VID', 'TIME'])
+                self.assertEqual(df['VID'].values[0], 'b')
+
+    def test_write_table_threads(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'table.cols')
+
+            def write(i):
+                columnar.write_table(path, {'TIME': np.arange(i * 1000, dtype=np.int64)}, meta={'i': i})
+
+            # writers in the same process don't share a temp file, so the last complete table wins
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                for future in [executor.submit(write, i) for i in range(1, 50)]:
+                    future.result()
+
+            table = columnar.read_table(path)
+            self.assertEqual(len(table.columns['TIME']), table.meta['i'] * 1000)
+            self.assertEqual(os.listdir(temp_dir), ['table.cols'])
+
+    def test_convert_csv_state_cache(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            csv_path = os.path.join(temp_dir, 'state_test_A_1577530800_1577617200.csv')
+
+            with open(csv_path, 'w') as f:
+                f.write(','.join(vehicle_positions.vehicle_keys) + '\n')
+                f.write('1577531000,0123,37.7750123456789,-122.4183\n')
+                f.write('1577530900,V1,37.7749,-122.4194123456789\n')
+                f.write('1577531000,V1,37.775,-122.419\n')
+
+            csv_df = vehicle_positions.read_state_csv(csv_path)
+
+            table_path = vehicle_positions.convert_csv_cache(csv_path)
+            self.assertTrue(table_path.endswith('.cols'))
+
+            df = vehicle_positions.read_state_table(table_path)
+
+            self.assertEqual(list(df.columns), ['TIME', 'VID', 'LAT', 'LON'])
+            self.assertEqual(df['TIME'].tolist(), [1577530900, 1577531000, 1577531000])
+
+            # vehicle IDs with leading zeros are preserved as strings
+            self.assertEqual(df['VID'].tolist(), ['V1', '0123', 'V1'])
+
+            # coordinates are identical to parsing the CSV file with high precision
+            def get_rows(df):
+                return sorted(zip(df['TIME'], df['VID'], df['LAT'], df['LON']))
+
+            self.assertEqual(get_rows(df), get_rows(csv_df))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import backend_path
+import unittest
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import date
+from unittest import mock
+import arrivals_fixtures
+
+# compute_arrivals.py and compute_stats.py import the backend modules as `models` (not `backend.models`),
+# so the backend directory is added to sys.path and the tests patch the `models` modules used by the scripts.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compute_arrivals
+import compute_stats
+from models import arrival_history, config, precomputed_stats, routeconfig, timetables, util, vehicle_positions
+
+d = date(2019, 12, 28)
+route_ids = ['R1', 'R2']
+
+# worker processes only use the patched data directory if they are forked from the test process
+@unittest.skipIf(multiprocessing.get_start_method() != 'fork', 'requires fork start method')
+class ComputeWorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agency = config.get_agency('test')
+        self.start_time, self.end_time = compute_arrivals.get_time_range(d, self.agency.default_day_start_hour, self.agency.tz)
+
+        self.route_configs = [arrivals_fixtures.make_route_config(route_id=route_id) for route_id in route_ids]
+        self.states = {
+            route_config.id: arrivals_fixtures.make_route_state(route_config,
+                self.start_time + 6 * 3600, self.start_time + 10 * 3600, num_vehicles=3, seed=i)
+            for i, route_config in enumerate(self.route_configs)
+        }
+
+    @contextmanager
+    def data_dir(self):
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(util, 'get_data_dir', return_value=temp_dir), \
+                mock.patch.object(timetables, 'get_by_date', side_effect=FileNotFoundError('no timetable')):
+            routeconfig.save_routes('test', self.route_configs)
+            yield temp_dir
+
+    def compute_arrivals(self, route_ids, workers, failed_route_ids=[]):
+        state = vehicle_positions.CachedState()
+        for route_id in route_ids:
+            cache_path = vehicle_positions.get_cache_path('test', d, self.start_time, self.end_time, route_id)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            if route_id in failed_route_ids:
+                with open(cache_path, 'wb') as f:
+                    f.write(b'invalid')
+            else:
+                vehicle_positions.write_state_table(cache_path, self.states[route_id])
+            state.add(route_id, cache_path)
+
+        with mock.patch.object(vehicle_positions, 'get_state', return_value=state):
+            compute_arrivals.compute_arrivals(d, self.agency, route_ids, save_to_s3=False, workers=workers)
+
+    def get_arrivals(self, route_id):
+        with open(arrival_history.get_cache_path('test', route_id, d)) as f:
+            return json.load(f)
+
+    def get_stats(self):
+        time_str_intervals, _ = compute_stats.get_stats_intervals(d, self.agency.tz)
+        stats = {}
+        for stat_id in precomputed_stats.AllStatIds:
+            for start_time_str, end_time_str in time_str_intervals:
+                with open(precomputed_stats.get_cache_path('test', stat_id, d, start_time_str, end_time_str)) as f:
+                    stats[(stat_id, start_time_str, end_time_str)] = json.load(f)
+        return stats
+
+    def test_compute_arrivals_workers(self):
+        with self.data_dir():
+            self.compute_arrivals(route_ids, workers=1)
+            serial_arrivals = {route_id: self.get_arrivals(route_id) for route_id in route_ids}
+
+        for route_id in route_ids:
+            self.assertGreater(len(serial_arrivals[route_id]['stops']), 0)
+
+        with self.data_dir():
+            # arrivals are saved for the other routes if a worker fails
+            with self.assertRaisesRegex(Exception, 'Error computing arrivals for 1 routes: R3'):
+                self.compute_arrivals(route_ids + ['R3'], workers=2, failed_route_ids=['R3'])
+
+            for route_id in route_ids:
+                self.assertEqual(self.get_arrivals(route_id), serial_arrivals[route_id])
+
+            self.assertFalse(os.path.exists(arrival_history.get_cache_path('test', 'R3', d)))
+
+    def test_compute_stats_workers(self):
+        with self.data_dir():
+            self.compute_arrivals(route_ids, workers=1)
+
+            compute_stats.compute_stats(d, self.agency, self.route_configs, save_to_s3=False, workers=1)
+            serial_stats = self.get_stats()
+
+            self.assertEqual(set(serial_stats[(precomputed_stats.StatIds.Combined, None, None)]['routes'].keys()), set(route_ids))
+
+            compute_stats.compute_stats(d, self.agency, self.route_configs, save_to_s3=False, workers=2)
+            self.assertEqual(self.get_stats(), serial_stats)
+
+            # stats are not saved if a worker fails
+            with open(arrival_history.get_cache_path('test', 'R3', d), 'w') as f:
+                f.write('invalid')
+
+            for path in self.get_stats_paths():
+                os.remove(path)
+
+            routes = self.route_configs + [arrivals_fixtures.make_route_config(route_id='R3')]
+            with self.assertRaisesRegex(Exception, 'Error computing stats for 1 routes: R3'):
+                compute_stats.compute_stats(d, self.agency, routes, save_to_s3=False, workers=2)
+
+            for path in self.get_stats_paths():
+                self.assertFalse(os.path.exists(path))
+
+    def get_stats_paths(self):
+        time_str_intervals, _ = compute_stats.get_stats_intervals(d, self.agency.tz)
+        return [
+            precomputed_stats.get_cache_path('test', stat_id, d, start_time_str, end_time_str)
+            for stat_id in precomputed_stats.AllStatIds
+            for start_time_str, end_time_str in time_str_intervals
+        ]
+
+if __name__ == '__main__':
+    unittest.main()
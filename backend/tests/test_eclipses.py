@@ -0,0 +1,264 @@
+import backend_path
+import unittest
+import numpy as np
+import pandas as pd
+from backend.models import eclipses, routeconfig, util
+import arrivals_fixtures
+
+class EclipsesTest(unittest.TestCase):
+
+    def assert_resample_buses_equal(self, route_state):
+        expected_buses = pd.concat([
+            eclipses.resample_bus(bus)
+            for vid, bus in route_state.groupby(route_state['VID'])
+        ], ignore_index=True)
+        expected_buses = expected_buses[expected_buses['TIME'] != 0]
+
+        buses = eclipses.resample_buses(route_state)
+
+        pd.testing.assert_frame_equal(buses, expected_buses)
+
+    def test_resample_buses(self):
+        route_config = arrivals_fixtures.make_route_config()
+
+        start_time = 1577534400
+        route_state = arrivals_fixtures.make_route_state(route_config, start_time, start_time + 6 * 3600, num_vehicles=5)
+
+        self.assert_resample_buses_equal(route_state)
+
+    def test_resample_buses_edge_cases(self):
+        lat = 37.77
+        lon = -122.45
+        meters = 1 / 111320
+
+        route_state = pd.DataFrame([
+            # duplicate observations, small movements, and moving 10 km in one minute (not interpolated)
+            (1000, '0012', lat, lon),
+            (1001, '0012', lat + 100 * meters, lon),
+            (1015, '0012', lat + 100 * meters, lon),
+            (1030, '0012', lat + 110 * meters, lon),
+            (1060, '0012', lat + 10000 * meters, lon),
+            # gap of more than 30 minutes starts a new observation group
+            (3000, '0012', lat + 10100 * meters, lon),
+            (3060, '0012', lat + 10400 * meters, lon),
+            # moving 300 m in 3 minutes (not interpolated)
+            (3240, '0012', lat + 10700 * meters, lon),
+            # vehicle with a single observation
+            (1500, 'A', lat, lon),
+            # vehicle with two gaps
+            (100, 'B', lat, lon),
+            (2000, 'B', lat, lon),
+            (2030, 'B', lat + 62.5 * meters, lon + 30 * meters),
+            (4000, 'B', lat, lon),
+        ], columns=['TIME', 'VID', 'LAT', 'LON']).sort_values('TIME', kind='mergesort')
+
+        self.assert_resample_buses_equal(route_state)
+
+        buses = eclipses.resample_buses(route_state)
+        self.assertEqual(buses[buses['VID'] == 'B']['OBS_GROUP'].tolist(), [1, 2, 2, 2, 3])
+        self.assertEqual(buses[buses['VID'] == '0012']['OBS_GROUP'].max(), 2)
+
+        # separator rows are removed, leaving gaps in the index between vehicles and observation groups
+        self.assertTrue(np.all(np.diff(buses.index.values) >= 1))
+        self.assertEqual(np.count_nonzero(np.diff(buses.index.values) > 1), 5)
+
+    def test_resample_buses_empty(self):
+        buses = eclipses.resample_buses(pd.DataFrame(columns=['TIME', 'VID', 'LAT', 'LON']))
+        self.assertTrue(buses.empty)
+        self.assertEqual(list(buses.columns), ['VID', 'LAT', 'LON', 'TIME', 'OBS_GROUP'])
+
+    def test_get_possible_arrivals_spatial_index(self):
+        class TestAgency:
+            tz = None
+            invalid_direction_times = []
+
+        route_config = arrivals_fixtures.make_route_config(num_stops=40, stop_spacing=150)
+
+        start_time = 1577534400
+        route_state = arrivals_fixtures.make_route_state(route_config, start_time, start_time + 6 * 3600, num_vehicles=5)
+
+        buses = eclipses.resample_buses(route_state)
+        possible_arrivals = eclipses.get_possible_arrivals(TestAgency(), buses, route_config, None, include_eclipse_times=True)
+
+        # distances to each stop are only added to the buses data frame without the spatial index
+        self.assertFalse(any(column.startswith('DIST_') for column in buses.columns))
+
+        dense_buses = buses.copy()
+        expected_possible_arrivals = eclipses.get_possible_arrivals(TestAgency(), dense_buses, route_config, None,
+            include_eclipse_times=True, use_spatial_index=False)
+
+        self.assertTrue(len(possible_arrivals) > 0)
+        pd.testing.assert_frame_equal(possible_arrivals, expected_possible_arrivals)
+
+        pd.testing.assert_frame_equal(
+            eclipses.clean_arrivals(possible_arrivals, buses, route_config),
+            eclipses.clean_arrivals(expected_possible_arrivals, dense_buses, route_config)
+        )
+
+    def test_find_arrivals_route_shapes(self):
+        class TestAgency:
+            tz = None
+            invalid_direction_times = []
+
+        for shape in ['curve', 'loop']:
+            route_config = arrivals_fixtures.make_route_config(num_stops=20, stop_spacing=250, shape=shape)
+
+            dir_infos = route_config.get_direction_infos()
+            self.assertEqual(len(dir_infos), 1 if shape == 'loop' else 2)
+            self.assertEqual(dir_infos[0].is_loop(), shape == 'loop')
+
+            # consecutive stops are stop_spacing meters apart
+            stop_infos = [route_config.get_stop_info(stop_id) for stop_id in dir_infos[0].get_stop_ids()]
+            for stop_info, next_stop_info in zip(stop_infos, stop_infos[1:]):
+                self.assertAlmostEqual(
+                    util.haver_distance(stop_info.lat, stop_info.lon, next_stop_info.lat, next_stop_info.lon), 250, delta=5)
+
+            start_time = 1577534400
+            route_state = arrivals_fixtures.make_route_state(route_config, start_time, start_time + 4 * 3600,
+                num_vehicles=3, gap_probability=0)
+
+            buses = eclipses.resample_buses(route_state)
+            arrivals = eclipses.clean_arrivals(
+                eclipses.get_possible_arrivals(TestAgency(), buses, route_config, None), buses, route_config)
+
+            # each vehicle arrives at every stop more than once
+            arrival_counts = arrivals.groupby(['VID', 'SID']).size()
+            self.assertEqual(len(arrival_counts), 3 * len(route_config.get_stop_ids()))
+            self.assertTrue(arrival_counts.min() >= 2)
+
+    def test_get_eclipse_nadirs(self):
+        def get_eclipse_nadirs_loop(distance_values, time_values, eclipse_start_indexes, eclipse_end_indexes, is_terminal):
+            # previous implementation, computing each eclipse separately
+            nadirs = []
+            for start_index, end_index in zip(eclipse_start_indexes, eclipse_end_indexes):
+                eclipse_distance_values = distance_values[start_index:end_index]
+                min_dist = np.min(eclipse_distance_values)
+                at_stop_indexes = np.nonzero(
+                    eclipse_distance_values <= ((min_dist + 75) if is_terminal else (min_dist + 25))
+                )[0]
+                eclipse_time_values = time_values[start_index:end_index]
+                nadirs.append((eclipse_time_values[at_stop_indexes[0]], eclipse_time_values[at_stop_indexes[-1]], min_dist))
+            return tuple(np.array(values) for values in zip(*nadirs))
+
+        rng = np.random.RandomState(0)
+
+        # eclipses with 1 to 30 observations, including repeated distances
+        eclipse_lengths = rng.randint(1, 30, 500)
+        eclipse_end_indexes = np.cumsum(eclipse_lengths)
+        eclipse_start_indexes = eclipse_end_indexes - eclipse_lengths
+
+        num_rows = eclipse_end_indexes[-1]
+        distance_values = np.round(rng.uniform(0, 200, num_rows), -1)
+        time_values = np.cumsum(rng.randint(5, 60, num_rows))
+
+        for is_terminal in [False, True]:
+            nadirs = eclipses.get_eclipse_nadirs(distance_values, time_values, eclipse_start_indexes, eclipse_end_indexes, is_terminal)
+            expected_nadirs = get_eclipse_nadirs_loop(distance_values, time_values, eclipse_start_indexes, eclipse_end_indexes, is_terminal)
+
+            for values, expected_values in zip(nadirs, expected_nadirs):
+                self.assertEqual(values.tolist(), expected_values.tolist())
+
+        # bus approaches the stop, waits 2 minutes slightly before the stop, and leaves
+        distance_values = np.array([150, 100, 60, 40, 30, 35, 30, 90, 180.0])
+        time_values = np.arange(1000, 1090, 10)
+        arrival_time_values, departure_time_values, min_dist_values = eclipses.get_eclipse_nadirs(
+            distance_values, time_values, np.array([0, 7]), np.array([7, 9]), is_terminal=False)
+
+        self.assertEqual(arrival_time_values.tolist(), [1030, 1070])
+        self.assertEqual(departure_time_values.tolist(), [1060, 1070])
+        self.assertEqual(min_dist_values.tolist(), [30, 90])
+
+    def test_make_buses_map(self):
+        buses = pd.DataFrame({
+            'VID': ['B', 'B', 'A', 'C', 'A', 'C', 'C'],
+            'TIME': np.arange(7) * 10,
+        }, index=[0, 1, 3, 4, 5, 8, 9])
+
+        # observations for each vehicle may or may not be contiguous in the buses data frame
+        for buses_order in [[0, 1, 2, 3, 4, 5, 6], [0, 1, 2, 4, 3, 5, 6]]:
+            ordered_buses = buses.iloc[buses_order]
+            buses_map = eclipses.make_buses_map(ordered_buses)
+
+            self.assertEqual(sorted(buses_map.keys()), ['A', 'B', 'C'])
+            for vid, bus in ordered_buses.groupby('VID'):
+                pd.testing.assert_frame_equal(buses_map[vid], bus)
+
+    def make_dir_info(self, num_stops, is_loop=False):
+        return routeconfig.DirectionInfo(None, {
+            'id': '0',
+            'title': 'Direction 0',
+            'gtfs_direction_id': '0',
+            'gtfs_shape_id': '0',
+            'stops': [f'S{i}' for i in range(num_stops)],
+            'loop': is_loop,
+            'stop_geometry': {},
+        })
+
+    def make_dir_arrivals(self, stop_indexes, dists=None):
+        num_arrivals = len(stop_indexes)
+        times = np.arange(num_arrivals) * 60 + 1000
+        return pd.DataFrame({
+            'VID': 'V1',
+            'TIME': times,
+            'DEPARTURE_TIME': times + 10,
+            'DIST': dists if dists is not None else np.full(num_arrivals, 10.0),
+            'SID': [f'S{i}' for i in stop_indexes],
+            'DID': '0',
+            'STOP_INDEX': stop_indexes,
+            'OBS_GROUP': 1,
+            'TRIP': -1,
+        }, columns=eclipses.arrival_columns)
+
+    def test_get_arrivals_with_ascending_stop_index(self):
+        cases = [
+            # twisty route with out-of-order stops
+            (10, False, [1,2,6,3,7,4,5,6,3,4,7,8,9], None,
+                [0,1,3,5,6,7,10,11,12], [5,5,5,5,5,5,5,5,5], [(12, 13)]),
+            # trip in the opposite direction between two trips, with the closest of two arrivals at stop 3
+            (8, False, [0,1,2,3,4,5,6,7,6,5,4,3,0,1,2,3,3,4,5,7], [10] * 15 + [30, 5] + [10] * 3,
+                [0,1,2,3,4,5,6,7,12,13,14,16,17,18,19], [5,5,5,5,5,5,5,5,6,6,6,6,6,6,6], [(7, 8)]),
+            # loop route
+            (6, True, [4,5,0,1,2,3,4,5,0,1,3,2,4,5,0], None,
+                [0,1,2,3,4,5,6,7,8,9,11,12,13,14], [5] * 14, []),
+            (12, False, [5,4,3,2,1,0,1,2,3,9,10,11], None,
+                [5,6,7,8,9,10,11], [5] * 7, []),
+        ]
+
+        for num_stops, is_loop, stop_indexes, dists, expected_row_indexes, expected_trips, expected_finish_points in cases:
+            dir_info = self.make_dir_info(num_stops, is_loop)
+            finish_points = []
+
+            dir_arrivals, next_trip = eclipses.get_arrivals_with_ascending_stop_index(
+                self.make_dir_arrivals(stop_indexes, dists), dir_info, 5, finish_points=finish_points)
+
+            self.assertEqual(dir_arrivals.index.tolist(), expected_row_indexes)
+            self.assertEqual(dir_arrivals['TRIP'].tolist(), expected_trips)
+            self.assertEqual(next_trip, max(expected_trips) + 1)
+            self.assertEqual(finish_points, expected_finish_points)
+
+        # all groups at once
+        all_dir_arrivals = pd.concat([self.make_dir_arrivals(stop_indexes, dists) for _, _, stop_indexes, dists, _, _, _ in cases])
+        group_lengths = [len(stop_indexes) for _, _, stop_indexes, _, _, _, _ in cases]
+        group_end_indexes = np.cumsum(group_lengths)
+
+        row_indexes, trip_ids, next_trip = eclipses.find_ascending_trips(
+            all_dir_arrivals['STOP_INDEX'].values,
+            all_dir_arrivals['TIME'].values,
+            all_dir_arrivals['DEPARTURE_TIME'].values,
+            all_dir_arrivals['DIST'].values,
+            group_end_indexes - group_lengths,
+            group_end_indexes,
+            [self.make_dir_info(num_stops, is_loop) for num_stops, is_loop, _, _, _, _, _ in cases],
+            0
+        )
+
+        self.assertEqual(row_indexes.tolist(), [
+            row_index + group_end_index - group_length
+            for (_, _, _, _, expected_row_indexes, _, _), group_end_index, group_length in zip(cases, group_end_indexes, group_lengths)
+            for row_index in expected_row_indexes
+        ])
+        self.assertEqual(trip_ids.tolist(), [0] * 9 + [1] * 8 + [2] * 7 + [3] * 14 + [4] * 7)
+        self.assertEqual(next_trip, 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import backend_path
+import unittest
+import csv
+import json
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from backend.models import instrumentation
+
+def compute_in_worker(route_id, num_arrivals):
+    with instrumentation.stage('find_arrivals', route=route_id):
+        instrumentation.count('arrivals', num_arrivals, route=route_id)
+    if num_arrivals < 0:
+        raise Exception(f"Invalid number of arrivals: {num_arrivals}")
+    return route_id
+
+class InstrumentationTest(unittest.TestCase):
+
+    def tearDown(self):
+        instrumentation.current_report = None
+
+    def test_no_report(self):
+        with instrumentation.stage('find_arrivals', route='R1'):
+            instrumentation.count('arrivals', 10, route='R1')
+
+        self.assertIsNone(instrumentation.get_report())
+
+    def test_report(self):
+        report = instrumentation.start_report('test')
+
+        with instrumentation.stage('get_state', date='2019-12-28'):
+            for route_id, num_arrivals in [('R1', 10), ('R2', 5)]:
+                with instrumentation.stage('find_arrivals', route=route_id):
+                    instrumentation.count('arrivals', num_arrivals, route=route_id)
+
+        try:
+            with instrumentation.stage('find_arrivals', route='R3'):
+                raise Exception("failed")
+        except Exception:
+            pass
+
+        self.assertEqual([(record['type'], record['name']) for record in report.records], [
+            ('counter', 'arrivals'),
+            ('stage', 'find_arrivals'),
+            ('counter', 'arrivals'),
+            ('stage', 'find_arrivals'),
+            ('stage', 'get_state'),
+            ('stage', 'find_arrivals'),
+        ])
+        self.assertEqual(report.records[1]['route'], 'R1')
+        self.assertEqual(report.records[4]['date'], '2019-12-28')
+
+        summary = report.get_summary()
+        self.assertEqual(summary['counters'], {'arrivals': 15})
+        self.assertEqual(summary['stages']['find_arrivals']['count'], 3)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            instrumentation.save_report(f'{temp_dir}/reports/report.json')
+            with open(f'{temp_dir}/reports/report.json', 'r') as f:
+                data = json.load(f)
+
+            self.assertEqual(data['name'], 'test')
+            self.assertEqual(data['records'], report.records)
+            self.assertEqual(data['summary'], summary)
+
+            instrumentation.save_report(f'{temp_dir}/report.csv')
+            with open(f'{temp_dir}/report.csv', 'r') as f:
+                rows = list(csv.DictReader(f))
+
+            self.assertEqual(len(rows), len(report.records))
+            self.assertEqual((rows[0]['run'], rows[0]['name'], rows[0]['route'], rows[0]['value']), ('test', 'arrivals', 'R1', '10'))
+            self.assertEqual(rows[4]['route'], '')
+
+    def test_trace_memory(self):
+        report = instrumentation.start_report('test', trace_memory=True)
+
+        with instrumentation.stage('allocate'):
+            values = [list(range(100)) for i in range(1000)]
+
+        instrumentation.snapshot_memory('after_allocate')
+
+        self.assertTrue(report.records[0]['memory_mb'] > 0.5)
+        self.assertTrue(report.records[0]['peak_memory_mb'] >= report.records[0]['memory_mb'])
+        self.assertTrue(any(record['type'] == 'memory' for record in report.records))
+
+    def test_submit(self):
+        report = instrumentation.start_report('test')
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            futures = [
+                instrumentation.submit(executor, compute_in_worker, route_id, num_arrivals)
+                for route_id, num_arrivals in [('R1', 10), ('R2', 5), ('R3', -1)]
+            ]
+
+            self.assertEqual(futures[0].result(), 'R1')
+            self.assertEqual(futures[1].result(), 'R2')
+            with self.assertRaises(Exception):
+                futures[2].result()
+
+        # records from the worker processes are added to the report in the main process
+        self.assertEqual(report.get_summary()['counters'], {'arrivals': 15})
+        self.assertEqual(sorted(record['route'] for record in report.records if record['type'] == 'stage'), ['R1', 'R2'])
+
+if __name__ == '__main__':
+    unittest.main()
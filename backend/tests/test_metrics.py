@@ -0,0 +1,131 @@
+import backend_path
+import unittest
+import datetime
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+from unittest import mock
+from backend.models import metrics, arrival_history, timetables, util
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.metrics_cache.clear()
+
+    def test_prefetch(self):
+        dates = [datetime.date(2019,12,1) + datetime.timedelta(days=i) for i in range(6)]
+
+        lock = threading.Lock()
+        loaded_dates = []
+        thread_ids = set()
+
+        def get_arrival_history(agency_id, route_id, d):
+            time.sleep(0.05)
+            with lock:
+                loaded_dates.append(d)
+                thread_ids.add(threading.get_ident())
+            if d == dates[-1]:
+                raise FileNotFoundError('not found')
+            return arrival_history.ArrivalHistory(agency_id, route_id, {}, start_time=0, end_time=86400)
+
+        timetable_dates = []
+
+        def get_timetable(agency_id, route_id, d):
+            with lock:
+                timetable_dates.append(d)
+            return d
+
+        # two date keys for weekdays and weekends
+        date_keys = {str(d): ('2019-12-02' if d.weekday() < 5 else '2019-12-07') for d in dates}
+
+        agency_metrics = metrics.AgencyMetrics('test')
+
+        with mock.patch.object(arrival_history, 'get_by_date', side_effect=get_arrival_history) as get_by_date, \
+                mock.patch.object(timetables, 'get_by_date', side_effect=get_timetable), \
+                mock.patch.object(timetables, 'get_date_keys', return_value=date_keys):
+
+            route_metrics = agency_metrics.get_route_metrics('A')
+            route_metrics.prefetch(dates, timetables=True)
+
+            self.assertEqual(sorted(loaded_dates), dates)
+            self.assertGreater(len(thread_ids), 1)
+            self.assertEqual(sorted(timetable_dates), dates)
+
+            # prefetched data (including missing arrival histories) is not loaded again
+            for d in dates:
+                route_metrics.get_arrival_history(d)
+                self.assertEqual(route_metrics.get_timetable(d), d)
+            route_metrics.prefetch(dates, timetables=True)
+
+            self.assertEqual(get_by_date.call_count, len(dates))
+            self.assertEqual(len(timetable_dates), len(dates))
+            self.assertTrue(route_metrics.get_arrival_history(dates[-1]).get_data_frame().empty)
+
+    def test_shared_cache(self):
+        agency_metrics = metrics.get_agency_metrics('test')
+        self.assertIs(metrics.get_agency_metrics('test'), agency_metrics)
+
+        today = datetime.datetime.now(agency_metrics.agency.tz).date()
+        old_date = today - datetime.timedelta(days=30)
+
+        def get_arrival_history(agency_id, route_id, d):
+            return arrival_history.ArrivalHistory(agency_id, route_id, {}, start_time=0, end_time=86400)
+
+        with tempfile.TemporaryDirectory() as temp_dir, mock.patch.object(util, 'get_data_dir', return_value=temp_dir), \
+                mock.patch.object(arrival_history, 'get_by_date', side_effect=get_arrival_history) as get_by_date:
+
+            for d in [today, old_date]:
+                cache_path = arrival_history.get_cache_path('test', 'A', d)
+                os.makedirs(os.path.dirname(cache_path))
+                with open(cache_path, 'w') as f:
+                    f.write('{}')
+
+            # arrival histories are shared by RouteMetrics objects in different requests
+            history = agency_metrics.get_route_metrics('A').get_arrival_history(today)
+            self.assertIs(metrics.AgencyMetrics('test').get_route_metrics('A').get_arrival_history(today), history)
+
+            old_history = agency_metrics.get_route_metrics('A').get_arrival_history(old_date)
+
+            # arrival history for today is loaded again when the file changes, but not for older dates
+            for d in [today, old_date]:
+                cache_path = arrival_history.get_cache_path('test', 'A', d)
+                mtime = os.stat(cache_path).st_mtime + 10
+                os.utime(cache_path, (mtime, mtime))
+
+            self.assertIsNot(agency_metrics.get_route_metrics('A').get_arrival_history(today), history)
+            self.assertIs(agency_metrics.get_route_metrics('A').get_arrival_history(old_date), old_history)
+            self.assertEqual(get_by_date.call_count, 3)
+
+    def test_compute_headway_minutes_by_day(self):
+        time_values_arr = [
+            np.array([1000, 1060, 1300, 1900], dtype=np.int64),
+            np.array([], dtype=object),
+            np.array([90000], dtype=np.int64),
+            np.array([87000, 87600, 88800], dtype=np.int64),
+        ]
+
+        for start_times, end_times in [
+                (None, None),
+                (np.array([1060, 0, 0, 87300]), None),
+                (None, np.array([1900, 0, 0, 88800])),
+                (np.array([1200, 0, 0, 86000]), np.array([1400, 0, 0, 87500])),
+            ]:
+            day_headways = metrics.compute_headway_minutes_by_day(time_values_arr, start_times, end_times)
+            day_counts = metrics.count_by_day(time_values_arr, start_times, end_times)
+
+            self.assertEqual(len(day_headways), len(time_values_arr))
+
+            for i, time_values in enumerate(time_values_arr):
+                start_time = int(start_times[i]) if start_times is not None else None
+                end_time = int(end_times[i]) if end_times is not None else None
+
+                self.assertEqual(day_headways[i].tolist(),
+                    metrics.compute_headway_minutes(time_values, start_time, end_time).tolist())
+
+                self.assertEqual(day_counts[i], len([t for t in time_values
+                    if (start_time is None or t >= start_time) and (end_time is None or t < end_time)]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,24 @@
 import backend_path
 import unittest
 import json
+import tempfile
+from unittest import mock
 from graphene.test import Client
 import pandas as pd
 import datetime
-from backend.models import arrival_history, routeconfig
+from backend.models import arrival_history, routeconfig, util
 from backend.models.schema import metrics_api
 
 class SchemaTest(unittest.TestCase):
 
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+
+        data_dir_patch = mock.patch.object(util, 'get_data_dir', return_value=temp_dir.name)
+        data_dir_patch.start()
+        self.addCleanup(data_dir_patch.stop)
+
     def test_route_metrics_query(self):
 
         routeconfig.save_routes('test', [], save_to_s3=False)
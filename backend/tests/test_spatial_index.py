@@ -0,0 +1,45 @@
+import backend_path
+import unittest
+import numpy as np
+from backend.models import spatial_index, util
+
+class SpatialIndexTest(unittest.TestCase):
+
+    def assert_query_radius_equal(self, index, lat_values, lon_values, lat, lon, radius):
+        indexes, distances = index.query_radius(lat, lon, radius)
+
+        all_distances = util.haver_distance(lat, lon, lat_values, lon_values)
+        expected_indexes = np.nonzero(all_distances < radius)[0]
+
+        self.assertEqual(indexes.tolist(), expected_indexes.tolist())
+        np.testing.assert_allclose(distances, all_distances[expected_indexes])
+
+    def test_query_radius(self):
+        rng = np.random.RandomState(0)
+
+        # points spread over about 20 km x 20 km, with many points at the same location
+        lat_values = np.r_[37.7 + rng.uniform(0, 0.18, 5000), np.full(50, 37.8)]
+        lon_values = np.r_[-122.5 + rng.uniform(0, 0.23, 5000), np.full(50, -122.4)]
+
+        index = spatial_index.GridIndex(lat_values, lon_values)
+        self.assertEqual(len(index), 5050)
+
+        for lat, lon in zip(lat_values[:100], lon_values[:100]):
+            for radius in [50, 200, 300, 1000]:
+                self.assert_query_radius_equal(index, lat_values, lon_values, lat, lon, radius)
+
+        self.assert_query_radius_equal(index, lat_values, lon_values, 37.8, -122.4, 200)
+
+        # far outside the grid
+        indexes, distances = index.query_radius(40, -100, 200)
+        self.assertEqual(len(indexes), 0)
+        self.assertEqual(len(distances), 0)
+
+    def test_query_radius_empty(self):
+        index = spatial_index.GridIndex(np.array([]), np.array([]))
+        indexes, distances = index.query_radius(37.8, -122.4, 200)
+        self.assertEqual(len(indexes), 0)
+        self.assertEqual(len(distances), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import backend_path
+import unittest
+import datetime
+import itertools
+import json
+import os
+import tempfile
+from unittest import mock
+import pandas as pd
+from backend.models import timetables, util
+
+class TimetablesTest(unittest.TestCase):
+
+    def test_columns(self):
+        data = {
+            'timezone_id': 'America/Los_Angeles',
+            'arrivals': {
+                '0': {
+                    'S1': [{'t': 21600, 'e': 21660, 'i': 1}, {'t': 25200, 'i': 2}],
+                    'S2': [{'t': 21900, 'e': 21900, 'i': 1}, {'t': 25500, 'e': 25560, 'i': 2}],
+                },
+                '1': {
+                    'S2': [{'t': 23000, 'e': 23030, 'i': 3}],
+                    'S3': [],
+                },
+            },
+        }
+
+        d = datetime.date(2019,12,28)
+        date_start_time = 1577520000
+
+        with tempfile.TemporaryDirectory() as temp_dir, mock.patch.object(util, 'get_data_dir', return_value=temp_dir), \
+                mock.patch.object(timetables, 'get_date_key', return_value='2019-12-28'):
+
+            cache_path = timetables.get_cache_path('test', 'A', '2019-12-28')
+            os.makedirs(os.path.dirname(cache_path))
+            with open(cache_path, 'w') as f:
+                json.dump(data, f)
+
+            timetable = timetables.get_by_date('test', 'A', d)
+            self.assertTrue(timetable.is_memory_mapped())
+            self.assertEqual(timetable.date_start_time, date_start_time)
+            self.assertTrue(os.path.exists(timetables.get_cache_path('test', 'A', '2019-12-28', extension='cols')))
+
+            json_timetable = timetables.Timetable('test', 'A', data['arrivals'], date_start_time)
+
+            # filtered data frames are the same as from the JSON timetable
+            for stop_id, direction_id, (start_time, end_time) in itertools.product(
+                    [None, 'S1', 'S2', 'S3', 'S4'], [None, '0', '1'],
+                    [(None, None), (date_start_time + 21900, None), (None, date_start_time + 25200)]):
+                df = timetable.get_data_frame(stop_id=stop_id, direction_id=direction_id, start_time=start_time, end_time=end_time)
+                json_df = json_timetable.get_data_frame(stop_id=stop_id, direction_id=direction_id, start_time=start_time, end_time=end_time)
+                if json_df.empty:
+                    self.assertTrue(df.empty)
+                else:
+                    pd.testing.assert_frame_equal(df, json_df, check_dtype=False)
+
+            # the columnar file is converted again if the JSON timetable is newer
+            data['arrivals']['1']['S3'] = [{'t': 24000, 'i': 4}]
+            with open(cache_path, 'w') as f:
+                json.dump(data, f)
+
+            columns_path = timetables.get_cache_path('test', 'A', '2019-12-28', extension='cols')
+            columns_mtime = os.stat(cache_path).st_mtime - 10
+            os.utime(columns_path, (columns_mtime, columns_mtime))
+
+            df = timetables.get_by_date('test', 'A', d).get_data_frame(stop_id='S3')
+            self.assertEqual(df['TIME'].tolist(), [date_start_time + 24000])
+            self.assertEqual(df['DEPARTURE_TIME'].tolist(), [date_start_time + 24000])
+
+if __name__ == '__main__':
+    unittest.main()
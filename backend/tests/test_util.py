@@ -2,6 +2,7 @@ import backend_path
 import unittest
 import datetime
 import numpy as np
+import pytz
 from backend.models import util
 
 class UtilTest(unittest.TestCase):
@@ -58,6 +59,44 @@ class UtilTest(unittest.TestCase):
             ]
         )
 
+    def test_get_timestamps_or_none(self):
+        tz = pytz.timezone('America/Los_Angeles')
+
+        # includes dates when daylight saving time starts (2019-03-10) and ends (2019-11-03)
+        dates = [datetime.date(2019,3,9) + datetime.timedelta(days=i) for i in range(3)] + \
+            [datetime.date(2019,11,2) + datetime.timedelta(days=i) for i in range(3)]
+
+        for time_str in ['00:00', '01:30', '02:30', '07:15:30', '02:30+1']:
+            self.assertEqual(
+                util.get_timestamps_or_none(dates, time_str, tz).tolist(),
+                [util.get_timestamp_or_none(d, time_str, tz) for d in dates]
+            )
+
+        self.assertIsNone(util.get_timestamps_or_none(dates, None, tz))
+        self.assertEqual(len(util.get_timestamps_or_none([], '07:00', tz)), 0)
+
+    def test_get_timestamps(self):
+        tz = pytz.timezone('America/Los_Angeles')
+
+        dates = [datetime.date(2019,3,10), datetime.date(2019,3,10), datetime.date(2019,11,3), datetime.date(2019,12,1)]
+        time_strs = ['02:30', '19:00', '01:30', '03:00+1']
+
+        self.assertEqual(
+            util.get_timestamps(dates, time_strs, tz).tolist(),
+            [util.get_timestamp_or_none(d, time_str, tz) for d, time_str in zip(dates, time_strs)]
+        )
+        self.assertEqual(util.get_timestamp_or_none(datetime.date(2019,12,1), '03:00+1', tz), 1575284400)
+
+        # timestamps for the same date and time string are only computed once
+        hits = util.get_timestamp_or_none.cache_info().hits
+        util.get_timestamp_or_none(datetime.date(2019,12,1), '03:00+1', tz)
+        self.assertEqual(util.get_timestamp_or_none.cache_info().hits, hits + 1)
+
+        self.assertEqual(
+            util.format_timestamps([1575284400, 1552213800], tz).tolist(),
+            ['2019-12-02 03:00:00', '2019-03-10 03:30:00']
+        )
+
     def test_haver_distance(self):
 
         lat1 = np.array([45.5181719,45.5245765])
@@ -0,0 +1,310 @@
+import backend_path
+import unittest
+import os
+import tempfile
+import json
+import asyncio
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from unittest import mock
+from aiohttp import web
+from pathlib import Path
+from backend.models import vehicle_positions, util
+
+def make_vehicles(route_id, vids, timestamp, secs_since_report=0):
+    return [{
+        'routeId': route_id,
+        'vehicleId': vid,
+        'latitude': 37.7 + i * 0.001 + timestamp * 1e-7,
+        'longitude': -122.4 - i * 0.001,
+        'secsSinceReport': secs_since_report,
+    } for i, vid in enumerate(vids)]
+
+class VehiclePositionsTest(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+
+        data_dir_patch = mock.patch.object(util, 'get_data_dir', return_value=temp_dir.name)
+        data_dir_patch.start()
+        self.addCleanup(data_dir_patch.stop)
+
+    def get_state_objects(self):
+        state_objects = []
+        for i, timestamp in enumerate(range(1577534000, 1577535000, 15)):
+            vehicles = make_vehicles('A', ['V1', 'V2', '0003'], timestamp, secs_since_report=i % 4) \
+                + make_vehicles('B', ['V4'], timestamp) \
+                + make_vehicles('C', ['V5'], timestamp)
+            state_objects.append((vehicles, timestamp))
+
+        # state objects are not fetched in chronological order
+        state_objects.reverse()
+        return state_objects
+
+    def save_state(self, max_buffer_bytes):
+        agency_id = 'test'
+        Path(vehicle_positions.get_state_cache_dir(agency_id)).mkdir(parents=True, exist_ok=True)
+
+        state_buffers = vehicle_positions.RouteStateBuffers(agency_id, ['A', 'B'], max_buffer_bytes=max_buffer_bytes)
+
+        for vehicles, timestamp in self.get_state_objects():
+            state_buffers.append_vehicles(vehicles, timestamp)
+
+            self.assertLessEqual(state_buffers.buffer_bytes, max(max_buffer_bytes,
+                state_buffers.min_route_buffer_rows * state_buffers.record_dtype.itemsize * 2))
+
+        cache_path = os.path.join(vehicle_positions.get_state_cache_dir(agency_id), f'test_state_{max_buffer_bytes}.cols')
+        state_buffers.save('A', cache_path)
+
+        self.assertFalse(os.path.exists(state_buffers.get_temp_path('A')))
+        state_buffers.remove_temp_files()
+        self.assertFalse(os.path.exists(state_buffers.get_temp_path('B')))
+
+        return vehicle_positions.read_state_table(cache_path)
+
+    def test_route_state_buffers(self):
+        df = self.save_state(max_buffer_bytes=64 * 1024 * 1024)
+
+        self.assertEqual(list(df.columns), ['TIME', 'VID', 'LAT', 'LON'])
+        self.assertEqual(len(df), 67 * 3)
+        self.assertEqual(set(df['VID'].values), {'V1', 'V2', '0003'})
+        self.assertTrue(np.all(np.diff(df['TIME'].values) >= 0))
+
+        # observation times are adjusted by secsSinceReport
+        self.assertEqual(df['TIME'].values[0], 1577534000)
+        self.assertEqual(df['TIME'].values[-1], 1577534990 - 66 % 4)
+
+        # flushing buffers to disk more frequently produces the same state
+        small_buffer_df = self.save_state(max_buffer_bytes=0)
+
+        def get_rows(df):
+            return sorted(zip(df['TIME'], df['VID'], df['LAT'], df['LON']))
+
+        self.assertEqual(get_rows(small_buffer_df), get_rows(df))
+
+    def test_separate_temp_files(self):
+        agency_id = 'test'
+        Path(vehicle_positions.get_state_cache_dir(agency_id)).mkdir(parents=True, exist_ok=True)
+
+        # buffers for the same route (e.g. for different dates) use different temp files
+        state_buffers1 = vehicle_positions.RouteStateBuffers(agency_id, ['A'], max_buffer_bytes=0)
+        state_buffers2 = vehicle_positions.RouteStateBuffers(agency_id, ['A'], max_buffer_bytes=0)
+        self.assertNotEqual(state_buffers1.get_temp_path('A'), state_buffers2.get_temp_path('A'))
+
+        state_buffers1.append_vehicles(make_vehicles('A', ['V1'], 1577534000), 1577534000)
+        state_buffers2.append_vehicles(make_vehicles('A', ['V2', 'V3'], 1577534015), 1577534015)
+
+        state_buffers1.remove_temp_files()
+        self.assertFalse(os.path.exists(state_buffers1.get_temp_path('A')))
+
+        df = state_buffers2.get_data_frame('A')
+        self.assertEqual(sorted(df['VID'].values), ['V2', 'V3'])
+
+    def test_fetch_state_objects(self):
+        agency_id = 'test'
+        start_time = 1577534000
+        end_time = 1577534990 # excludes last state object
+        hour_prefixes = [
+            vehicle_positions.get_bucket_hour_prefix(agency_id, timestamp)
+            for timestamp in range(start_time - start_time % 3600, end_time, 3600)
+        ]
+
+        # state objects span two hours
+        self.assertEqual(len(hour_prefixes), 2)
+
+        Path(vehicle_positions.get_state_cache_dir(agency_id)).mkdir(parents=True, exist_ok=True)
+        state_buffers = vehicle_positions.RouteStateBuffers(agency_id, ['A'], max_buffer_bytes=1024)
+
+        with LocalStateServer(agency_id, self.get_state_objects()) as server:
+            num_fetched = asyncio.run(vehicle_positions.fetch_state_objects(server.source, hour_prefixes, start_time, end_time, state_buffers,
+                concurrency=3, max_pending_keys=2))
+
+        self.assertEqual(num_fetched, 66)
+
+        cache_path = os.path.join(vehicle_positions.get_state_cache_dir(agency_id), 'test_state_fetched.cols')
+        state_buffers.save('A', cache_path)
+        df = vehicle_positions.read_state_table(cache_path)
+
+        self.assertEqual(len(df), 66 * 3)
+        self.assertTrue(np.all(np.diff(df['TIME'].values) >= 0))
+
+    def test_get_state_incremental(self):
+        agency_id = 'test'
+        d = datetime.date(2019, 12, 28)
+        start_time = 1577534000
+        end_time = start_time + 86400
+        route_ids = ['A', 'B']
+
+        for route_id in route_ids:
+            for partial in [False, True]:
+                cache_path = vehicle_positions.get_cache_path(agency_id, d, start_time, end_time, route_id, partial=partial)
+                if os.path.exists(cache_path):
+                    os.remove(cache_path)
+
+        manifest_path = vehicle_positions.get_manifest_path(agency_id, d, start_time, end_time)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        first_hour = 1577530800
+        second_hour = 1577534400
+
+        with LocalStateServer(agency_id, self.get_state_objects()) as server:
+            # the first hour has ended but the second hour is in progress
+            with mock.patch('time.time', return_value=second_hour + 400):
+                state = vehicle_positions.get_state(agency_id, d, start_time, end_time, route_ids, source=server.source)
+
+            self.assertEqual(server.get_num_requests(first_hour), 27)
+            self.assertEqual(server.get_num_requests(second_hour), 27)
+
+            df = state.get_for_route('A')
+            self.assertEqual(len(df), 54 * 3)
+            self.assertTrue(np.all(np.diff(df['TIME'].values) >= 0))
+
+            self.assertEqual(vehicle_positions.load_manifest(manifest_path), {'A': [first_hour], 'B': [first_hour]})
+
+            # after the second hour has ended, only the second hour is fetched again
+            with mock.patch('time.time', return_value=second_hour + 3600 + 300):
+                state = vehicle_positions.get_state(agency_id, d, start_time, end_time, route_ids, source=server.source)
+
+            self.assertEqual(server.get_num_requests(first_hour), 27)
+            self.assertEqual(server.get_num_requests(second_hour), 27 + 40)
+
+            df = state.get_for_route('A')
+            self.assertEqual(len(df), 67 * 3)
+            self.assertTrue(np.all(np.diff(df['TIME'].values) >= 0))
+
+            self.assertFalse(os.path.exists(vehicle_positions.get_cache_path(agency_id, d, start_time, end_time, 'A', partial=True)))
+
+            # once all hours are cached, nothing is fetched
+            with mock.patch('time.time', return_value=end_time + 3600):
+                state = vehicle_positions.get_state(agency_id, d, start_time, end_time, route_ids, source=server.source)
+                self.assertEqual(server.get_num_requests(second_hour), 27 + 40)
+
+        b_df = state.get_for_route('B')
+        self.assertEqual(len(b_df), 67)
+        self.assertEqual(set(b_df['VID'].values), {'V4'})
+
+    def test_get_state_end_time_within_hour(self):
+        agency_id = 'test'
+        d = datetime.date(2019, 12, 28)
+        start_time = 1577534000
+        end_time = 1577534700 # not at the end of an hour
+        route_ids = ['A']
+
+        cache_path = vehicle_positions.get_cache_path(agency_id, d, start_time, end_time, 'A')
+        manifest_path = vehicle_positions.get_manifest_path(agency_id, d, start_time, end_time)
+        for path in [cache_path, manifest_path, vehicle_positions.get_cache_path(agency_id, d, start_time, end_time, 'A', partial=True)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        first_hour = 1577530800
+        second_hour = 1577534400
+
+        with LocalStateServer(agency_id, self.get_state_objects()) as server:
+            # the last hour is complete once end_time is old enough, even though the hour hasn't ended
+            with mock.patch('time.time', return_value=end_time + 300):
+                state = vehicle_positions.get_state(agency_id, d, start_time, end_time, route_ids, source=server.source)
+
+            self.assertEqual(vehicle_positions.load_manifest(manifest_path), {'A': [first_hour, second_hour]})
+            self.assertFalse(os.path.exists(vehicle_positions.get_cache_path(agency_id, d, start_time, end_time, 'A', partial=True)))
+
+            num_requests = len(server.requested_keys)
+
+            # running get_state again doesn't fetch the last hour again
+            with mock.patch('time.time', return_value=end_time + 7200):
+                state = vehicle_positions.get_state(agency_id, d, start_time, end_time, route_ids, source=server.source)
+
+            self.assertEqual(len(server.requested_keys), num_requests)
+            self.assertEqual(len(state.get_for_route('A')), 47 * 3)
+
+    def test_save_manifest_threads(self):
+        manifest_path = os.path.join(util.get_data_dir(), 'state_test_hours.json')
+
+        # concurrent writers don't share a temp file, so the manifest is always complete
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(vehicle_positions.save_manifest, manifest_path, {'A': list(range(i))}) for i in range(50)]
+            for future in futures:
+                future.result()
+
+        self.assertIn(len(vehicle_positions.load_manifest(manifest_path)['A']), range(50))
+        self.assertEqual(os.listdir(util.get_data_dir()), ['state_test_hours.json'])
+
+    def test_get_state_future(self):
+        agency_id = 'test'
+        d = datetime.date(2019, 12, 28)
+        start_time = 1577534000
+        end_time = start_time + 86400
+
+        with LocalStateServer(agency_id, self.get_state_objects()) as server:
+            # no hours of the time range have started yet
+            with mock.patch('time.time', return_value=start_time - 3600):
+                state = vehicle_positions.get_state(agency_id, d, start_time, end_time, ['A'], source=server.source)
+
+            self.assertEqual(len(server.requested_keys), 0)
+
+        self.assertEqual(state.cache_paths, {})
+        self.assertIsNone(state.get_for_route('A'))
+
+class LocalStateServer:
+    # serves raw state objects from a local HTTP server (in a separate thread) standing in for S3
+
+    def __init__(self, agency_id, state_objects):
+        self.objects = {}
+        for vehicles, timestamp in state_objects:
+            key = vehicle_positions.get_bucket_hour_prefix(agency_id, timestamp) + f'{agency_id}_{timestamp * 1000}.json'
+            self.objects[key] = json.dumps(vehicles)
+
+        self.requested_keys = []
+
+    def get_num_requests(self, hour):
+        return len([key for key in self.requested_keys if vehicle_positions.get_key_timestamp(key) // 3600 * 3600 == hour])
+
+    def __enter__(self):
+        started = threading.Event()
+        loop = self.loop = asyncio.new_event_loop()
+
+        async def get_object(request):
+            key = request.match_info['key']
+            if key not in self.objects:
+                return web.Response(status=404)
+            self.requested_keys.append(key)
+            return web.Response(text=self.objects[key], content_type='application/json')
+
+        async def start():
+            app = web.Application()
+            app.router.add_get('/test-bucket/{key:.+}', get_object)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, '127.0.0.1', 0)
+            await site.start()
+            self.port = site._server.sockets[0].getsockname()[1]
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(start())
+            started.set()
+            loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+
+        objects = self.objects
+
+        class LocalStateSource(vehicle_positions.S3StateSource):
+            def list_keys(self, key_prefix):
+                return [key for key in objects if key.startswith(key_prefix)]
+
+        self.source = LocalStateSource('test-bucket', endpoint_url=f'http://127.0.0.1:{self.port}')
+        return self
+
+    def __exit__(self, *args):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+if __name__ == '__main__':
+    unittest.main()